@@ -0,0 +1,59 @@
+"""
+/***************************************************************************
+                           Append Features to Layer
+                             --------------------
+        begin                : 2018-04-09
+        git sha              : :%H$
+        copyright            : (C) 2018 by Germán Carrillo (BSF Swissphoto)
+        email                : gcarrillo@linuxmail.org
+ ***************************************************************************/
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License v3.0 as          *
+ *   published by the Free Software Foundation.                            *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from qgis.PyQt.QtCore import QCoreApplication
+
+from qgis.core import (QgsProcessing,
+                       QgsProcessingFeatureSource,
+                       QgsProcessingParameterMultipleLayers,
+                       QgsVectorLayer)
+
+from AppendFeaturesToLayer.processing.algs.AppendFeaturesToLayer import AppendFeaturesToLayer
+from AppendFeaturesToLayer.processing.utils.sources import LoadSource
+
+
+class AppendFeaturesFromLayersToLayer(AppendFeaturesToLayer):
+    """
+    Same as AppendFeaturesToLayer, but for several source layers at once: the target layer is checked and its index
+    of values is built only once, and features from all source layers are written in the same batches.
+    """
+
+    INPUT = 'SOURCE_LAYERS'
+    SOURCE_FIELDS_PARENT = ''  # Source fields are chosen by name, they must be in all source layers
+
+    def shortHelpString(self):
+        return QCoreApplication.translate("AppendFeaturesToLayer", "This algorithm copies features from several source layers into a target layer, in a single run.\n\n"
+                                          "It works just like 'Append features to layer', but the target layer is checked and its values to compare are read only once, and features from all source layers are committed together (or in batches of N features, if chosen). This is much faster than running 'Append features to layer' once per source layer.\n\n"
+                                          "Source fields to compare (and the watermark field, if any) are given by name, and must be found in all source layers. Duplicates are only searched among target features that existed before the run, so source layers are not compared to each other.")
+
+    def add_source_parameter(self):
+        self.addParameter(QgsProcessingParameterMultipleLayers(self.INPUT,
+                                                               QCoreApplication.translate("AppendFeaturesToLayer", 'Source layers'),
+                                                               QgsProcessing.TypeVector))
+
+    def name(self):
+        return 'appendfeaturesfromlayerstolayer'
+
+    def displayName(self):
+        return QCoreApplication.translate("AppendFeaturesToLayer", 'Append features from layers to layer')
+
+    def processAlgorithm(self, parameters, context, feedback):
+        sources = [LoadSource(QgsProcessingFeatureSource(layer, context), layer)
+                   for layer in self.parameterAsLayerList(parameters, self.INPUT, context)
+                   if isinstance(layer, QgsVectorLayer)]
+
+        return self.append_features(sources, parameters, context, feedback)
@@ -15,39 +15,75 @@
  *                                                                         *
  ***************************************************************************/
 """
-from qgis.PyQt.QtCore import (QVariant,
-                              QCoreApplication)
+from qgis.PyQt.QtCore import QCoreApplication
 
-from qgis.core import (edit,
-                       QgsEditError,
+from qgis.core import (QgsEditError,
                        QgsGeometry,
                        QgsWkbTypes,
                        QgsProcessing,
                        QgsProcessingAlgorithm,
+                       QgsProcessingParameterBoolean,
+                       QgsProcessingParameterDefinition,
                        QgsProcessingParameterEnum,
+                       QgsProcessingParameterExpression,
                        QgsProcessingParameterFeatureSource,
                        QgsProcessingParameterField,
+                       QgsProcessingParameterNumber,
                        QgsProcessingParameterVectorLayer,
                        QgsProcessingOutputVectorLayer,
                        QgsProject,
-                       QgsVectorLayerUtils,
                        QgsVectorDataProvider,
                        QgsProcessingOutputNumber,
-                       QgsFeatureRequest)
+                       QgsExpression,
+                       QgsRectangle)
+
+from AppendFeaturesToLayer.processing.utils.changes import ChangeDetector
+from AppendFeaturesToLayer.processing.utils.converters import get_key_converter
+from AppendFeaturesToLayer.processing.utils.geometry import (AvoidIntersections,
+                                                             GeometryConversionPlan,
+                                                             ParallelGeometryPreparer,
+                                                             prepare_geometry)
+from AppendFeaturesToLayer.processing.utils.key_index import (build_target_key_index,
+                                                              is_null,
+                                                              probe_target_key_index)
+from AppendFeaturesToLayer.processing.utils.key_index_cache import KeyIndexCache
+from AppendFeaturesToLayer.processing.utils.mapping import AttributeTransformer
+from AppendFeaturesToLayer.processing.utils.sources import LoadSource
+from AppendFeaturesToLayer.processing.utils.watermark import Watermark
+from AppendFeaturesToLayer.processing.utils.writers import (DataProviderWriter,
+                                                            GeoPackageWriter,
+                                                            LayerEditBufferWriter,
+                                                            PostgresCopyWriter,
+                                                            PostgresUpsertWriter)
 
 
 class AppendFeaturesToLayer(QgsProcessingAlgorithm):
 
     INPUT = 'SOURCE_LAYER'
+    SOURCE_FIELDS_PARENT = INPUT  # Parameter whose fields are listed to choose source fields
     INPUT_FIELD = 'SOURCE_FIELD'
+    SOURCE_FILTER = 'SOURCE_FILTER'
     OUTPUT = 'TARGET_LAYER'
     OUTPUT_FIELD = 'TARGET_FIELD'
+    TARGET_FILTER = 'TARGET_FILTER'
     ACTION_ON_DUPLICATE = 'ACTION_ON_DUPLICATE'
+    KEY_INDEX_STRATEGY = 'KEY_INDEX_STRATEGY'
+    USE_KEY_INDEX_CACHE = 'USE_KEY_INDEX_CACHE'
+    BATCH_SIZE = 'BATCH_SIZE'
+    WRITE_MODE = 'WRITE_MODE'
+    AVOID_INTERSECTIONS = 'AVOID_INTERSECTIONS'
+    GEOMETRY_WORKERS = 'GEOMETRY_WORKERS'
+    ONLY_WRITE_CHANGES = 'ONLY_WRITE_CHANGES'
+    DELETE_MISSING = 'DELETE_MISSING'
+    WATERMARK_FIELD = 'WATERMARK_FIELD'
 
     APPENDED_COUNT = 'APPENDED_COUNT'
     UPDATED_FEATURE_COUNT = 'UPDATED_FEATURE_COUNT'
     UPDATED_ONLY_GEOMETRY_COUNT = 'UPDATED_ONLY_GEOMETRY_COUNT'
     SKIPPED_COUNT = 'SKIPPED_COUNT'
+    UNCHANGED_COUNT = 'UNCHANGED_COUNT'
+    DELETED_COUNT = 'DELETED_COUNT'
+    FILTERED_COUNT = 'FILTERED_COUNT'
 
     NO_ACTION_TEXT = "Just APPEND all features, no matter of duplicates"
     SKIP_FEATURE_TEXT = 'If duplicate is found, SKIP feature'
@@ -58,6 +94,21 @@ class AppendFeaturesToLayer(QgsProcessingAlgorithm):
     UPDATE_EXISTING_FEATURE = 2
     UPDATE_EXISTING_GEOMETRY = 3
 
+    AUTOMATIC_KEY_INDEX_TEXT = 'Automatic (based on source and target feature counts)'
+    FULL_KEY_INDEX_TEXT = 'Index all target features'
+    PROBE_KEY_INDEX_TEXT = 'Only look up source values in the target layer (probe)'
+    AUTOMATIC_KEY_INDEX = 0
+    FULL_KEY_INDEX = 1
+    PROBE_KEY_INDEX = 2
+    PROBE_MAX_RATIO = 100  # Automatic strategy probes if the target has this many times more features than the source
+
+    LAYER_EDIT_BUFFER_WRITE_MODE_TEXT = 'Layer edit buffer'
+    DATA_PROVIDER_WRITE_MODE_TEXT = 'Data provider (bypass the layer edit buffer, faster for headless runs)'
+    NATIVE_WRITE_MODE_TEXT = 'Native database tools (PostgreSQL: COPY, and a staging table to find duplicates; GeoPackage: SQLite in bulk)'
+    LAYER_EDIT_BUFFER_WRITE_MODE = 0
+    DATA_PROVIDER_WRITE_MODE = 1
+    NATIVE_WRITE_MODE = 2
+
     def createInstance(self):
         return type(self)()
 
@@ -80,22 +131,32 @@ class AppendFeaturesToLayer(QgsProcessingAlgorithm):
                                           "This algorithm allows you to choose a field in source and target layers to compare and detect duplicates. It has 4 modes of operation: 1) APPEND feature, regardless of duplicates; 2) SKIP feature if duplicate is found; 3) UPDATE the feature in target layer with attributes (including geometry) from the feature in the source layer; or 4) Only UPDATE the feature's geometry in target layer (leaving attributes intact) if duplicate is found.")
 
     def initAlgorithm(self, config=None):
-        self.addParameter(QgsProcessingParameterFeatureSource(self.INPUT,
-                                                              QCoreApplication.translate("AppendFeaturesToLayer", 'Source layer'),
-                                                              [QgsProcessing.TypeVector]))
+        self.add_source_parameter()
         self.addParameter(QgsProcessingParameterField(self.INPUT_FIELD,
-                                                      QCoreApplication.translate("AppendFeaturesToLayer", 'Source field to compare'),
+                                                      QCoreApplication.translate("AppendFeaturesToLayer", 'Source field(s) to compare'),
                                                       None,
-                                                      self.INPUT,
+                                                      self.SOURCE_FIELDS_PARENT,
+                                                      allowMultiple=True,
                                                       optional=True))
+        self.addParameter(QgsProcessingParameterExpression(self.SOURCE_FILTER,
+                                                           QCoreApplication.translate("AppendFeaturesToLayer", 'Only read source features matching this expression'),
+                                                           None,
+                                                           self.SOURCE_FIELDS_PARENT,
+                                                           optional=True))
         self.addParameter(QgsProcessingParameterVectorLayer(self.OUTPUT,
                                                               QCoreApplication.translate("AppendFeaturesToLayer", 'Target layer'),
                                                               [QgsProcessing.TypeVector]))
         self.addParameter(QgsProcessingParameterField(self.OUTPUT_FIELD,
-                                                      QCoreApplication.translate("AppendFeaturesToLayer", 'Target field to compare'),
+                                                      QCoreApplication.translate("AppendFeaturesToLayer", 'Target field(s) to compare'),
                                                       None,
                                                       self.OUTPUT,
+                                                      allowMultiple=True,
                                                       optional=True))
+        self.addParameter(QgsProcessingParameterExpression(self.TARGET_FILTER,
+                                                           QCoreApplication.translate("AppendFeaturesToLayer", 'Only find duplicates among target features matching this expression'),
+                                                           None,
+                                                           self.OUTPUT,
+                                                           optional=True))
         self.addParameter(QgsProcessingParameterEnum(self.ACTION_ON_DUPLICATE,
                                                      QCoreApplication.translate("AppendFeaturesToLayer",
                                                                                 'Action for duplicate features'),
@@ -105,6 +166,79 @@ class AppendFeaturesToLayer(QgsProcessingAlgorithm):
                                                      False,
                                                      self.NO_ACTION_TEXT,
                                                      optional=False))
+        key_index_strategy = QgsProcessingParameterEnum(self.KEY_INDEX_STRATEGY,
+                                                        QCoreApplication.translate("AppendFeaturesToLayer",
+                                                                                   'Strategy to find duplicates in target layer'),
+                                                        [self.AUTOMATIC_KEY_INDEX_TEXT, self.FULL_KEY_INDEX_TEXT,
+                                                         self.PROBE_KEY_INDEX_TEXT],
+                                                        False,
+                                                        self.AUTOMATIC_KEY_INDEX,
+                                                        optional=True)
+        key_index_strategy.setFlags(key_index_strategy.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(key_index_strategy)
+        use_key_index_cache = QgsProcessingParameterBoolean(self.USE_KEY_INDEX_CACHE,
+                                                            QCoreApplication.translate("AppendFeaturesToLayer",
+                                                                                       'Cache the target index of values across runs'),
+                                                            False,
+                                                            optional=True)
+        use_key_index_cache.setFlags(use_key_index_cache.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(use_key_index_cache)
+        batch_size = QgsProcessingParameterNumber(self.BATCH_SIZE,
+                                                  QCoreApplication.translate("AppendFeaturesToLayer",
+                                                                             'Commit every N source features (0: commit all features at once)'),
+                                                  QgsProcessingParameterNumber.Integer,
+                                                  0,
+                                                  optional=True,
+                                                  minValue=0)
+        batch_size.setFlags(batch_size.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(batch_size)
+        write_mode = QgsProcessingParameterEnum(self.WRITE_MODE,
+                                                QCoreApplication.translate("AppendFeaturesToLayer",
+                                                                           'Write features through'),
+                                                [self.LAYER_EDIT_BUFFER_WRITE_MODE_TEXT,
+                                                 self.DATA_PROVIDER_WRITE_MODE_TEXT,
+                                                 self.NATIVE_WRITE_MODE_TEXT],
+                                                False,
+                                                self.LAYER_EDIT_BUFFER_WRITE_MODE,
+                                                optional=True)
+        write_mode.setFlags(write_mode.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(write_mode)
+        avoid_intersections = QgsProcessingParameterBoolean(self.AVOID_INTERSECTIONS,
+                                                            QCoreApplication.translate("AppendFeaturesToLayer",
+                                                                                       "Avoid intersections with layers set in the project's digitizing options"),
+                                                            True,
+                                                            optional=True)
+        avoid_intersections.setFlags(avoid_intersections.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(avoid_intersections)
+        geometry_workers = QgsProcessingParameterNumber(self.GEOMETRY_WORKERS,
+                                                        QCoreApplication.translate("AppendFeaturesToLayer",
+                                                                                   'Prepare geometries in N parallel workers (0: no workers)'),
+                                                        QgsProcessingParameterNumber.Integer,
+                                                        0,
+                                                        optional=True,
+                                                        minValue=0)
+        geometry_workers.setFlags(geometry_workers.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(geometry_workers)
+        only_write_changes = QgsProcessingParameterBoolean(self.ONLY_WRITE_CHANGES,
+                                                           QCoreApplication.translate("AppendFeaturesToLayer",
+                                                                                      'On UPDATE, only write features and fields whose values differ from source values'),
+                                                           False,
+                                                           optional=True)
+        only_write_changes.setFlags(only_write_changes.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(only_write_changes)
+        self.addParameter(QgsProcessingParameterBoolean(self.DELETE_MISSING,
+                                                        QCoreApplication.translate("AppendFeaturesToLayer",
+                                                                                   'DELETE target features not found in source layer (sync)'),
+                                                        False,
+                                                        optional=True))
+        watermark_field = QgsProcessingParameterField(self.WATERMARK_FIELD,
+                                                      QCoreApplication.translate("AppendFeaturesToLayer",
+                                                                                 'Only read source features whose value in this field is greater than in the last run (e.g., a modification timestamp)'),
+                                                      None,
+                                                      self.SOURCE_FIELDS_PARENT,
+                                                      optional=True)
+        watermark_field.setFlags(watermark_field.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(watermark_field)
         self.addOutput(QgsProcessingOutputVectorLayer(self.OUTPUT,
                                                       QCoreApplication.translate("AppendFeaturesToLayer",
                                                                                  "Target layer to paste new features")))
@@ -120,6 +254,20 @@ class AppendFeaturesToLayer(QgsProcessingAlgorithm):
         self.addOutput(QgsProcessingOutputNumber(self.SKIPPED_COUNT,
                                                  QCoreApplication.translate("AppendFeaturesToLayer",
                                                                             "Number of features skipped")))
+        self.addOutput(QgsProcessingOutputNumber(self.UNCHANGED_COUNT,
+                                                 QCoreApplication.translate("AppendFeaturesToLayer",
+                                                                            "Number of duplicate features not updated, since they had no changes")))
+        self.addOutput(QgsProcessingOutputNumber(self.DELETED_COUNT,
+                                                 QCoreApplication.translate("AppendFeaturesToLayer",
+                                                                            "Number of target features deleted, since they were not found in source layer")))
+        self.addOutput(QgsProcessingOutputNumber(self.FILTERED_COUNT,
+                                                 QCoreApplication.translate("AppendFeaturesToLayer",
+                                                                            "Number of source features not read, since they didn't match the source filter")))
+
+    def add_source_parameter(self):
+        self.addParameter(QgsProcessingParameterFeatureSource(self.INPUT,
+                                                              QCoreApplication.translate("AppendFeaturesToLayer", 'Source layer'),
+                                                              [QgsProcessing.TypeVector]))
 
     def name(self):
         return 'appendfeaturestolayer'
@@ -129,57 +277,106 @@ class AppendFeaturesToLayer(QgsProcessingAlgorithm):
 
     def processAlgorithm(self, parameters, context, feedback):
         source = self.parameterAsSource(parameters, self.INPUT, context)
+        source_layer = None  # Only needed to identify the source layer across runs
+        if self.parameterAsFields(parameters, self.WATERMARK_FIELD, context):
+            source_layer = self.parameterAsVectorLayer(parameters, self.INPUT, context)
+
+        return self.append_features([LoadSource(source, source_layer)], parameters, context, feedback)
+
+    def append_features(self, sources, parameters, context, feedback):
+        """
+        Append features from one or more source layers to the target layer. Target checks, the target index of
+        values and the writer are shared by all source layers, whose features go through the same batches.
+
+        :param sources: List of LoadSource
+        :return: dict of results
+        """
         source_fields_parameter = self.parameterAsFields(parameters, self.INPUT_FIELD, context)
+        source_filter_expression = self.parameterAsExpression(parameters, self.SOURCE_FILTER, context)
         target = self.parameterAsVectorLayer(parameters, self.OUTPUT, context)
         target_fields_parameter = self.parameterAsFields(parameters, self.OUTPUT_FIELD, context)
+        target_filter = self.parameterAsExpression(parameters, self.TARGET_FILTER, context)
         action_on_duplicate = self.parameterAsEnum(parameters, self.ACTION_ON_DUPLICATE, context)
+        key_index_strategy = self.parameterAsEnum(parameters, self.KEY_INDEX_STRATEGY, context)
+        use_key_index_cache = self.parameterAsBoolean(parameters, self.USE_KEY_INDEX_CACHE, context)
+        batch_size = self.parameterAsInt(parameters, self.BATCH_SIZE, context)
+        write_mode = self.parameterAsEnum(parameters, self.WRITE_MODE, context)
+        use_avoid_intersections = self.parameterAsBoolean(parameters, self.AVOID_INTERSECTIONS, context)
+        geometry_workers = self.parameterAsInt(parameters, self.GEOMETRY_WORKERS, context)
+        only_write_changes = self.parameterAsBoolean(parameters, self.ONLY_WRITE_CHANGES, context)
+        delete_missing = self.parameterAsBoolean(parameters, self.DELETE_MISSING, context)
+        watermark_fields_parameter = self.parameterAsFields(parameters, self.WATERMARK_FIELD, context)
 
         results = {self.OUTPUT: None,
                    self.APPENDED_COUNT: None,
                    self.UPDATED_FEATURE_COUNT: None,
                    self.UPDATED_ONLY_GEOMETRY_COUNT: None,
-                   self.SKIPPED_COUNT: None}
+                   self.SKIPPED_COUNT: None,
+                   self.UNCHANGED_COUNT: None,
+                   self.DELETED_COUNT: None,
+                   self.FILTERED_COUNT: None}
 
+        if not sources:
+            feedback.reportError("\nWARNING: You need to choose at least one source layer before running this algorithm.")
+            return results
+
+        # Several fields to compare make a composite key, whose components are compared in the given order
         target_value_dict = dict()
-        source_field_unique_values = ''
-        target_field_unique_values = ''
-        source_field_type = None
-        target_field_type = None
-
-        if source_fields_parameter:
-            source_field_unique_values = source_fields_parameter[0]
-            if source.fields().indexOf(source_field_unique_values) == -1:
+        target_field_unique_values = list()
+        target_field_types = list()
+
+        for target_field in target_fields_parameter:
+            if target.fields().indexOf(target_field) == -1:
                 feedback.reportError(
-                    "\nWARNING: '{field}' field not found in source layer! If you're using an ETL model, the '{field}' field must be included in the mapping.".format(field=source_field_unique_values))
+                    "\nWARNING: '{field}' field not found in target layer! If you're using an ETL model, the '{field}' field must be included in the mapping.".format(field=target_field))
                 return results
 
-            source_field_type = source.fields().field(source_field_unique_values).type()
+            target_field_unique_values.append(target_field)
+            target_field_types.append(target.fields().field(target_field).type())
 
-        if target_fields_parameter:
-            target_field_unique_values = target_fields_parameter[0]
-            if target.fields().indexOf(target_field_unique_values) == -1:
-                feedback.reportError(
-                    "\nWARNING: '{field}' field not found in target layer! If you're using an ETL model, the '{field}' field must be included in the mapping.".format(field=target_field_unique_values))
-                return results
+        if source_fields_parameter and target_field_unique_values and len(source_fields_parameter) != len(target_field_unique_values):
+            feedback.reportError("\nWARNING: You need to choose the same number of source and target fields to compare (they are compared in the given order).")
+            return results
+
+        if source_filter_expression and QgsExpression(source_filter_expression).hasParserError():
+            feedback.reportError("\nWARNING: The source filter is not a valid expression: {}".format(
+                QgsExpression(source_filter_expression).parserErrorString()))
+            return results
+
+        if target_filter and QgsExpression(target_filter).hasParserError():
+            feedback.reportError("\nWARNING: The target filter is not a valid expression: {}".format(
+                QgsExpression(target_filter).parserErrorString()))
+            return results
 
-            target_field_type = target.fields().field(target_field_unique_values).type()
+        if watermark_fields_parameter and delete_missing:
+            feedback.reportError("\nWARNING: Target features not found in source layer cannot be deleted when only reading source features newer than the last run. Choose either option before running this algorithm.")
+            return results
 
-        if source_field_type != target_field_type:
-            feedback.pushInfo("\nWARNING: Source and target fields to compare have different field types.")
+        if source_filter_expression and delete_missing and not target_filter:
+            feedback.reportError("\nWARNING: Target features not found in source layer cannot be deleted when only reading source features matching the source filter, since target features matching the other source features would be deleted too. Set a target filter that selects the same features, or choose either option before running this algorithm.")
+            return results
 
-        if source_field_unique_values and target_field_unique_values and action_on_duplicate == self.NO_ACTION:
+        if source_fields_parameter and target_field_unique_values and action_on_duplicate == self.NO_ACTION:
             feedback.reportError("\nWARNING: Since you have chosen source and target fields to compare, you need to choose a valid action to apply on duplicate features before running this algorithm.")
             return results
 
-        if action_on_duplicate != self.NO_ACTION and not (source_field_unique_values and target_field_unique_values):
+        if action_on_duplicate != self.NO_ACTION and not (source_fields_parameter and target_field_unique_values):
             feedback.reportError("\nWARNING: Since you have chosen an action on duplicate features, you need to choose both source and target fields for comparing values before running this algorithm.")
             return results
 
+        if delete_missing and action_on_duplicate == self.NO_ACTION:
+            feedback.reportError("\nWARNING: To delete target features not found in source layer, you need to choose source and target fields to compare and a valid action to apply on duplicate features before running this algorithm.")
+            return results
+
         caps = target.dataProvider().capabilities()
         if not(caps & QgsVectorDataProvider.AddFeatures):
             feedback.reportError("\nWARNING: The target layer does not support appending features to it! Choose another target layer.")
             return results
 
+        if delete_missing and not (caps & QgsVectorDataProvider.DeleteFeatures):
+            feedback.reportError("\nWARNING: The target layer does not support deleting features! Uncheck the option to delete target features not found in source layer or choose another target layer.")
+            return results
+
         if action_on_duplicate == self.UPDATE_EXISTING_FEATURE:
             if target.isSpatial() and not (
                     caps & QgsVectorDataProvider.ChangeAttributeValues and caps & QgsVectorDataProvider.ChangeGeometries):
@@ -193,11 +390,6 @@ class AppendFeaturesToLayer(QgsProcessingAlgorithm):
                 return results
 
         if action_on_duplicate == self.UPDATE_EXISTING_GEOMETRY:
-            if QgsWkbTypes.geometryType(source.wkbType()) == QgsWkbTypes.NullGeometry:
-                feedback.reportError(
-                    "\nWARNING: The source layer is not spatial! Choose another action for duplicate features or choose another source layer.")
-                return results
-
             if not target.isSpatial():
                 feedback.reportError(
                     "\nWARNING: The target layer is not spatial! Choose another action for duplicate features or choose another target layer.")
@@ -208,151 +400,446 @@ class AppendFeaturesToLayer(QgsProcessingAlgorithm):
                     "\nWARNING: The target layer does not support updating its geometries! Choose another action for duplicate features or choose another target layer.")
                 return results
 
-        editable_before = False
         if target.isEditable():
-            editable_before = True
             feedback.reportError("\nWARNING: You need to close the edit session on layer '{}' before running this algorithm.".format(
                 target.name()
             ))
             return results
 
-        # Define a mapping between source and target layer
-        mapping = dict()
-        for target_idx in target.fields().allAttributesList():
-            # We won't update PKs on UPDATE mode, that would be dangerous (at least most of the times)!
-            if action_on_duplicate == self.UPDATE_EXISTING_FEATURE and target_idx in target.primaryKeyAttributes():
-                continue
+        # Compare values to update with current target values, instead of writing them all
+        only_write_changes = only_write_changes and action_on_duplicate in (self.UPDATE_EXISTING_FEATURE,
+                                                                            self.UPDATE_EXISTING_GEOMETRY)
+
+        # Resolve, once per source layer (instead of for each source feature), how to read and convert its features
+        for load_source in sources:
+            source = load_source.source
+            source_field_types = list()
+            for source_field in source_fields_parameter:
+                source_idx = source.fields().indexOf(source_field)
+                if source_idx == -1:
+                    feedback.reportError(
+                        "\nWARNING: '{field}' field not found in source layer '{layer}'! If you're using an ETL model, the '{field}' field must be included in the mapping.".format(
+                            field=source_field, layer=load_source.name))
+                    return results
+
+                load_source.key_idxs.append(source_idx)
+                source_field_types.append(source.fields().field(source_field).type())
+
+            if watermark_fields_parameter:
+                watermark_field = watermark_fields_parameter[0]
+                load_source.watermark_idx = source.fields().indexOf(watermark_field)
+                if load_source.watermark_idx == -1:
+                    feedback.reportError(
+                        "\nWARNING: '{field}' field not found in source layer '{layer}'! If you're using an ETL model, the '{field}' field must be included in the mapping.".format(
+                            field=watermark_field, layer=load_source.name))
+                    return results
+
+                if source.fields().at(load_source.watermark_idx).type() not in Watermark.FIELD_TYPES:
+                    feedback.reportError("\nWARNING: The watermark field '{}' must be a numeric, text, date or datetime field.".format(watermark_field))
+                    return results
+
+                if load_source.layer is None:
+                    feedback.pushInfo("\nWARNING: The source layer '{}' cannot be identified across runs, so all its features will be read.".format(
+                        load_source.name))
+                else:
+                    load_source.watermark = Watermark(load_source.layer, target, watermark_field)
 
-            # Check that we don't have an automatic PK.
-            # Note that for non-automatic PKs, PG is giving a nextval(NULL) as default clause (which should be '').
-            if target.dataProvider().defaultValueClause(target_idx) not in ['', 'nextval(NULL)'] and target_idx in target.primaryKeyAttributes():
-                continue  # We won't be able to update automatic PKs, so skip them
+            load_source.convert_key = get_key_converter(source_field_types, target_field_types)
+            if source_field_types != target_field_types:
+                load_source.duplicate_convert_key = load_source.convert_key
+                feedback.pushInfo("\nWARNING: Source fields to compare in '{}' and target fields to compare have different field types.".format(
+                    load_source.name))
 
-            target_field = target.fields().field(target_idx)
+            if action_on_duplicate == self.UPDATE_EXISTING_GEOMETRY and \
+                    QgsWkbTypes.geometryType(source.wkbType()) == QgsWkbTypes.NullGeometry:
+                feedback.reportError(
+                    "\nWARNING: The source layer '{}' is not spatial! Choose another action for duplicate features or choose another source layer.".format(
+                        load_source.name))
+                return results
 
-            if target.dataProvider().storageType() == 'GPKG' and target_field.name() == 'fid':
-                continue  # We won't be able to update a GPKG FID, so skip it.
+            load_source.geometry_plan = GeometryConversionPlan(source.wkbType(),
+                                                               target.wkbType() if target.isSpatial() else QgsWkbTypes.NoGeometry)
+            if not load_source.geometry_plan.is_supported():
+                feedback.reportError("\nWARNING: Source geometries ({}) of '{}' cannot be converted to the geometry type of the target layer ({})! Choose another target layer.".format(
+                    QgsWkbTypes.displayString(source.wkbType()),
+                    load_source.name,
+                    QgsWkbTypes.displayString(target.wkbType())
+                ))
+                return results
 
-            source_idx = source.fields().indexOf(target_field.name())
-            if source_idx != -1:
-                mapping[target_idx] = source_idx
+            load_source.mapping = self.build_mapping(source, target, action_on_duplicate)
+            load_source.transformer = AttributeTransformer(load_source.mapping, source.fields().count(), target.fields().count())
+            if only_write_changes:
+                load_source.change_detector = ChangeDetector(target, source.fields(), load_source.mapping)
+
+            # Only read source features matching the source filter, and newer than the last committed watermark.
+            # Providers that can compile the expression run it themselves (e.g., in SQL).
+            source_filters = [source_filter_expression] if source_filter_expression else list()
+            if load_source.watermark:
+                last_watermark = load_source.watermark.load()
+                if last_watermark is None:
+                    feedback.pushInfo("\nWATERMARK: There is no watermark from previous runs, so all features from '{}' will be read.".format(
+                        load_source.name))
+                else:
+                    source_filters.append(load_source.watermark.filter_expression(last_watermark))
+                    feedback.pushInfo("\nWATERMARK: Only features from '{}' with {} will be read.".format(
+                        load_source.name, source_filters[-1]))
+
+            load_source.filter_expression = " AND ".join("({})".format(f) for f in source_filters) or None
+            if load_source.filter_expression:
+                load_source.expression_context = self.createExpressionContext(parameters, context, source)
+
+        if write_mode == self.NATIVE_WRITE_MODE and not (PostgresCopyWriter.is_supported(target) or GeoPackageWriter.is_supported(target)):
+            feedback.pushInfo("\nWARNING: Native database tools are only used for GeoPackage and PostgreSQL layers (the latter require the psycopg2 Python module). Features will be written through the data provider of '{}'.".format(
+                target.name()
+            ))
+            write_mode = self.DATA_PROVIDER_WRITE_MODE
+
+        if write_mode == self.NATIVE_WRITE_MODE and (target_filter or target.subsetString()) and \
+                action_on_duplicate != self.NO_ACTION and PostgresCopyWriter.is_supported(target):
+            # Statements run by PostgreSQL would also find, update or delete target features outside the layer's subset
+            feedback.pushInfo("\nWARNING: Duplicates among filtered target features (by the target filter or the layer's subset) cannot be found by PostgreSQL itself. Features will be written through the data provider of '{}'.".format(
+                target.name()
+            ))
+            write_mode = self.DATA_PROVIDER_WRITE_MODE
+
+        if write_mode == self.NATIVE_WRITE_MODE and len({tuple(sorted(s.mapping)) for s in sources}) > 1:
+            # Native writers copy the same target fields for all features, and leave the others to the database
+            feedback.pushInfo("\nWARNING: Source layers don't share the same fields with the target layer, so native database tools cannot be used. Features will be written through the data provider of '{}'.".format(
+                target.name()
+            ))
+            write_mode = self.DATA_PROVIDER_WRITE_MODE
+
+        if write_mode in (self.DATA_PROVIDER_WRITE_MODE, self.NATIVE_WRITE_MODE) and not DataProviderWriter.is_supported(target):
+            feedback.pushInfo("\nWARNING: Features cannot be written through the data provider of '{}', nor with native database tools (it has joined or virtual fields), so the layer edit buffer will be used.".format(
+                target.name()
+            ))
+            write_mode = self.LAYER_EDIT_BUFFER_WRITE_MODE
+
+        # In native mode, duplicates are found by the database itself, after staging all source features
+        match_in_database = write_mode == self.NATIVE_WRITE_MODE and action_on_duplicate != self.NO_ACTION and \
+                            PostgresCopyWriter.is_supported(target)
+
+        source_feature_counts = [load_source.source.featureCount() for load_source in sources]
+        source_feature_count = sum(source_feature_counts) if min(source_feature_counts) >= 0 else -1
 
         # Build dict of target field values so that we can search easily later {value1: [id1, id2], ...}
-        if target_field_unique_values:
-            for f in target.getFeatures():
-                if f[target_field_unique_values] in target_value_dict:
-                    target_value_dict[f[target_field_unique_values]].append(int(f.id()))
+        key_index_cache = None
+        if target_field_unique_values and not match_in_database:
+            if use_key_index_cache and target_filter:
+                feedback.pushInfo("\nKEY INDEX: The target index of values is not cached when filtering target features.")
+            elif use_key_index_cache:
+                if key_index_strategy == self.PROBE_KEY_INDEX and not delete_missing:
+                    feedback.pushInfo("\nKEY INDEX: The target index of values is not cached when probing the target layer.")
+                else:
+                    key_index_strategy = self.FULL_KEY_INDEX  # A cached index is cheaper than probing
+                    key_index_cache = KeyIndexCache(target, target_field_unique_values)
+                    if not key_index_cache.is_supported():
+                        feedback.pushInfo("\nKEY INDEX: The target index of values cannot be cached for layer '{}'.".format(target.name()))
+                        key_index_cache = None
+
+            if delete_missing and key_index_strategy != self.FULL_KEY_INDEX:
+                # Target features not found in source can only be known if all of them are indexed
+                if key_index_strategy == self.PROBE_KEY_INDEX:
+                    feedback.pushInfo("\nKEY INDEX: All target features will be indexed (instead of probing the target layer), to find those not found in source layer.")
+                key_index_strategy = self.FULL_KEY_INDEX
+
+            if key_index_strategy == self.AUTOMATIC_KEY_INDEX:
+                target_count = target.featureCount()
+                if 0 <= source_feature_count and source_feature_count * self.PROBE_MAX_RATIO < target_count:
+                    key_index_strategy = self.PROBE_KEY_INDEX
                 else:
-                    target_value_dict[f[target_field_unique_values]] = [int(f.id())]
+                    key_index_strategy = self.FULL_KEY_INDEX
+
+            if key_index_strategy == self.PROBE_KEY_INDEX:
+                # Only read source keys and look them up in the target (once for all source layers)
+                source_values = list()
+                for load_source in sources:
+                    for f in load_source.source.getFeatures(load_source.key_request()):
+                        converted_value = load_source.convert_key(load_source.key(f.attributes()))
+                        if converted_value is not None:
+                            source_values.append(converted_value)
+
+                target_value_dict = probe_target_key_index(target, target_field_unique_values, source_values, feedback,
+                                                           filter_expression=target_filter)
+            else:
+                if key_index_cache:
+                    target_value_dict = key_index_cache.load()
+                    if target_value_dict is not None:
+                        feedback.pushInfo("\nKEY INDEX: {} unique values in '{}' were read from the cache.".format(
+                            len(target_value_dict),
+                            "', '".join(target_field_unique_values)
+                        ))
+
+                if target_value_dict is None:
+                    target_value_dict = build_target_key_index(target, target_field_unique_values, feedback,
+                                                               filter_expression=target_filter)
+                    if key_index_cache:
+                        key_index_cache.save(target_value_dict)
 
         # Prepare features for the Copy and Paste
         results[self.APPENDED_COUNT] = 0
-        total = 100.0 / source.featureCount() if source.featureCount() else 0
-        features = source.getFeatures()
-        destType = target.geometryType()
-        destIsMulti = QgsWkbTypes.isMultiType(target.wkbType())
+        total = 100.0 / source_feature_count if source_feature_count > 0 else 0
+        for description in dict.fromkeys(load_source.geometry_plan.describe() for load_source in sources
+                                         if load_source.geometry_plan.has_geometries()):
+            feedback.pushInfo("\nGEOMETRIES: {}.".format(description))
+
+        # Read avoid-intersections layers once, only where source features can be
+        avoid_intersections = None
+        if use_avoid_intersections and any(load_source.geometry_plan.has_geometries() for load_source in sources) and \
+                sources[0].geometry_plan.target_geometry_type in (QgsWkbTypes.PolygonGeometry, QgsWkbTypes.UnknownGeometry):
+            avoid_intersections_layers = QgsProject.instance().avoidIntersectionsLayers()
+            if avoid_intersections_layers:
+                source_extent = QgsRectangle(sources[0].source.sourceExtent())
+                for load_source in sources[1:]:
+                    source_extent.combineExtentWith(load_source.source.sourceExtent())
+                avoid_intersections = AvoidIntersections(avoid_intersections_layers, source_extent, feedback)
         new_features = list()
-        updated_features = dict()
+        updated_features = dict()  # Updates from the current source layer
         updated_geometries = dict()
+        pending_features = dict()  # Updates from all source layers, to write in the current batch
+        pending_geometries = dict()
+        batch_count = 0  # Source features processed since the last commit
+        current = 0  # Source features processed, from all source layers
+        appended_count = 0
+        not_appended_count = 0
+        not_converted_count = 0  # Source features whose geometries couldn't be converted
         updated_features_count = 0
         updated_geometries_count = 0
         skipped_features_count = 0  # To properly count features that were skipped
+        unchanged_features_count = 0  # Duplicate features that already had source values
         duplicate_features_set = set()  # To properly count features that were updated
-        for current, in_feature in enumerate(features):
-            if feedback.isCanceled():
-                break
-
-            target_feature_exists = False
-            duplicate_target_value = None
-
-            # If skip is the action, skip as soon as possible
-            if source_field_unique_values:
-                duplicate_target, duplicate_target_value = self.find_duplicate_value(
-                    in_feature[source_field_unique_values],
-                    source_field_type,
-                    target_value_dict,
-                    target_field_type)
-                if duplicate_target:
-                    if action_on_duplicate == self.SKIP_FEATURE:
-                        request = QgsFeatureRequest(target_value_dict[duplicate_target_value])  # Get target feature ids
-                        request.setFlags(QgsFeatureRequest.NoGeometry)
-                        request.setSubsetOfAttributes([])  # Note: this adds a new flag
-                        skipped_features_count += len([f for f in target.getFeatures(request)])
-                        continue
-
-                    target_feature_exists = True
-
-            attrs = {target_idx: in_feature[source_idx] for target_idx, source_idx in mapping.items()}
-
-            geom = QgsGeometry()
-
-            if QgsWkbTypes.geometryType(
-                    source.wkbType()) != QgsWkbTypes.NullGeometry and in_feature.hasGeometry() and target.isSpatial():
-                # Convert geometry to match destination layer
-                # Adapted from QGIS qgisapp.cpp, pasteFromClipboard()
-                geom = in_feature.geometry()
-
-                if not geom.isNull():
-                    if destType != QgsWkbTypes.UnknownGeometry:
-                        newGeometry = geom.convertToType(destType, destIsMulti)
-
-                        if newGeometry.isNull():
-                            continue  # Couldn't convert
-                        geom = newGeometry
+        found_target_values = set()  # Target values found in source, to know which target features to delete
+        deleted_features_count = 0
+
+        field_indexes = sources[0].mapping.keys()  # The same for all source layers in native mode
+        if match_in_database:
+            writer = PostgresUpsertWriter(target, feedback, field_indexes, target_field_unique_values)
+        elif write_mode == self.NATIVE_WRITE_MODE and GeoPackageWriter.is_supported(target):
+            writer = GeoPackageWriter(target, feedback, field_indexes, key_index_cache)
+        elif write_mode == self.NATIVE_WRITE_MODE:
+            writer = PostgresCopyWriter(target, feedback, field_indexes)
+            if key_index_cache:
+                # Feature ids of copied rows are not known, so they cannot be registered in the cached index
+                key_index_cache.invalidate()
+                key_index_cache = None
+        elif write_mode == self.DATA_PROVIDER_WRITE_MODE:
+            writer = DataProviderWriter(target, feedback, key_index_cache)
+        else:
+            writer = LayerEditBufferWriter(target, feedback)
 
-                    # Avoid intersection if enabled in digitize settings
-                    geom.avoidIntersections(QgsProject.instance().avoidIntersectionsLayers())
+        if key_index_cache:
+            key_index_cache.track_commits()
 
-            if target_feature_exists and action_on_duplicate in (self.UPDATE_EXISTING_FEATURE, self.UPDATE_EXISTING_GEOMETRY):
-                for t_f in target.getFeatures(target_value_dict[duplicate_target_value]):
-                    duplicate_features_set.add(t_f.id())
-                    if action_on_duplicate == self.UPDATE_EXISTING_FEATURE:
-                        updated_features[t_f.id()] = attrs
+        if geometry_workers and any(load_source.geometry_plan.has_geometries() for load_source in sources):
+            feedback.pushInfo("\nGEOMETRIES: Geometries will be prepared by {} parallel workers.".format(geometry_workers))
 
-                    if QgsWkbTypes.geometryType(source.wkbType()) != QgsWkbTypes.NullGeometry and target.isSpatial():
-                        # Only overwrite geometry if both source and target layers are spatial
-                        updated_geometries[t_f.id()] = geom
-            else:  # Append
-                new_feature = QgsVectorLayerUtils().createFeature(target, geom, attrs)
-                new_features.append(new_feature)
+        for load_source in sources:
+            if feedback.isCanceled():
+                break
 
-            feedback.setProgress(int(current * total))
+            copy_geometries = load_source.geometry_plan.has_geometries()
+            transformer = load_source.transformer
+            features = load_source.source.getFeatures(load_source.request(copy_geometries))
+
+            # Geometries are either prepared by parallel workers, ahead of this loop, or in this loop
+            prepared_features = ((in_feature, None) for in_feature in features)
+            if geometry_workers and copy_geometries:
+                prepared_features = ParallelGeometryPreparer(load_source.geometry_plan, avoid_intersections,
+                                                             geometry_workers).prepare(features)
+
+            for in_feature, prepared_geometry in prepared_features:
+                if feedback.isCanceled():
+                    break
+
+                current += 1
+                load_source.read_count += 1
+                target_feature_exists = False
+                duplicate_target_value = None
+                in_attributes = in_feature.attributes()
+                if load_source.watermark:
+                    load_source.watermark.observe(in_attributes[load_source.watermark_idx])
+
+                # If skip is the action, skip as soon as possible
+                if load_source.key_idxs and not match_in_database:
+                    duplicate_target, duplicate_target_value = self.find_duplicate_value(
+                        load_source.key(in_attributes),
+                        target_value_dict,
+                        load_source.duplicate_convert_key)
+                    if duplicate_target:
+                        load_source.duplicate_count += 1
+                        if delete_missing:
+                            found_target_values.add(duplicate_target_value)
+
+                        if action_on_duplicate == self.SKIP_FEATURE:
+                            # The key index already has the target feature ids, no need to go to the target layer
+                            skipped_features_count += len(target_value_dict[duplicate_target_value])
+                            continue
+
+                        target_feature_exists = True
+
+                geom = QgsGeometry()
+
+                if prepared_geometry is False:
+                    not_converted_count += 1
+                    continue  # Couldn't convert
+                elif prepared_geometry is not None:
+                    geom = prepared_geometry
+                elif copy_geometries and in_feature.hasGeometry():
+                    # Convert geometry to match destination layer and avoid intersection if enabled in digitize settings
+                    # Adapted from QGIS qgisapp.cpp, pasteFromClipboard()
+                    geom = in_feature.geometry()
+
+                    if not geom.isNull():
+                        geom = prepare_geometry(geom, load_source.geometry_plan, avoid_intersections)
+                        if geom is None:
+                            not_converted_count += 1
+                            continue  # Couldn't convert
 
-        # Do the Copy and Paste
-        res_add_features = False
+                if target_feature_exists and action_on_duplicate in (self.UPDATE_EXISTING_FEATURE, self.UPDATE_EXISTING_GEOMETRY):
+                    attrs = transformer.update_map(in_attributes)
+                    for fid in target_value_dict[duplicate_target_value]:
+                        duplicate_features_set.add(fid)
+                        if action_on_duplicate == self.UPDATE_EXISTING_FEATURE:
+                            updated_features[fid] = attrs
+
+                        if copy_geometries:
+                            # Only overwrite geometry if both source and target layers are spatial
+                            updated_geometries[fid] = geom
+                elif match_in_database:  # Stage, duplicates will be found by the database
+                    new_feature = writer.create_feature(geom, transformer.target_attributes(in_attributes),
+                                                        load_source.convert_key(load_source.key(in_attributes)))
+                    new_features.append(new_feature)
+                else:  # Append
+                    new_feature = writer.create_feature(geom, transformer.target_attributes(in_attributes))
+                    new_features.append(new_feature)
+                    load_source.queued_count += 1
+
+                batch_count += 1
+                if batch_size and batch_count >= batch_size:
+                    # Commit this batch, so that memory usage doesn't depend on the source size
+                    unchanged_features_count += self.merge_updates(load_source.change_detector,
+                                                                   updated_features, updated_geometries,
+                                                                   pending_features, pending_geometries)
+                    try:
+                        res_update_features, res_update_geometries, res_add_features = writer.write(
+                            new_features, pending_features, pending_geometries)
+                    except QgsEditError as e:
+                        self.report_write_error(target, writer, key_index_cache, e, appended_count, feedback)
+                        return results
+
+                    updated_features_count += res_update_features
+                    updated_geometries_count += res_update_geometries
+                    if match_in_database:
+                        pass  # Staged features are counted after merging them
+                    elif res_add_features:
+                        appended_count += len(new_features)
+                    else:
+                        not_appended_count += len(new_features)
+                    for written_source in sources:
+                        written_source.batch_written(res_add_features)
+
+                    new_features = list()
+                    updated_features = dict()
+                    updated_geometries = dict()
+                    pending_features = dict()
+                    pending_geometries = dict()
+                    batch_count = 0
+                    feedback.setProgress(int(current * total))
+                elif not batch_size:
+                    feedback.setProgress(int((current - 1) * total))
+
+            # Updates are compared with target values using the field types of their own source layer
+            unchanged_features_count += self.merge_updates(load_source.change_detector,
+                                                           updated_features, updated_geometries,
+                                                           pending_features, pending_geometries)
+            updated_features = dict()
+            updated_geometries = dict()
+
+        # Do the Copy and Paste (or commit the last batch)
         try:
-            with edit(target):
-                target.beginEditCommand("Appending/Updating features...")
-
-                if updated_features:
-                    for k, v in updated_features.items():
-                        if target.changeAttributeValues(k, v):
-                            updated_features_count += 1
-                        else:
-                            feedback.reportError("\nERROR: Target feature (id={}) couldn't be updated to the following attributes: {}.".format(k, v))
-
-                if updated_geometries:
-                    for k,v in updated_geometries.items():
-                        if target.changeGeometry(k, v):
-                            updated_geometries_count += 1
-                        else:
-                            feedback.reportError("\nERROR: Target feature's geometry (id={}) couldn't be updated.".format(k))
-
-                if new_features:
-                    res_add_features = target.addFeatures(new_features)
-
-                target.endEditCommand()
+            res_update_features, res_update_geometries, res_add_features = writer.write(
+                new_features, pending_features, pending_geometries)
         except QgsEditError as e:
-            if not editable_before:
-                # Let's close the edit session to prepare for a next run
-                target.rollBack()
-
-            feedback.reportError("\nERROR: No features could be appended/updated to/in '{}', because of the following error:\n{}\n".format(
-                target.name(),
-                repr(e)
-            ))
+            self.report_write_error(target, writer, key_index_cache, e, appended_count, feedback)
             return results
 
+        updated_features_count += res_update_features
+        updated_geometries_count += res_update_geometries
+        if new_features and not match_in_database:
+            if res_add_features:
+                appended_count += len(new_features)
+            else:
+                not_appended_count += len(new_features)
+        for written_source in sources:
+            written_source.batch_written(res_add_features)
+
+        # Delete target features not found in source, only if the whole source was read
+        if delete_missing and not match_in_database and not feedback.isCanceled():
+            missing_fids = [fid for value, fids in target_value_dict.items()
+                            if value not in found_target_values and not self.has_null_component(value)
+                            for fid in fids]
+            try:
+                deleted_features_count = writer.delete(missing_fids)
+            except QgsEditError as e:
+                self.report_write_error(target, writer, key_index_cache, e, appended_count, feedback)
+                return results
+
+        duplicate_features_count = len(duplicate_features_set)
+        if only_write_changes and action_on_duplicate == self.UPDATE_EXISTING_FEATURE:
+            # Features with changes only in their geometries were updated as well
+            updated_features_count = duplicate_features_count - unchanged_features_count
+        if match_in_database and not feedback.isCanceled():
+            try:
+                counts = writer.merge(action_on_duplicate == self.UPDATE_EXISTING_FEATURE,
+                                      action_on_duplicate in (self.UPDATE_EXISTING_FEATURE, self.UPDATE_EXISTING_GEOMETRY) and
+                                      any(load_source.geometry_plan.has_geometries() for load_source in sources),
+                                      only_write_changes,
+                                      delete_missing)
+            except QgsEditError as e:
+                self.report_write_error(target, writer, key_index_cache, e, appended_count, feedback)
+                return results
+
+            appended_count = counts['appended']
+            skipped_features_count = counts['skipped']
+            duplicate_features_count = counts['matched']
+            if action_on_duplicate == self.UPDATE_EXISTING_FEATURE:
+                updated_features_count = counts['updated']
+            elif action_on_duplicate == self.UPDATE_EXISTING_GEOMETRY:
+                updated_geometries_count = counts['updated']
+            unchanged_features_count = counts['unchanged']
+            deleted_features_count = counts['deleted']
+
+        writer.finish()
+        if key_index_cache:
+            key_index_cache.stop_tracking_commits()
+            key_index_cache.update()
+
+        # Only advance watermarks once all source features read in this run were committed
+        if not feedback.isCanceled() and not not_appended_count:
+            for load_source in sources:
+                if not load_source.watermark:
+                    continue
+
+                new_watermark = load_source.watermark.save()
+                if new_watermark is not None:
+                    feedback.pushInfo("\nWATERMARK: The next run will only read features from '{}' with {}.".format(
+                        load_source.name,
+                        load_source.watermark.filter_expression(new_watermark)))
+
+        if len(sources) > 1:
+            feedback.pushInfo("\nSOURCE LAYERS: {} source layers were read in a single run.".format(len(sources)))
+            for load_source in sources:
+                if match_in_database:  # Duplicates were found by the database, for all staged features at once
+                    feedback.pushInfo("  '{}': {} features read.".format(load_source.name, load_source.read_count))
+                else:
+                    feedback.pushInfo("  '{}': {} features read, {} appended, {} duplicates found.".format(
+                        load_source.name,
+                        load_source.read_count,
+                        load_source.appended_count,
+                        load_source.duplicate_count
+                    ))
+
         if action_on_duplicate == self.SKIP_FEATURE:
             feedback.pushInfo("\nSKIPPED FEATURES: {} duplicate features were skipped while copying features to '{}'!".format(
                 skipped_features_count,
@@ -363,7 +850,7 @@ class AppendFeaturesToLayer(QgsProcessingAlgorithm):
         if action_on_duplicate == self.UPDATE_EXISTING_FEATURE:
             feedback.pushInfo("\nUPDATED FEATURES: {} out of {} duplicate features were updated while copying features to '{}'!".format(
                 updated_features_count,
-                len(duplicate_features_set),
+                duplicate_features_count,
                 target.name()
             ))
             results[self.UPDATED_FEATURE_COUNT] = updated_features_count
@@ -371,56 +858,170 @@ class AppendFeaturesToLayer(QgsProcessingAlgorithm):
         if action_on_duplicate == self.UPDATE_EXISTING_GEOMETRY:
             feedback.pushInfo("\nUPDATED GEOMETRIES: {} out of {} geometries of duplicate features were updated while copying features to '{}'!".format(
                 updated_geometries_count,
-                len(duplicate_features_set),
+                duplicate_features_count,
                 target.name()
             ))
             results[self.UPDATED_ONLY_GEOMETRY_COUNT] = updated_geometries_count
 
-        if not new_features:
+        if only_write_changes:
+            feedback.pushInfo("\nUNCHANGED FEATURES: {} duplicate features already had source values, so they were not written to '{}'!".format(
+                unchanged_features_count,
+                target.name()
+            ))
+            results[self.UNCHANGED_COUNT] = unchanged_features_count
+
+        # Filtered-out features were never fetched, so just count them from source feature counts
+        filtered_sources = [load_source for load_source in sources
+                            if load_source.filter_expression and load_source.source.featureCount() >= 0]
+        if filtered_sources and not feedback.isCanceled():
+            filtered_features_count = sum(load_source.source.featureCount() - load_source.read_count
+                                          for load_source in filtered_sources)
+            if source_filter_expression and watermark_fields_parameter:
+                filter_description = "didn't match the source filter or weren't newer than the watermark"
+            elif source_filter_expression:
+                filter_description = "didn't match the source filter"
+            else:
+                filter_description = "weren't newer than the watermark"
+            feedback.pushInfo("\nFILTERED FEATURES: {} source features {}, so they were not read!".format(
+                filtered_features_count,
+                filter_description
+            ))
+            results[self.FILTERED_COUNT] = filtered_features_count
+
+        if delete_missing:
+            feedback.pushInfo("\nDELETED FEATURES: {} features not found in source layer were deleted from '{}'!".format(
+                deleted_features_count,
+                target.name()
+            ))
+            results[self.DELETED_COUNT] = deleted_features_count
+
+        if not_converted_count:
+            feedback.reportError("\nWARNING: {} source features were not appended to '{}', since their geometries couldn't be converted to its geometry type (e.g., avoiding intersections split them into several parts, but the layer only stores single-part geometries).".format(
+                not_converted_count,
+                target.name()
+            ))
+
+        if not appended_count and not not_appended_count:
             feedback.pushInfo("\nFINISHED WITHOUT APPENDED FEATURES: There were no features to append to '{}'.".format(
                 target.name() if target.name() else target.source()
             ))
         else:
-            if res_add_features:
+            if appended_count:
                 feedback.pushInfo("\nAPPENDED FEATURES: {} out of {} features from input layer were successfully appended to '{}'!".format(
-                    len(new_features),
-                    source.featureCount(),
+                    appended_count,
+                    source_feature_count,
                     target.name()
                 ))
-                results[self.APPENDED_COUNT] = len(new_features)
-            else: # TODO do we really need this else message below?
+                results[self.APPENDED_COUNT] = appended_count
+
+            if not_appended_count:  # TODO do we really need this message below?
                 feedback.reportError("\nERROR: The {} features from input layer could not be appended to '{}'. Sometimes this might be due to NOT NULL constraints that are not met.".format(
-                    source.featureCount(),
+                    not_appended_count,
                     target.name()
                 ))
 
         results[self.OUTPUT] = target
         return results
 
-    def find_duplicate_value(self, source_value, source_field_type, target_value_dict, target_field_type):
+    def build_mapping(self, source, target, action_on_duplicate):
+        """
+        Define a mapping between source and target layer.
+
+        :return: dict {target field index: source field index}
+        """
+        mapping = dict()
+        for target_idx in target.fields().allAttributesList():
+            # We won't update PKs on UPDATE mode, that would be dangerous (at least most of the times)!
+            if action_on_duplicate == self.UPDATE_EXISTING_FEATURE and target_idx in target.primaryKeyAttributes():
+                continue
+
+            # Check that we don't have an automatic PK.
+            # Note that for non-automatic PKs, PG is giving a nextval(NULL) as default clause (which should be '').
+            if target.dataProvider().defaultValueClause(target_idx) not in ['', 'nextval(NULL)'] and target_idx in target.primaryKeyAttributes():
+                continue  # We won't be able to update automatic PKs, so skip them
+
+            target_field = target.fields().field(target_idx)
+
+            if target.dataProvider().storageType() == 'GPKG' and target_field.name() == 'fid':
+                continue  # We won't be able to update a GPKG FID, so skip it.
+
+            source_idx = source.fields().indexOf(target_field.name())
+            if source_idx != -1:
+                mapping[target_idx] = source_idx
+
+        return mapping
+
+    @staticmethod
+    def merge_updates(change_detector, updated_features, updated_geometries, pending_features, pending_geometries):
+        """
+        Move updates from a source layer to the updates to write in the current batch. Later updates of a target
+        feature replace earlier ones.
+
+        :param change_detector: ChangeDetector of the source layer, to only keep actual changes, or None
+        :return: Number of target features without changes
+        """
+        unchanged_count = 0
+        if change_detector:
+            for fid in set(updated_features) | set(updated_geometries):
+                pending_features.pop(fid, None)
+                pending_geometries.pop(fid, None)
+
+            updated_features, updated_geometries, unchanged_count = change_detector.changes(updated_features,
+                                                                                            updated_geometries)
+
+        pending_features.update(updated_features)
+        pending_geometries.update(updated_geometries)
+        return unchanged_count
+
+    def report_write_error(self, target, writer, key_index_cache, error, appended_count, feedback):
+        writer.rollback()
+
+        if key_index_cache:
+            key_index_cache.stop_tracking_commits()
+            key_index_cache.invalidate()
+
+        feedback.reportError("\nERROR: No features could be appended/updated to/in '{}', because of the following error:\n{}\n".format(
+            target.name(),
+            repr(error)
+        ))
+        if appended_count:
+            feedback.reportError("\nNOTE: {} features had already been appended to '{}' by previous batches.".format(
+                appended_count,
+                target.name()
+            ))
+
+    @staticmethod
+    def has_null_component(value):
+        """
+        Target features whose values to compare are (partially) NULL cannot be told apart, so they are never deleted.
+
+        :param value: key (see make_key()) from the target layer
+        """
+        if isinstance(value, tuple):
+            return None in value
+
+        return is_null(value)
+
+    def find_duplicate_value(self, source_value, target_value_dict, convert_key=None):
         """
         Check if source_value is in target layer. First, as is, and if necessary as a converted value.
 
-        :param source_value: single value from the source layer
-        :param source_field_type: QVariant.Type
+        :param source_value: key (see make_key()) from the source layer
         :param target_value_dict: dict of unique values in the target layer. We only use keys in this function.
-        :param target_field_type: QVariant.Type
+        :param convert_key: Function that converts source keys to the target field types (see get_key_converter()),
+                            or None if source and target field types match
         :return: Whether the source_value is duplicated in the target layer and, if so, also the target value
         """
         # Direct comparison
-        if source_field_type == target_field_type:
+        if convert_key is None:
             if source_value in target_value_dict:
                 return True, source_value
             else:
                 return False, None
 
         # We first need to convert types before comparing...
-        qvariant_value = QVariant(source_value)
-        res_can_convert = qvariant_value.canConvert(target_field_type)
-        if res_can_convert:
-            res_convert = qvariant_value.convert(target_field_type)
-            if res_convert:
-                if qvariant_value.value() in target_value_dict:
-                    return True, qvariant_value.value()
+        converted_value = convert_key(source_value)
+        if converted_value is not None and converted_value in target_value_dict:
+            return True, converted_value
 
         return False, None
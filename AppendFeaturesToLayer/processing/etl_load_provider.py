@@ -19,6 +19,7 @@
 from qgis.core import QgsProcessingProvider
 from processing.core.ProcessingConfig import Setting, ProcessingConfig
 from AppendFeaturesToLayer.processing.algs.AppendFeaturesToLayer import AppendFeaturesToLayer
+from AppendFeaturesToLayer.processing.algs.AppendFeaturesFromLayersToLayer import AppendFeaturesFromLayersToLayer
 
 
 class ETLLoadAlgorithmProvider(QgsProcessingProvider):
@@ -80,5 +81,5 @@ class ETLLoadAlgorithmProvider(QgsProcessingProvider):
         even if the list does not change, since the self.algs list is
         cleared before calling this method.
         """
-        for alg in [AppendFeaturesToLayer()]:
+        for alg in [AppendFeaturesToLayer(), AppendFeaturesFromLayersToLayer()]:
             self.addAlgorithm(alg)
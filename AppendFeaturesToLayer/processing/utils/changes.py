@@ -0,0 +1,116 @@
+"""
+/***************************************************************************
+                           Append Features to Layer
+                             --------------------
+        begin                : 2018-04-09
+        git sha              : :%H$
+        copyright            : (C) 2018 by Germán Carrillo (BSF Swissphoto)
+        email                : gcarrillo@linuxmail.org
+ ***************************************************************************/
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License v3.0 as          *
+ *   published by the Free Software Foundation.                            *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from qgis.core import (QgsFeatureRequest,
+                       QgsWkbTypes)
+
+from AppendFeaturesToLayer.processing.utils.converters import get_converter
+from AppendFeaturesToLayer.processing.utils.key_index import is_null
+from AppendFeaturesToLayer.processing.utils.writers import match_dimensions
+
+
+class ChangeDetector:
+    """
+    Compare values to update with the current values of target features, so that only features and fields that
+    actually change are written.
+
+    Target features are read in batches of ids, only with the fields (and geometries) to compare. Source values
+    are converted to target field types (see get_converter()) before comparing them.
+    """
+    BATCH_SIZE = 1000
+
+    def __init__(self, target, source_fields, mapping):
+        """
+        :param target: Target QgsVectorLayer
+        :param source_fields: QgsFields of the source layer
+        :param mapping: dict {target field index: source field index}
+        """
+        self.target = target
+        target_fields = target.fields()
+        self.converters = {target_idx: get_converter(source_fields.at(source_idx).type(),
+                                                     target_fields.at(target_idx).type())
+                           for target_idx, source_idx in mapping.items()}
+        self.has_z = QgsWkbTypes.hasZ(target.wkbType())
+        self.has_m = QgsWkbTypes.hasM(target.wkbType())
+
+    def changes(self, updated_features, updated_geometries):
+        """
+        :param updated_features: dict {fid: {field index: value}} of attributes to change
+        :param updated_geometries: dict {fid: QgsGeometry} of geometries to change
+        :return: Tuple (dict {fid: {field index: value}} of attributes that actually change, dict {fid: QgsGeometry}
+                 of geometries that actually change, number of target features without changes)
+        """
+        changed_features = dict()
+        changed_geometries = dict()
+        unchanged_count = 0
+
+        fids = list(set(updated_features) | set(updated_geometries))
+        field_idxs = sorted({idx for attrs in updated_features.values() for idx in attrs})
+        found_fids = set()
+        for i in range(0, len(fids), self.BATCH_SIZE):
+            request = QgsFeatureRequest().setFilterFids(fids[i:i + self.BATCH_SIZE])
+            request.setSubsetOfAttributes(field_idxs)
+            if not updated_geometries:
+                request.setFlags(QgsFeatureRequest.NoGeometry)
+
+            for target_feature in self.target.getFeatures(request):
+                fid = target_feature.id()
+                found_fids.add(fid)
+                changed = False
+
+                if fid in updated_features:
+                    attrs = {idx: value for idx, value in updated_features[fid].items()
+                             if self._is_changed(idx, value, target_feature.attribute(idx))}
+                    if attrs:
+                        changed_features[fid] = attrs
+                        changed = True
+
+                if fid in updated_geometries:
+                    geometry = updated_geometries[fid]
+                    if not self._is_same_geometry(geometry, target_feature.geometry()):
+                        changed_geometries[fid] = geometry
+                        changed = True
+
+                if not changed:
+                    unchanged_count += 1
+
+        # Features that couldn't be read are left to the writer
+        for fid in set(fids) - found_fids:
+            if fid in updated_features:
+                changed_features[fid] = updated_features[fid]
+            if fid in updated_geometries:
+                changed_geometries[fid] = updated_geometries[fid]
+
+        return changed_features, changed_geometries, unchanged_count
+
+    def _is_changed(self, idx, value, target_value):
+        if is_null(value) or is_null(target_value):
+            return is_null(value) != is_null(target_value)
+
+        converter = self.converters.get(idx)
+        if converter is not None:
+            value = converter(value)
+            if value is None:
+                return True  # Let the writer deal with it
+
+        return value != target_value
+
+    def _is_same_geometry(self, geometry, target_geometry):
+        if geometry.isNull() or target_geometry.isNull():
+            return geometry.isNull() and target_geometry.isNull()
+
+        return match_dimensions(geometry, self.has_z, self.has_m).equals(target_geometry)
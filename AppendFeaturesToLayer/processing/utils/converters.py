@@ -0,0 +1,164 @@
+"""
+/***************************************************************************
+                           Append Features to Layer
+                             --------------------
+        begin                : 2018-04-09
+        git sha              : :%H$
+        copyright            : (C) 2018 by Germán Carrillo (BSF Swissphoto)
+        email                : gcarrillo@linuxmail.org
+ ***************************************************************************/
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License v3.0 as          *
+ *   published by the Free Software Foundation.                            *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import math
+import re
+
+from qgis.PyQt.QtCore import (Qt,
+                              QDate,
+                              QVariant)
+
+from AppendFeaturesToLayer.processing.utils.key_index import is_null
+
+INT_TYPES = (QVariant.Int, QVariant.LongLong)
+INT_RANGE = {QVariant.Int: (-2 ** 31, 2 ** 31 - 1),
+             QVariant.LongLong: (-2 ** 63, 2 ** 63 - 1)}
+
+# Unlike int() and float(), QString::toInt() and QString::toDouble() only accept ASCII digits (e.g., no digit
+# separators, no full-width digits) and no 'infinity'
+INT_PATTERN = re.compile(r'^\s*[+-]?\d+\s*$', re.ASCII)
+DOUBLE_PATTERN = re.compile(r'^\s*[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?\s*$', re.ASCII)
+
+
+def convert_with_qvariant(value, target_type):
+    """
+    Convert a value to the target type via QVariant, which covers any pair of types QVariant can convert.
+
+    :return: The converted value, or None if it cannot be converted
+    """
+    qvariant_value = QVariant(value)
+    if qvariant_value.canConvert(target_type) and qvariant_value.convert(target_type):
+        return qvariant_value.value()
+
+    return None
+
+
+def _int_converter(target_type):
+    min_value, max_value = INT_RANGE[target_type]
+
+    def convert(value):
+        return value if min_value <= value <= max_value else None
+
+    return convert
+
+
+def _string_to_int_converter(target_type):
+    to_int = _int_converter(target_type)
+
+    def convert(value):
+        if not INT_PATTERN.match(value):
+            return None
+
+        return to_int(int(value))
+
+    return convert
+
+
+def _double_to_int_converter(target_type):
+    to_int = _int_converter(target_type)
+
+    def convert(value):
+        if value != value or value in (float('inf'), float('-inf')):
+            return None
+        return to_int(math.floor(value + 0.5))  # Just like qRound(), halves are rounded up
+
+    return convert
+
+
+def _string_to_double(value):
+    return float(value) if DOUBLE_PATTERN.match(value) else None
+
+
+def _string_to_date(value):
+    date = QDate.fromString(value, Qt.ISODate)
+    return date if date.isValid() else None
+
+
+def _date_to_string(value):
+    return value.toString(Qt.ISODate)
+
+
+def get_converter(source_type, target_type):
+    """
+    Resolve, once per run, how to convert values from a source field type to a target field type.
+
+    Common pairs get a plain Python function that gives the same results as QVariant's conversion, so that
+    source values don't need to go through QVariant for each row. Other pairs fall back to QVariant.
+
+    :param source_type: QVariant.Type
+    :param target_type: QVariant.Type
+    :return: Function that takes a non-NULL source value and returns the converted value, or None if it cannot be
+             converted
+    """
+    if source_type == target_type:
+        return lambda value: value
+
+    if source_type in INT_TYPES and target_type in INT_TYPES:
+        return _int_converter(target_type)
+    if source_type in INT_TYPES and target_type == QVariant.String:
+        return str
+    if source_type in INT_TYPES and target_type == QVariant.Double:
+        return float
+    if source_type == QVariant.String and target_type in INT_TYPES:
+        return _string_to_int_converter(target_type)
+    if source_type == QVariant.String and target_type == QVariant.Double:
+        return _string_to_double
+    if source_type == QVariant.Double and target_type in INT_TYPES:
+        return _double_to_int_converter(target_type)
+    if source_type == QVariant.Date and target_type == QVariant.String:
+        return _date_to_string
+    if source_type == QVariant.String and target_type == QVariant.Date:
+        return _string_to_date
+
+    return lambda value: convert_with_qvariant(value, target_type)
+
+
+def get_key_converter(source_types, target_types):
+    """
+    Resolve, once per run, how to convert source keys (see make_key()) to the target field types.
+
+    :param source_types: list of QVariant.Type, one per key field
+    :param target_types: list of QVariant.Type, one per key field
+    :return: Function that takes a source key and returns the converted key, or None if it cannot be converted
+    """
+    if source_types == target_types:
+        return lambda key: key
+
+    converters = [get_converter(source_type, target_type) for source_type, target_type in zip(source_types, target_types)]
+    if len(converters) == 1:
+        convert_value = converters[0]
+
+        def convert(key):
+            return None if is_null(key) else convert_value(key)
+
+        return convert
+
+    def convert_composite(key):
+        converted_key = list()
+        for value, convert_value in zip(key, converters):
+            if value is None:  # NULL component
+                converted_key.append(None)
+                continue
+
+            converted_value = convert_value(value)
+            if converted_value is None:
+                return None
+            converted_key.append(converted_value)
+
+        return tuple(converted_key)
+
+    return convert_composite
@@ -0,0 +1,271 @@
+"""
+/***************************************************************************
+                           Append Features to Layer
+                             --------------------
+        begin                : 2018-04-09
+        git sha              : :%H$
+        copyright            : (C) 2018 by Germán Carrillo (BSF Swissphoto)
+        email                : gcarrillo@linuxmail.org
+ ***************************************************************************/
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License v3.0 as          *
+ *   published by the Free Software Foundation.                            *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from qgis.core import (QgsFeatureRequest,
+                       QgsGeometry,
+                       QgsSpatialIndex,
+                       QgsWkbTypes)
+
+
+class GeometryConversionPlan:
+    """
+    How to convert source geometries to match the target layer, resolved once per run from source and target
+    WKB types, so that each geometry only goes through the steps it needs.
+
+    Geometries whose type differs from the one declared by the source layer (e.g., multi-part geometries in
+    a single-part layer) go through a generic conversion.
+    """
+    NO_GEOMETRY = 'no geometry'  # Either layer is not spatial, features are written without geometry
+    IDENTITY = 'identity'
+    PROMOTE_TO_MULTI = 'promote to multi-part'
+    GENERIC = 'generic conversion'
+    UNSUPPORTED = 'unsupported'
+
+    def __init__(self, source_wkb_type, target_wkb_type):
+        self.source_wkb_type = source_wkb_type
+        self.target_wkb_type = target_wkb_type
+        self.target_geometry_type = QgsWkbTypes.geometryType(target_wkb_type)
+        self.target_is_multi = QgsWkbTypes.isMultiType(target_wkb_type)
+
+        source_geometry_type = QgsWkbTypes.geometryType(source_wkb_type)
+        target_is_known = self.target_geometry_type != QgsWkbTypes.UnknownGeometry
+        self.drop_z = target_is_known and QgsWkbTypes.hasZ(source_wkb_type) and not QgsWkbTypes.hasZ(target_wkb_type)
+        self.drop_m = target_is_known and QgsWkbTypes.hasM(source_wkb_type) and not QgsWkbTypes.hasM(target_wkb_type)
+
+        if QgsWkbTypes.NullGeometry in (source_geometry_type, self.target_geometry_type):
+            self.kind = self.NO_GEOMETRY
+        elif not target_is_known:
+            self.kind = self.IDENTITY  # The target layer accepts any geometry type
+        elif source_geometry_type == QgsWkbTypes.UnknownGeometry:
+            self.kind = self.GENERIC
+        elif source_geometry_type == self.target_geometry_type:
+            source_is_multi = QgsWkbTypes.isMultiType(source_wkb_type)
+            if source_is_multi == self.target_is_multi:
+                self.kind = self.IDENTITY
+            elif self.target_is_multi:
+                self.kind = self.PROMOTE_TO_MULTI
+            else:
+                self.kind = self.GENERIC
+        elif source_geometry_type == QgsWkbTypes.PointGeometry and not QgsWkbTypes.isMultiType(source_wkb_type):
+            self.kind = self.UNSUPPORTED  # Lines and polygons can only be built from multi-points
+        elif self.target_geometry_type == QgsWkbTypes.PointGeometry and not self.target_is_multi:
+            self.kind = self.UNSUPPORTED  # Lines and polygons can only be converted to multi-points
+        else:
+            self.kind = self.GENERIC
+
+    def has_geometries(self):
+        return self.kind != self.NO_GEOMETRY
+
+    def is_supported(self):
+        return self.kind != self.UNSUPPORTED
+
+    def accepts_multi(self):
+        return self.target_is_multi or self.target_geometry_type == QgsWkbTypes.UnknownGeometry
+
+    def describe(self):
+        steps = [self.kind]
+        if self.drop_z:
+            steps.append('drop Z')
+        if self.drop_m:
+            steps.append('drop M')
+
+        return "{} to {}: {}".format(QgsWkbTypes.displayString(self.source_wkb_type),
+                                     QgsWkbTypes.displayString(self.target_wkb_type),
+                                     ", ".join(steps))
+
+    def convert(self, geometry):
+        """
+        :param geometry: Non-null source QgsGeometry (it might be modified)
+        :return: QgsGeometry matching the target layer, or None if it couldn't be converted
+        """
+        kind = self.kind
+        if kind != self.GENERIC and geometry.wkbType() != self.source_wkb_type and self.target_geometry_type != QgsWkbTypes.UnknownGeometry:
+            kind = self.GENERIC  # Not what the source layer declares
+
+        if kind == self.GENERIC:
+            geometry = geometry.convertToType(self.target_geometry_type, self.target_is_multi)
+            if geometry.isNull():
+                return None
+        elif kind == self.PROMOTE_TO_MULTI:
+            geometry.convertToMultiType()
+
+        if self.drop_z and QgsWkbTypes.hasZ(geometry.wkbType()):
+            geometry.get().dropZValue()
+        if self.drop_m and QgsWkbTypes.hasM(geometry.wkbType()):
+            geometry.get().dropMValue()
+
+        return geometry
+
+
+class AvoidIntersections:
+    """
+    Remove from geometries the areas covered by the avoid-intersections layers set in the project's digitizing
+    options, just like QgsGeometry.avoidIntersections() does, but reading those layers only once per run.
+
+    Features of avoid-intersections layers within the source extent are kept in memory with a spatial index, so
+    that each geometry is only compared to the features whose bounding box intersects its own.
+    """
+
+    def __init__(self, layers, extent, feedback):
+        """
+        :param layers: List of QgsVectorLayers to avoid intersections with
+        :param extent: QgsRectangle to read features from, or None to read all of them
+        :param feedback: QgsProcessingFeedback to report stats
+        """
+        start_time = time.time()
+        self.index = QgsSpatialIndex()
+        self.geometries = dict()  # {index id: QgsGeometry}
+
+        for layer in layers:
+            request = QgsFeatureRequest().setNoAttributes()
+            if extent is not None and not extent.isNull():
+                request.setFilterRect(extent)
+
+            for f in layer.getFeatures(request):
+                if feedback.isCanceled():
+                    return
+
+                if not f.hasGeometry():
+                    continue
+
+                index_id = len(self.geometries)
+                self.geometries[index_id] = f.geometry()
+                self.index.addFeature(index_id, f.geometry().boundingBox())
+
+        feedback.pushInfo("\nAVOID INTERSECTIONS: {} features from {} layers were indexed in {:.2f} seconds.".format(
+            len(self.geometries),
+            len(layers),
+            time.time() - start_time
+        ))
+
+    def apply(self, geometry):
+        """
+        :param geometry: Non-null QgsGeometry
+        :return: QgsGeometry without the areas covered by avoid-intersections layers (multi-part if it was split)
+        """
+        if geometry.type() != QgsWkbTypes.PolygonGeometry:
+            return geometry  # Just like QgsGeometry.avoidIntersections(), only polygons are modified
+
+        candidates = self.index.intersects(geometry.boundingBox())
+        if not candidates:
+            return geometry
+
+        engine = QgsGeometry.createGeometryEngine(geometry.constGet())
+        engine.prepareGeometry()
+        others = [self.geometries[index_id] for index_id in candidates
+                  if engine.intersects(self.geometries[index_id].constGet())]
+        if not others:
+            return geometry
+
+        result = geometry.difference(others[0] if len(others) == 1 else QgsGeometry.unaryUnion(others))
+        if result.isNull():
+            return geometry  # Couldn't compute the difference
+
+        # Keep the geometry type whenever possible, several parts can only be kept in a multi-part geometry
+        if QgsWkbTypes.isMultiType(geometry.wkbType()):
+            result.convertToMultiType()
+        elif QgsWkbTypes.isMultiType(result.wkbType()) and result.constGet().numGeometries() == 1:
+            result.convertToSingleType()
+
+        return result
+
+
+def prepare_geometry(geometry, plan, avoid_intersections=None):
+    """
+    Convert a source geometry to match the target layer and avoid intersections, if required.
+
+    :param geometry: Non-null source QgsGeometry
+    :param plan: GeometryConversionPlan
+    :param avoid_intersections: AvoidIntersections or None
+    :return: Prepared QgsGeometry, or None if it couldn't be converted
+    """
+    geometry = plan.convert(geometry)
+    if geometry is not None and avoid_intersections:
+        geometry = avoid_intersections.apply(geometry)
+        if QgsWkbTypes.isMultiType(geometry.wkbType()) and not plan.accepts_multi():
+            return None  # Split into several parts, which a single-part target layer cannot store
+
+    return geometry
+
+
+class ParallelGeometryPreparer:
+    """
+    Prepare source geometries (see prepare_geometry()) in a pool of worker threads, while the caller processes
+    features whose geometries are already prepared.
+
+    Features are read in chunks, each chunk is prepared by one worker, and geometries go back and forth as WKB.
+    Features are yielded in source order, so results don't depend on the number of workers.
+    """
+    CHUNK_SIZE = 500
+
+    def __init__(self, plan, avoid_intersections, workers):
+        self.plan = plan
+        self.avoid_intersections = avoid_intersections
+        self.workers = workers
+
+    def prepare(self, features):
+        """
+        :param features: Iterable of source QgsFeatures
+        :return: Generator of (QgsFeature, prepared QgsGeometry, None if the feature has no geometry, or False if
+                 its geometry couldn't be converted)
+        """
+        features = iter(features)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = deque()  # (chunk, future) in source order
+            while True:
+                chunk = list(islice(features, self.CHUNK_SIZE))
+                if chunk:
+                    wkbs = [bytes(f.geometry().asWkb()) if f.hasGeometry() and not f.geometry().isNull() else None
+                            for f in chunk]
+                    pending.append((chunk, executor.submit(self._prepare_chunk, wkbs)))
+
+                # Keep workers busy, but don't read the source much further than what's consumed
+                while pending and (not chunk or len(pending) > 2 * self.workers):
+                    done_chunk, future = pending.popleft()
+                    for feature, wkb in zip(done_chunk, future.result()):
+                        yield feature, self._to_geometry(wkb)
+
+                if not chunk:
+                    break
+
+    def _prepare_chunk(self, wkbs):
+        prepared = list()
+        for wkb in wkbs:
+            if wkb is None:
+                prepared.append(None)
+                continue
+
+            geometry = QgsGeometry()
+            geometry.fromWkb(wkb)
+            geometry = prepare_geometry(geometry, self.plan, self.avoid_intersections)
+            prepared.append(False if geometry is None else bytes(geometry.asWkb()))
+
+        return prepared
+
+    @staticmethod
+    def _to_geometry(wkb):
+        if not wkb:
+            return wkb  # None or False
+
+        geometry = QgsGeometry()
+        geometry.fromWkb(wkb)
+        return geometry
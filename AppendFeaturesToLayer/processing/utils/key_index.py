@@ -0,0 +1,337 @@
+"""
+/***************************************************************************
+                           Append Features to Layer
+                             --------------------
+        begin                : 2018-04-09
+        git sha              : :%H$
+        copyright            : (C) 2018 by Germán Carrillo (BSF Swissphoto)
+        email                : gcarrillo@linuxmail.org
+ ***************************************************************************/
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License v3.0 as          *
+ *   published by the Free Software Foundation.                            *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import time
+
+from qgis.PyQt.QtCore import QVariant
+from qgis.core import (NULL,
+                       QgsDataSourceUri,
+                       QgsExpression,
+                       QgsFeatureRequest,
+                       QgsProviderConnectionException,
+                       QgsProviderRegistry)
+
+# Providers for which the key index can be built by a single SQL query
+SQL_KEY_INDEX_PROVIDERS = ('postgres', 'ogr', 'spatialite')
+
+# Key field types whose values are returned by SQL exactly as QgsFeatures return them
+SQL_KEY_INDEX_FIELD_TYPES = (QVariant.String, QVariant.Int, QVariant.LongLong)
+
+# Number of key values to look up per request when probing the target layer
+PROBE_BATCH_SIZE = 1000
+
+
+def build_target_key_index(target, target_fields, feedback, filter_expression=None):
+    """
+    Build a dict of target field values so that we can search easily later {value1: [id1, id2], ...}
+
+    If the target provider can run SQL, the index is built server-side by a single query that returns
+    (key, fids) pairs. Otherwise, or if target features are filtered, only the key fields are fetched from
+    the target layer (no geometry, no other attributes), and the filter expression is compiled by the
+    provider whenever it can.
+
+    :param target: QgsVectorLayer to index
+    :param target_fields: Name of the target field to use as key, or list of names for a composite key
+    :param feedback: QgsProcessingFeedback to report progress and stats
+    :param filter_expression: Expression to only index some target features, or None to index all of them
+    :return: dict of unique values (see make_key()) in the target layer and their corresponding feature ids
+    """
+    start_time = time.time()
+    target_value_dict = None
+    method = 'server-side query'
+
+    connection, sql = get_key_index_query(target, target_fields) if not filter_expression else (None, None)
+    if sql:
+        try:
+            target_value_dict = _run_key_index_query(connection, sql, feedback)
+        except (QgsProviderConnectionException, ValueError) as e:
+            feedback.pushInfo("\nKEY INDEX: The key index couldn't be built server-side, falling back to iterating target features. Details: {}".format(e))
+
+    if target_value_dict is None:
+        method = 'feature iteration'
+        target_value_dict = _iterate_key_index(target, target_fields, feedback, filter_expression)
+
+    feedback.pushInfo("\nKEY INDEX: {} target features ({} unique values in '{}') were indexed in {:.2f} seconds ({}).".format(
+        sum(len(fids) for fids in target_value_dict.values()),
+        len(target_value_dict),
+        "', '".join(key_field_list(target_fields)),
+        time.time() - start_time,
+        method
+    ))
+    return target_value_dict
+
+
+def probe_target_key_index(target, target_fields, values, feedback, batch_size=PROBE_BATCH_SIZE, filter_expression=None):
+    """
+    Build a dict of target field values {value1: [id1, id2], ...} only for the given key values.
+
+    Instead of indexing all target features, key values are looked up in batches (IN-list filter
+    expressions, or OR-ed conjunctions for composite keys, that providers can compile to SQL), so
+    that only matching target features are read.
+
+    :param target: QgsVectorLayer to look up
+    :param target_fields: Name of the target field to use as key, or list of names for a composite key
+    :param values: Iterable of key values (already converted to the target field types) to look up
+    :param feedback: QgsProcessingFeedback to report progress and stats
+    :param batch_size: Maximum number of key values per request
+    :param filter_expression: Expression to only look up some target features, or None to look up all of them
+    :return: dict of found values in the target layer and their corresponding feature ids
+    """
+    start_time = time.time()
+    target_value_dict = dict()
+    key_fields = key_field_list(target_fields)
+    field_idxs = [target.fields().indexOf(field) for field in key_fields]
+    column_refs = [QgsExpression.quotedColumnRef(field) for field in key_fields]
+
+    look_up_nulls = False
+    if len(key_fields) == 1:
+        unique_values = set()
+        for value in values:
+            if is_null(value):
+                look_up_nulls = True
+            else:
+                unique_values.add(value)
+        values = list(unique_values)
+
+        expressions = ["{} IN ({})".format(column_refs[0], ', '.join(QgsExpression.quotedValue(value) for value in values[i:i + batch_size]))
+                       for i in range(0, len(values), batch_size)]
+        if look_up_nulls:
+            expressions.append("{} IS NULL".format(column_refs[0]))
+    else:
+        values = list(set(values))
+        conditions = [" AND ".join("{} IS NULL".format(column_ref) if component is None else
+                                   "{} = {}".format(column_ref, QgsExpression.quotedValue(component))
+                                   for column_ref, component in zip(column_refs, value))
+                      for value in values]
+        expressions = [" OR ".join("({})".format(condition) for condition in conditions[i:i + batch_size])
+                       for i in range(0, len(conditions), batch_size)]
+
+    for expression in expressions:
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes(field_idxs)
+        request.setFilterExpression("({}) AND ({})".format(filter_expression, expression) if filter_expression else expression)
+
+        for f in target.getFeatures(request):
+            if feedback.isCanceled():
+                return target_value_dict
+
+            value = make_key([f.attribute(idx) for idx in field_idxs])
+            if value in target_value_dict:
+                target_value_dict[value].append(int(f.id()))
+            else:
+                target_value_dict[value] = [int(f.id())]
+
+    feedback.pushInfo("\nKEY INDEX: {} out of {} source values were found in '{}' ({} target features) in {:.2f} seconds ({} probe requests).".format(
+        len(target_value_dict),
+        len(values) + int(look_up_nulls),
+        "', '".join(key_fields),
+        sum(len(fids) for fids in target_value_dict.values()),
+        time.time() - start_time,
+        len(expressions)
+    ))
+    return target_value_dict
+
+
+def _iterate_key_index(target, target_fields, feedback, filter_expression=None):
+    target_value_dict = dict()
+    field_idxs = [target.fields().indexOf(field) for field in key_field_list(target_fields)]
+
+    request = QgsFeatureRequest()
+    request.setFlags(QgsFeatureRequest.NoGeometry)
+    request.setSubsetOfAttributes(field_idxs)
+    if filter_expression:
+        request.setFilterExpression(filter_expression)
+
+    for f in target.getFeatures(request):
+        if feedback.isCanceled():
+            break
+
+        value = make_key([f.attribute(idx) for idx in field_idxs])
+        if value in target_value_dict:
+            target_value_dict[value].append(int(f.id()))
+        else:
+            target_value_dict[value] = [int(f.id())]
+
+    return target_value_dict
+
+
+def _run_key_index_query(connection, sql, feedback):
+    target_value_dict = dict()
+    for row in connection.executeSql(sql, feedback):
+        key = make_key(row[:-1])
+        if key is None:
+            key = NULL  # Just as QgsFeatures give it to us
+
+        target_value_dict[key] = [int(fid) for fid in str(row[-1]).split(',')]
+
+    return target_value_dict
+
+
+def key_field_list(key_fields):
+    """
+    :param key_fields: Name of the field to use as key, or list of names for a composite key
+    :return: List of key field names
+    """
+    return [key_fields] if isinstance(key_fields, str) else list(key_fields)
+
+
+def make_key(values):
+    """
+    Get the key of the index for the values of the key fields.
+
+    :param values: List of values, one per key field
+    :return: The value itself for single keys. For composite keys, a tuple with None for NULL values, which
+             (unlike QVariant NULLs) can be hashed.
+    """
+    if len(values) == 1:
+        return values[0]
+
+    return tuple(None if is_null(value) else value for value in values)
+
+
+def is_null(value):
+    return value is None or (isinstance(value, QVariant) and value.isNull())
+
+
+def quoted_identifier(identifier):
+    return '"{}"'.format(identifier.replace('"', '""'))
+
+
+def get_sql_table(target):
+    """
+    Get what is needed to query the target layer's table via SQL.
+
+    :return: Tuple (QgsAbstractDatabaseProviderConnection, quoted table name, quoted fid column, subset string)
+             or None if the target cannot be queried via SQL or QGIS' feature ids cannot be obtained from it.
+    """
+    provider_type = target.providerType()
+    if provider_type not in SQL_KEY_INDEX_PROVIDERS:
+        return None
+
+    subset = target.subsetString()
+    if subset.strip().lower().startswith('select'):
+        return None  # OGR SQL layers
+
+    metadata = QgsProviderRegistry.instance().providerMetadata(provider_type)
+    if provider_type == 'ogr':
+        if target.dataProvider().storageType() != 'GPKG':
+            return None
+
+        # GPKG feature tables have an INTEGER PRIMARY KEY, which is an alias of the rowid and QGIS' feature id
+        parts = metadata.decodeUri(target.source())
+        if not parts.get('layerName'):
+            return None
+
+        table = quoted_identifier(parts['layerName'])
+        fid_column = 'rowid'
+        connection_uri = parts['path']
+    else:
+        # QGIS' feature ids match PK values only for single integer PKs
+        fields = target.fields()
+        pk_attrs = target.primaryKeyAttributes()
+        if len(pk_attrs) != 1 or fields.at(pk_attrs[0]).type() not in (QVariant.Int, QVariant.LongLong):
+            return None
+
+        fid_column = quoted_identifier(fields.at(pk_attrs[0]).name())
+        uri = QgsDataSourceUri(target.source())
+        if uri.table().startswith('('):
+            return None  # Query layers
+
+        if provider_type == 'postgres':
+            table = quoted_identifier(uri.table())
+            if uri.schema():
+                table = "{}.{}".format(quoted_identifier(uri.schema()), table)
+            connection_uri = uri.connectionInfo(False)
+        else:  # spatialite
+            table = quoted_identifier(uri.table())
+            connection_uri = QgsDataSourceUri()
+            connection_uri.setDatabase(uri.database())
+            connection_uri = connection_uri.uri()
+
+    try:
+        connection = metadata.createConnection(connection_uri, {})
+    except QgsProviderConnectionException:
+        return None
+
+    return connection, table, fid_column, subset
+
+
+def get_key_index_query(target, target_fields):
+    """
+    Get a provider connection and an SQL query that returns (key1[, key2, ...], 'fid1,fid2,...') rows for the
+    target layer.
+
+    :return: Tuple (QgsAbstractDatabaseProviderConnection, SQL string) or (None, None) if the target
+             doesn't support building the key index server-side.
+    """
+    key_fields = key_field_list(target_fields)
+    if any(target.fields().field(field).type() not in SQL_KEY_INDEX_FIELD_TYPES for field in key_fields):
+        return None, None
+
+    sql_table = get_sql_table(target)
+    if sql_table is None:
+        return None, None
+
+    connection, table, fid_column, subset = sql_table
+    key_columns = ", ".join(quoted_identifier(field) for field in key_fields)
+    where = " WHERE ({})".format(subset) if subset else ""
+    if target.providerType() == 'postgres':
+        aggregate = "string_agg({fid}::text, ',' ORDER BY {fid})".format(fid=fid_column)
+    else:
+        aggregate = "group_concat({})".format(fid_column)
+
+    sql = "SELECT {key}, {aggregate} FROM {table}{where} GROUP BY {key}".format(key=key_columns,
+                                                                                 aggregate=aggregate,
+                                                                                 table=table,
+                                                                                 where=where)
+    return connection, sql
+
+
+def get_target_signature(target):
+    """
+    Get a cheap signature of the target layer's contents, to detect whether features were added or deleted.
+
+    :return: Tuple (feature count, max feature id) or None if it cannot be obtained cheaply.
+    """
+    sql_table = get_sql_table(target)
+    if sql_table is not None:
+        connection, table, fid_column, subset = sql_table
+        where = " WHERE ({})".format(subset) if subset else ""
+        try:
+            res = connection.executeSql("SELECT count(*), max({}) FROM {}{}".format(fid_column, table, where))
+            count, max_fid = res[0]
+            return int(count), int(max_fid) if max_fid is not None else -1
+        except (QgsProviderConnectionException, IndexError, ValueError):
+            pass
+
+    # Single integer PKs are QGIS' feature ids and can be sorted server-side
+    fields = target.fields()
+    pk_attrs = target.primaryKeyAttributes()
+    if len(pk_attrs) != 1 or fields.at(pk_attrs[0]).type() not in (QVariant.Int, QVariant.LongLong):
+        return None
+
+    request = QgsFeatureRequest()
+    request.setFlags(QgsFeatureRequest.NoGeometry)
+    request.setSubsetOfAttributes([pk_attrs[0]])
+    request.addOrderBy(QgsExpression.quotedColumnRef(fields.at(pk_attrs[0]).name()), False)
+    request.setLimit(1)
+    max_fid = -1
+    for f in target.getFeatures(request):
+        max_fid = int(f.id())
+
+    return target.featureCount(), max_fid
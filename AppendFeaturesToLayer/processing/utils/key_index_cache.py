@@ -0,0 +1,254 @@
+"""
+/***************************************************************************
+                           Append Features to Layer
+                             --------------------
+        begin                : 2018-04-09
+        git sha              : :%H$
+        copyright            : (C) 2018 by Germán Carrillo (BSF Swissphoto)
+        email                : gcarrillo@linuxmail.org
+ ***************************************************************************/
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License v3.0 as          *
+ *   published by the Free Software Foundation.                            *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import hashlib
+import json
+import os.path
+import sqlite3
+import time
+
+from qgis.core import (NULL,
+                       QgsApplication)
+
+from AppendFeaturesToLayer.processing.utils.key_index import (SQL_KEY_INDEX_FIELD_TYPES,
+                                                              get_target_signature,
+                                                              is_null,
+                                                              key_field_list,
+                                                              make_key)
+
+
+def get_cache_dir():
+    return os.path.join(QgsApplication.qgisSettingsDirPath(), 'append_features_to_layer')
+
+
+class KeyIndexCache:
+    """
+    Persist target key indexes ({value1: [id1, id2], ...}) in a SQLite file, so that subsequent runs
+    against the same target layer and key field don't need to read the whole target layer.
+
+    A cached index is only used if the target's signature (feature count and max feature id) hasn't
+    changed since it was stored. After a run commits, the cached index is updated with the features
+    that were added, deleted or whose key value changed, unless these changes don't explain the new
+    signature (e.g., other applications added or deleted features meanwhile), in which case the cached
+    index is dropped. Note that key values modified by other applications are not detected by the signature.
+    """
+
+    def __init__(self, target, key_fields, path=None):
+        """
+        :param key_fields: Name of the target field to use as key, or list of names for a composite key
+        """
+        self.target = target
+        self.key_fields = key_field_list(key_fields)
+        self.key_field_idxs = [target.fields().indexOf(field) for field in self.key_fields]
+        self.path = path or os.path.join(get_cache_dir(), 'key_index_cache.sqlite')
+        # Don't store the source itself, it might contain credentials
+        self.cache_key = hashlib.sha256("{}|{}|{}".format(target.providerType(),
+                                                         target.source(),
+                                                         ",".join(self.key_fields)).encode('utf-8')).hexdigest()
+
+        self.signature = None
+        if all(target.fields().at(idx).type() in SQL_KEY_INDEX_FIELD_TYPES for idx in self.key_field_idxs):
+            self.signature = get_target_signature(target)
+
+        self._committed_keys = dict()  # {fid: key value} for target features added or changed by a commit
+        self._added_fids = set()
+        self._deleted_fids = set()
+        self._stale = False  # Whether committed changes cannot be applied to the cached index
+
+    def is_supported(self):
+        return self.signature is not None
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path)
+        conn.execute("""CREATE TABLE IF NOT EXISTS key_index_cache(
+                            cache_key TEXT PRIMARY KEY,
+                            feature_count INTEGER,
+                            max_fid INTEGER,
+                            updated_at REAL)""")
+        conn.execute("""CREATE TABLE IF NOT EXISTS key_index(
+                            cache_key TEXT,
+                            fid INTEGER,
+                            key_value TEXT,
+                            PRIMARY KEY (cache_key, fid)) WITHOUT ROWID""")
+        return conn
+
+    def load(self):
+        """
+        :return: The cached key index, or None if there is no valid cached index for the target layer.
+        """
+        if not self.is_supported() or not os.path.exists(self.path):
+            return None
+
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT feature_count, max_fid FROM key_index_cache WHERE cache_key = ?",
+                               (self.cache_key,)).fetchone()
+            if row is None or tuple(row) != tuple(self.signature):
+                return None
+
+            target_value_dict = dict()
+            for key_value, fid in conn.execute("SELECT key_value, fid FROM key_index WHERE cache_key = ?",
+                                               (self.cache_key,)):
+                key = json.loads(key_value)
+                if isinstance(key, list):
+                    key = tuple(key)  # Composite key
+                elif key is None:
+                    key = NULL  # Just as QgsFeatures give it to us
+
+                if key in target_value_dict:
+                    target_value_dict[key].append(fid)
+                else:
+                    target_value_dict[key] = [fid]
+
+            return target_value_dict
+        finally:
+            conn.close()
+
+    def save(self, target_value_dict):
+        if not self.is_supported():
+            return
+
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM key_index WHERE cache_key = ?", (self.cache_key,))
+                conn.executemany("INSERT INTO key_index (cache_key, fid, key_value) VALUES (?, ?, ?)",
+                                 ((self.cache_key, fid, self._dump_key(key))
+                                  for key, fids in target_value_dict.items() for fid in fids))
+                self._save_signature(conn)
+        finally:
+            conn.close()
+
+    def invalidate(self):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM key_index WHERE cache_key = ?", (self.cache_key,))
+                conn.execute("DELETE FROM key_index_cache WHERE cache_key = ?", (self.cache_key,))
+        finally:
+            conn.close()
+
+    def track_commits(self):
+        """
+        Keep track of target features added, changed or deleted when the target layer's edits are committed.
+        """
+        self.target.committedFeaturesAdded.connect(self._features_added)
+        self.target.committedAttributeValuesChanges.connect(self._attribute_values_changed)
+        self.target.committedFeaturesRemoved.connect(self._features_removed)
+
+    def stop_tracking_commits(self):
+        self.target.committedFeaturesAdded.disconnect(self._features_added)
+        self.target.committedAttributeValuesChanges.disconnect(self._attribute_values_changed)
+        self.target.committedFeaturesRemoved.disconnect(self._features_removed)
+
+    def _features_added(self, layer_id, features):
+        self.add_committed_changes({int(f.id()): self.feature_key(f) for f in features})
+
+    def _attribute_values_changed(self, layer_id, changed_attribute_values):
+        self.add_changed_attributes(changed_attribute_values)
+
+    def _features_removed(self, layer_id, fids):
+        self._deleted_fids.update(int(fid) for fid in fids)
+
+    def feature_key(self, feature):
+        return make_key([feature.attribute(idx) for idx in self.key_field_idxs])
+
+    def add_changed_attributes(self, changed_attribute_values):
+        """
+        Register attribute changes committed to the target layer without going through its edit buffer.
+
+        :param changed_attribute_values: dict {fid: {field index: value}}
+        """
+        for fid, attrs in changed_attribute_values.items():
+            values = [attrs[idx] for idx in self.key_field_idxs if idx in attrs]
+            if not values:
+                continue
+
+            if len(values) < len(self.key_field_idxs):
+                self._stale = True  # Only some components of a composite key changed, the new key is unknown
+            else:
+                self._committed_keys[int(fid)] = make_key(values)
+
+    def add_committed_changes(self, added_keys=None, deleted_fids=None):
+        """
+        Register changes committed to the target layer without going through its edit buffer.
+
+        :param added_keys: dict {fid: key value} of added target features
+        :param deleted_fids: iterable of deleted target feature ids
+        """
+        self._committed_keys.update(added_keys or dict())
+        self._added_fids.update(added_keys or dict())
+        self._deleted_fids.update(deleted_fids or list())
+
+    def _explains(self, signature):
+        """
+        :return: Whether registered additions and deletions explain the change from the cached signature to the
+                 given one
+        """
+        added_fids = self._added_fids - self._deleted_fids
+        deleted_fids = self._deleted_fids - self._added_fids
+        count, max_fid = self.signature
+        max_fid = max([max_fid] + list(added_fids))
+        if signature[0] != count + len(added_fids) - len(deleted_fids):
+            return False
+
+        # If the highest feature id was deleted, the new one is only known to be lower
+        return signature[1] == max_fid or (max_fid in self._deleted_fids and signature[1] < max_fid)
+
+    def update(self):
+        """
+        Incrementally update the cached index with committed changes, and store the target's new signature.
+        """
+        if not self.is_supported():
+            return
+
+        signature = get_target_signature(self.target)
+        stale = signature is None or self._stale or not self._explains(signature)
+        self.signature = signature
+        if stale:
+            self.invalidate()
+            self._reset_changes()
+            return
+
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany("DELETE FROM key_index WHERE cache_key = ? AND fid = ?",
+                                 ((self.cache_key, fid) for fid in self._deleted_fids))
+                conn.executemany("INSERT OR REPLACE INTO key_index (cache_key, fid, key_value) VALUES (?, ?, ?)",
+                                 ((self.cache_key, fid, self._dump_key(key))
+                                  for fid, key in self._committed_keys.items() if fid not in self._deleted_fids))
+                self._save_signature(conn)
+        finally:
+            conn.close()
+
+        self._reset_changes()
+
+    def _reset_changes(self):
+        self._committed_keys = dict()
+        self._added_fids = set()
+        self._deleted_fids = set()
+        self._stale = False
+
+    def _save_signature(self, conn):
+        conn.execute("INSERT OR REPLACE INTO key_index_cache (cache_key, feature_count, max_fid, updated_at) VALUES (?, ?, ?, ?)",
+                     (self.cache_key, self.signature[0], self.signature[1], time.time()))
+
+    @staticmethod
+    def _dump_key(key):
+        return json.dumps(None if is_null(key) else key)
@@ -0,0 +1,68 @@
+"""
+/***************************************************************************
+                           Append Features to Layer
+                             --------------------
+        begin                : 2018-04-09
+        git sha              : :%H$
+        copyright            : (C) 2018 by Germán Carrillo (BSF Swissphoto)
+        email                : gcarrillo@linuxmail.org
+ ***************************************************************************/
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License v3.0 as          *
+ *   published by the Free Software Foundation.                            *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from operator import itemgetter
+
+from qgis.core import NULL
+
+
+def _tuple_getter(positions):
+    """
+    :return: Function that takes a list and returns a tuple with the items at the given positions
+    """
+    if not positions:
+        return lambda row: ()
+    if len(positions) == 1:
+        position = positions[0]
+        return lambda row: (row[position],)
+
+    return itemgetter(*positions)
+
+
+class AttributeTransformer:
+    """
+    Field mapping between source and target layers compiled once per run, so that target attributes are taken
+    from source attributes (i.e., QgsFeature.attributes()) by position, instead of looking up fields per row.
+    """
+
+    def __init__(self, mapping, source_field_count, target_field_count):
+        """
+        :param mapping: dict {target field index: source field index}
+        :param source_field_count: Number of fields in the source layer
+        :param target_field_count: Number of fields in the target layer
+        """
+        self.target_idxs = tuple(sorted(mapping))
+        self.mapped_values = _tuple_getter([mapping[idx] for idx in self.target_idxs])
+
+        # Unmapped target fields take the item appended to source attributes, i.e., NULL
+        self.target_attributes_getter = _tuple_getter([mapping.get(idx, source_field_count)
+                                                       for idx in range(target_field_count)])
+
+    def update_map(self, source_attributes):
+        """
+        :param source_attributes: List of source feature attributes
+        :return: dict {target field index: value} of mapped fields, as expected by changeAttributeValues()
+        """
+        return dict(zip(self.target_idxs, self.mapped_values(source_attributes)))
+
+    def target_attributes(self, source_attributes):
+        """
+        :param source_attributes: List of source feature attributes (it gets an extra item)
+        :return: List of target feature attributes, NULL for unmapped fields
+        """
+        source_attributes.append(NULL)
+        return list(self.target_attributes_getter(source_attributes))
@@ -0,0 +1,104 @@
+"""
+/***************************************************************************
+                           Append Features to Layer
+                             --------------------
+        begin                : 2018-04-09
+        git sha              : :%H$
+        copyright            : (C) 2018 by Germán Carrillo (BSF Swissphoto)
+        email                : gcarrillo@linuxmail.org
+ ***************************************************************************/
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License v3.0 as          *
+ *   published by the Free Software Foundation.                            *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from qgis.core import QgsFeatureRequest
+
+from AppendFeaturesToLayer.processing.utils.key_index import make_key
+
+
+class LoadSource:
+    """
+    A source layer to append to the target layer, with everything that is resolved once per run for it (fields to
+    compare, field mapping, geometry conversion, filter, etc.), and its own counts.
+
+    Several source layers can be loaded in the same run, sharing the target index of values and the writer.
+    """
+
+    def __init__(self, source, layer=None):
+        """
+        :param source: QgsProcessingFeatureSource to read features from
+        :param layer: QgsVectorLayer of the source, to identify it across runs (see Watermark), or None
+        """
+        self.source = source
+        self.layer = layer
+        self.name = source.sourceName()
+
+        self.key_idxs = list()  # Source fields to compare
+        self.convert_key = None  # See get_key_converter()
+        self.duplicate_convert_key = None  # None if source and target fields to compare have the same types
+        self.mapping = dict()  # {target field index: source field index}
+        self.transformer = None  # AttributeTransformer
+        self.geometry_plan = None  # GeometryConversionPlan
+        self.change_detector = None  # ChangeDetector, only if just changes are written
+        self.watermark = None
+        self.watermark_idx = -1
+        self.filter_expression = None  # Source filter and watermark, run by the source provider if possible
+        self.expression_context = None
+
+        self.read_count = 0  # Source features that matched the filter (if any)
+        self.duplicate_count = 0  # Source features found in the target layer
+        self.appended_count = 0
+        self.queued_count = 0  # Features to append in the current batch
+
+    def key(self, attributes):
+        """
+        :param attributes: List of source feature attributes
+        :return: key (see make_key()) of the source feature
+        """
+        return make_key([attributes[idx] for idx in self.key_idxs])
+
+    def request(self, copy_geometries):
+        """
+        Only read mapped and key fields from the source, and geometries only if they are copied.
+
+        :return: QgsFeatureRequest
+        """
+        request = QgsFeatureRequest()
+        source_idxs = set(self.mapping.values()) | set(self.key_idxs)
+        if self.watermark:
+            source_idxs.add(self.watermark_idx)
+        request.setSubsetOfAttributes(sorted(source_idxs))
+        if not copy_geometries:
+            request.setFlags(QgsFeatureRequest.NoGeometry)
+        if self.filter_expression:
+            request.setFilterExpression(self.filter_expression)
+            request.setExpressionContext(self.expression_context)
+
+        return request
+
+    def key_request(self):
+        """
+        Only read source keys (no geometry, no other attributes), to look them up in the target layer.
+
+        :return: QgsFeatureRequest
+        """
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes(self.key_idxs)
+        if self.filter_expression:
+            request.setFilterExpression(self.filter_expression)
+            request.setExpressionContext(self.expression_context)
+
+        return request
+
+    def batch_written(self, appended):
+        """
+        :param appended: Whether the features queued in the last batch were appended
+        """
+        if appended:
+            self.appended_count += self.queued_count
+        self.queued_count = 0
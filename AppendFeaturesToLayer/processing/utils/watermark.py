@@ -0,0 +1,118 @@
+"""
+/***************************************************************************
+                           Append Features to Layer
+                             --------------------
+        begin                : 2018-04-09
+        git sha              : :%H$
+        copyright            : (C) 2018 by Germán Carrillo (BSF Swissphoto)
+        email                : gcarrillo@linuxmail.org
+ ***************************************************************************/
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License v3.0 as          *
+ *   published by the Free Software Foundation.                            *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import hashlib
+import os.path
+import sqlite3
+import time
+
+from qgis.PyQt.QtCore import (Qt,
+                              QDate,
+                              QDateTime,
+                              QVariant)
+from qgis.core import QgsExpression
+
+from AppendFeaturesToLayer.processing.utils.key_index import is_null
+from AppendFeaturesToLayer.processing.utils.key_index_cache import get_cache_dir
+
+
+class Watermark:
+    """
+    Persist, per source and target layers, the highest value of a source field (e.g., a modification timestamp)
+    that was successfully loaded, so that subsequent runs only read source features with higher values.
+
+    The watermark is stored as an expression literal, which is used to filter source features on the provider
+    side whenever the provider can compile the expression. It is only advanced by save(), i.e., after changes
+    were committed to the target layer.
+    """
+    FIELD_TYPES = (QVariant.Int, QVariant.LongLong, QVariant.Double, QVariant.String, QVariant.Date, QVariant.DateTime)
+
+    def __init__(self, source_layer, target, field, path=None):
+        """
+        :param source_layer: Source QgsVectorLayer
+        :param target: Target QgsVectorLayer
+        :param field: Name of the source field whose values grow as source features are added or modified
+        """
+        self.field = field
+        self.path = path or os.path.join(get_cache_dir(), 'watermarks.sqlite')
+        self.state_key = hashlib.sha256("{}|{}|{}|{}|{}".format(source_layer.providerType(),
+                                                               source_layer.source(),
+                                                               target.providerType(),
+                                                               target.source(),
+                                                               field).encode('utf-8')).hexdigest()
+        self.value = None  # Highest value read in this run
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path)
+        conn.execute("""CREATE TABLE IF NOT EXISTS watermark(
+                            state_key TEXT PRIMARY KEY,
+                            literal TEXT,
+                            updated_at REAL)""")
+        return conn
+
+    def load(self):
+        """
+        :return: Expression literal of the last committed watermark, or None if there is none
+        """
+        if not os.path.exists(self.path):
+            return None
+
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT literal FROM watermark WHERE state_key = ?", (self.state_key,)).fetchone()
+            return row[0] if row else None
+        finally:
+            conn.close()
+
+    def filter_expression(self, literal):
+        return "{} > {}".format(QgsExpression.quotedColumnRef(self.field), literal)
+
+    def observe(self, value):
+        if not is_null(value) and (self.value is None or value > self.value):
+            self.value = value
+
+    def save(self):
+        """
+        Advance the watermark to the highest value read in this run, if any.
+
+        :return: Expression literal of the stored watermark, or None if there was no value to store
+        """
+        if self.value is None:
+            return None
+
+        literal = self.literal(self.value)
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO watermark (state_key, literal, updated_at) VALUES (?, ?, ?)",
+                             (self.state_key, literal, time.time()))
+        finally:
+            conn.close()
+
+        return literal
+
+    @staticmethod
+    def literal(value):
+        if isinstance(value, QDateTime):
+            return QgsExpression.quotedString(value.toString(Qt.ISODateWithMs))
+        elif isinstance(value, QDate):
+            return QgsExpression.quotedString(value.toString(Qt.ISODate))
+        elif isinstance(value, str):
+            return QgsExpression.quotedString(value)
+
+        return repr(value)  # Numbers
@@ -0,0 +1,904 @@
+"""
+/***************************************************************************
+                           Append Features to Layer
+                             --------------------
+        begin                : 2018-04-09
+        git sha              : :%H$
+        copyright            : (C) 2018 by Germán Carrillo (BSF Swissphoto)
+        email                : gcarrillo@linuxmail.org
+ ***************************************************************************/
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License v3.0 as          *
+ *   published by the Free Software Foundation.                            *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import io
+import json
+import sqlite3
+import struct
+
+from qgis.PyQt.QtCore import (Qt,
+                              QByteArray,
+                              QDate,
+                              QDateTime,
+                              QTime)
+from qgis.core import (edit,
+                       NULL,
+                       QgsDataProvider,
+                       QgsDataSourceUri,
+                       QgsEditError,
+                       QgsFeature,
+                       QgsField,
+                       QgsFieldConstraints,
+                       QgsFields,
+                       QgsGeometry,
+                       QgsProviderRegistry,
+                       QgsVectorLayerUtils,
+                       QgsWkbTypes)
+
+from AppendFeaturesToLayer.processing.utils.key_index import (is_null,
+                                                              key_field_list,
+                                                              quoted_identifier)
+
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+
+def match_dimensions(geometry, has_z, has_m):
+    """
+    Get a copy of the geometry with Z and M values dropped or added (as 0) to match the target's.
+    """
+    geometry = QgsGeometry(geometry)
+    if not has_z and QgsWkbTypes.hasZ(geometry.wkbType()):
+        geometry.get().dropZValue()
+    if not has_m and QgsWkbTypes.hasM(geometry.wkbType()):
+        geometry.get().dropMValue()
+    if has_z and not QgsWkbTypes.hasZ(geometry.wkbType()):
+        geometry.get().addZValue(0)
+    if has_m and not QgsWkbTypes.hasM(geometry.wkbType()):
+        geometry.get().addMValue(0)
+
+    return geometry
+
+
+class FeatureTemplate:
+    """
+    Create features for the target layer just like QgsVectorLayerUtils.createFeature() does, but resolving once
+    which values come from defaults, instead of for each feature.
+
+    Provider default clauses and literals are stored in a list of attributes that is copied for each feature.
+    Features only go through createFeature() if they need values evaluated per feature: default value
+    expressions or provider defaults evaluated client-side for NULL values, and values of fields with unique
+    constraints, which need to be checked against the layer.
+    """
+
+    def __init__(self, target):
+        self.target = target
+        self.fields = target.fields()
+        self.attributes = [NULL] * self.fields.count()
+        self.evaluate_if_null = list()  # Field indexes whose default is evaluated per feature
+        self.evaluate_if_not_null = list()  # Field indexes whose values must be unique or are always evaluated
+
+        provider = target.dataProvider()
+        evaluate_provider_defaults = provider.providerProperty(QgsDataProvider.EvaluateDefaultValues, False)
+        for idx in range(self.fields.count()):
+            has_unique_constraint = bool(self.fields.at(idx).constraints().constraints() & QgsFieldConstraints.ConstraintUnique)
+            if has_unique_constraint:
+                self.evaluate_if_not_null.append(idx)
+
+            default_value_definition = target.defaultValueDefinition(idx)
+            if default_value_definition.isValid():
+                self.evaluate_if_null.append(idx)
+                if default_value_definition.applyOnUpdate() and not has_unique_constraint:
+                    self.evaluate_if_not_null.append(idx)
+                continue
+
+            if self.fields.fieldOrigin(idx) == QgsFields.OriginProvider:
+                provider_idx = self.fields.fieldOriginIndex(idx)
+                default_clause = provider.defaultValueClause(provider_idx)
+                if default_clause:
+                    self.attributes[idx] = default_clause
+                    continue
+
+                if evaluate_provider_defaults:
+                    self.evaluate_if_null.append(idx)
+                    continue
+
+                default_value = provider.defaultValue(provider_idx)
+                if not is_null(default_value):
+                    self.attributes[idx] = default_value
+                    continue
+
+            if has_unique_constraint:
+                self.evaluate_if_null.append(idx)  # A unique value would be created
+
+        self.default_idxs = [idx for idx, value in enumerate(self.attributes) if not is_null(value)]
+
+    def create_feature(self, geometry, attributes):
+        """
+        :param geometry: QgsGeometry
+        :param attributes: List of target attributes, NULL for fields without a value (it might be modified)
+        """
+        if any(not is_null(attributes[idx]) for idx in self.evaluate_if_not_null) or \
+                any(is_null(attributes[idx]) for idx in self.evaluate_if_null):
+            return QgsVectorLayerUtils.createFeature(
+                self.target, geometry, {idx: value for idx, value in enumerate(attributes) if not is_null(value)})
+
+        for idx in self.default_idxs:
+            if is_null(attributes[idx]):
+                attributes[idx] = self.attributes[idx]
+
+        feature = QgsFeature(self.fields)
+        feature.setAttributes(attributes)
+        feature.setGeometry(geometry)
+        return feature
+
+
+class FeatureWriter:
+    """
+    Base class for writing features to the target layer.
+    """
+
+    def __init__(self, target, feedback):
+        self.target = target
+        self.feedback = feedback
+        self.feature_template = None
+
+    def create_feature(self, geometry, attributes, key_value=None):
+        """
+        Create a new feature for the target layer.
+
+        :param geometry: QgsGeometry
+        :param attributes: List of target attributes, NULL for unmapped fields (see AttributeTransformer)
+        :param key_value: Value of the source field to compare, only used by writers that find duplicates themselves
+        """
+        if self.feature_template is None:
+            self.feature_template = FeatureTemplate(self.target)
+
+        return self.feature_template.create_feature(geometry, attributes)
+
+    def write(self, new_features, updated_features, updated_geometries):
+        """
+        Write features to the target layer.
+
+        :param new_features: list of QgsFeatures to add
+        :param updated_features: dict {fid: {field index: value}} of attributes to change
+        :param updated_geometries: dict {fid: QgsGeometry} of geometries to change
+        :return: Tuple (number of features whose attributes were updated, number of features whose geometries
+                 were updated, whether new features were added)
+        :raises QgsEditError: If the changes cannot be committed
+        """
+        raise NotImplementedError
+
+    def delete(self, fids):
+        """
+        Delete features from the target layer, in a single call to its data provider.
+
+        :param fids: list of ids of target features to delete
+        :return: Number of deleted features
+        :raises QgsEditError: If features cannot be deleted
+        """
+        if not fids:
+            return 0
+
+        provider = self.target.dataProvider()
+        provider.clearErrors()
+        if not provider.deleteFeatures(fids):
+            raise QgsEditError("Target features couldn't be deleted: {}".format("\n".join(provider.errors())))
+
+        self.written = True
+        return len(fids)
+
+    def rollback(self):
+        pass
+
+    def finish(self):
+        pass
+
+
+class LayerEditBufferWriter(FeatureWriter):
+    """
+    Write features through the target layer's edit buffer, in an edit session that is committed on each write.
+    """
+
+    def write(self, new_features, updated_features, updated_geometries):
+        updated_features_count = 0
+        updated_geometries_count = 0
+        res_add_features = False
+        if not (new_features or updated_features or updated_geometries):
+            return updated_features_count, updated_geometries_count, res_add_features
+
+        with edit(self.target):
+            self.target.beginEditCommand("Appending/Updating features...")
+
+            if updated_features:
+                for k, v in updated_features.items():
+                    if self.target.changeAttributeValues(k, v):
+                        updated_features_count += 1
+                    else:
+                        self.feedback.reportError("\nERROR: Target feature (id={}) couldn't be updated to the following attributes: {}.".format(k, v))
+
+            if updated_geometries:
+                for k,v in updated_geometries.items():
+                    if self.target.changeGeometry(k, v):
+                        updated_geometries_count += 1
+                    else:
+                        self.feedback.reportError("\nERROR: Target feature's geometry (id={}) couldn't be updated.".format(k))
+
+            if new_features:
+                res_add_features = self.target.addFeatures(new_features)
+
+            self.target.endEditCommand()
+
+        return updated_features_count, updated_geometries_count, res_add_features
+
+    def delete(self, fids):
+        if not fids:
+            return 0
+
+        with edit(self.target):
+            if not self.target.deleteFeatures(fids):
+                raise QgsEditError("Target features couldn't be deleted")
+
+        return len(fids)
+
+    def rollback(self):
+        if self.target.isEditable():
+            # Let's close the edit session to prepare for a next run
+            self.target.rollBack()
+
+
+class DataProviderWriter(FeatureWriter):
+    """
+    Write features directly through the target layer's data provider, in bulk calls that bypass the layer's
+    edit buffer, undo stack and per-feature signals. Each call is committed by the provider itself.
+
+    Since layer signals are not emitted, changes are registered in the key index cache (if any) by the writer.
+    """
+
+    def __init__(self, target, feedback, key_index_cache=None):
+        super().__init__(target, feedback)
+        self.provider = target.dataProvider()
+        self.key_index_cache = key_index_cache
+        self.written = False
+
+    @staticmethod
+    def is_supported(target):
+        # Layer field indexes must be the provider ones, i.e., no joined or virtual fields
+        return target.fields().count() == target.dataProvider().fields().count()
+
+    def write(self, new_features, updated_features, updated_geometries):
+        updated_features_count = 0
+        updated_geometries_count = 0
+        res_add_features = False
+        self.provider.clearErrors()
+
+        if updated_features:
+            if not self.provider.changeAttributeValues(updated_features):
+                self._raise_provider_error("Target features couldn't be updated")
+            updated_features_count = len(updated_features)
+            self.written = True
+
+            if self.key_index_cache:
+                self.key_index_cache.add_changed_attributes(updated_features)
+
+        if updated_geometries:
+            if not self.provider.changeGeometryValues(updated_geometries):
+                self._raise_provider_error("Target feature's geometries couldn't be updated")
+            updated_geometries_count = len(updated_geometries)
+            self.written = True
+
+        if new_features:
+            res_add_features, added_features = self.provider.addFeatures(new_features)
+            if not res_add_features:
+                self._raise_provider_error("Features couldn't be added")
+            self.written = True
+
+            if self.key_index_cache:
+                self.key_index_cache.add_committed_changes(
+                    {int(f.id()): self.key_index_cache.feature_key(f) for f in added_features})
+
+        return updated_features_count, updated_geometries_count, res_add_features
+
+    def delete(self, fids):
+        deleted_count = super().delete(fids)
+        if self.key_index_cache:
+            self.key_index_cache.add_committed_changes(deleted_fids=fids)
+
+        return deleted_count
+
+    def _raise_provider_error(self, message):
+        raise QgsEditError("{}: {}".format(message, "\n".join(self.provider.errors())))
+
+    def rollback(self):
+        self.finish()  # Changes already written by the provider cannot be rolled back
+
+    def finish(self):
+        if self.written:
+            # Let the layer know about changes made behind its back
+            self.target.reload()
+            self.target.updateExtents()
+            self.target.triggerRepaint()
+            self.written = False
+
+
+class PostgresCopyWriter(FeatureWriter):
+    """
+    Append features to a PostgreSQL target by streaming them with COPY ... FROM STDIN, instead of going through
+    the provider's INSERTs. Geometries are sent as hex EWKB.
+
+    Only mapped target fields are copied, so that the database fills the other ones (e.g., automatic PKs) with
+    their default values. Each write is committed in its own transaction.
+    """
+
+    def __init__(self, target, feedback, field_indexes):
+        """
+        :param field_indexes: Indexes of target fields to copy
+        """
+        super().__init__(target, feedback)
+        self.uri = QgsDataSourceUri(target.source())
+        self.field_indexes = sorted(field_indexes)
+        self.fields = target.fields()
+        self.geometry_column = self.uri.geometryColumn() if target.isSpatial() else ''
+        self.srid = self.uri.srid() or str(target.crs().postgisSrid())
+        self.has_z = QgsWkbTypes.hasZ(target.wkbType())
+        self.has_m = QgsWkbTypes.hasM(target.wkbType())
+        self.connection = None
+        self.written = False
+
+        self.table = quoted_identifier(self.uri.table())
+        if self.uri.schema():
+            self.table = "{}.{}".format(quoted_identifier(self.uri.schema()), self.table)
+        self.columns = [quoted_identifier(self.fields.at(idx).name()) for idx in self.field_indexes]
+        if self.geometry_column:
+            self.columns.append(quoted_identifier(self.geometry_column))
+        self.copy_sql = "COPY {} ({}) FROM STDIN".format(self.table, ", ".join(self.columns))
+
+    @staticmethod
+    def is_supported(target):
+        return target.providerType() == 'postgres' and psycopg2 is not None and \
+               not QgsDataSourceUri(target.source()).table().startswith('(')  # Query layers
+
+    def create_feature(self, geometry, attributes, key_value=None):
+        # The database fills unmapped fields with their default values
+        feature = QgsFeature(self.fields)
+        feature.setAttributes(attributes)
+        feature.setGeometry(geometry)
+        return feature
+
+    def write(self, new_features, updated_features, updated_geometries):
+        if updated_features or updated_geometries:
+            raise QgsEditError("Features can only be appended via COPY")
+
+        if not new_features:
+            return 0, 0, False
+
+        self._connect()
+        try:
+            self._copy(new_features)
+            self.connection.commit()
+        except psycopg2.Error as e:
+            self.connection.rollback()
+            raise QgsEditError(str(e))
+
+        self.written = True
+        return 0, 0, True
+
+    def _connect(self):
+        """
+        :raises QgsEditError: If the database cannot be reached (e.g., wrong credentials)
+        """
+        if self.connection is None:
+            try:
+                self.connection = psycopg2.connect(self.uri.connectionInfo(True))
+            except psycopg2.Error as e:
+                raise QgsEditError(str(e))
+
+    def _copy(self, features):
+        self._connect()
+        rows = io.StringIO()
+        for f in features:
+            rows.write("\t".join(self._row_values(f)))
+            rows.write("\n")
+        rows.seek(0)
+
+        with self.connection.cursor() as cursor:
+            cursor.copy_expert(self.copy_sql, rows)
+
+    def _row_values(self, feature):
+        values = [self._copy_value(feature.attribute(idx), self.fields.at(idx)) for idx in self.field_indexes]
+        if self.geometry_column:
+            values.append(self._copy_geometry(feature.geometry()))
+        return values
+
+    def _copy_geometry(self, geometry):
+        if geometry.isNull():
+            return '\\N'
+
+        geometry = match_dimensions(geometry, self.has_z, self.has_m)
+        return "SRID={};{}".format(self.srid, bytes(geometry.asWkb().toHex()).decode('ascii'))
+
+    @staticmethod
+    def _copy_value(value, field):
+        """
+        Format a value for COPY's text format.
+        """
+        if is_null(value):
+            return '\\N'
+
+        if isinstance(value, (dict, list, bool)) and field.typeName().lower() in ('json', 'jsonb'):
+            value = json.dumps(value)  # JSON text (e.g., from a string field) is passed through
+        elif isinstance(value, bool):
+            value = 't' if value else 'f'
+        elif isinstance(value, QDateTime):
+            value = value.toString(Qt.ISODateWithMs)
+        elif isinstance(value, (QDate, QTime)):
+            value = value.toString(Qt.ISODate)
+        elif isinstance(value, (QByteArray, bytes)):
+            value = '\\x' + bytes(value).hex()
+        elif isinstance(value, (list, tuple)):
+            elements = ['NULL' if is_null(e) else '"{}"'.format(str(e).replace('\\', '\\\\').replace('"', '\\"'))
+                        for e in value]
+            value = "{{{}}}".format(",".join(elements))
+        else:
+            value = str(value)
+
+        return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+    def rollback(self):
+        self.finish()
+
+    def finish(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+        if self.written:
+            self.target.reload()
+            self.target.updateExtents()
+            self.target.triggerRepaint()
+            self.written = False
+
+
+class PostgresUpsertWriter(PostgresCopyWriter):
+    """
+    Find duplicates and append/update features in a PostgreSQL target with set-based SQL statements.
+
+    All source features are streamed with COPY into a temporary staging table, together with their values of the
+    source fields to compare. Then, in a single transaction, duplicates are updated with one UPDATE ... FROM and the
+    rest are appended with one INSERT ... SELECT. Just like when finding duplicates in QGIS, duplicates are those
+    found in the target before any change, and if several source features match the same target feature, the last
+    one wins.
+    """
+    STAGING_TABLE = 'append_features_to_layer_staging'
+    KEY_COLUMN_PREFIX = '__aftl_key_'
+    ROW_COLUMN = '__aftl_row'
+    EXISTS_COLUMN = '__aftl_exists'
+
+    def __init__(self, target, feedback, field_indexes, key_fields):
+        """
+        :param key_fields: Name of the target field to compare, or list of names for a composite key
+        """
+        super().__init__(target, feedback, field_indexes)
+        key_fields = key_field_list(key_fields)
+        self.key_columns = [quoted_identifier(field) for field in key_fields]
+        self.staging_key_columns = ["{}{}".format(self.KEY_COLUMN_PREFIX, i) for i in range(len(key_fields))]
+        self.staging_fields = QgsFields(self.fields)
+        for column, field in zip(self.staging_key_columns, key_fields):
+            self.staging_fields.append(QgsField(column, self.fields.field(field).type()))
+        self.key_idxs = list(range(self.fields.count(), self.staging_fields.count()))
+        self.json_columns = {quoted_identifier(self.fields.at(idx).name()) for idx in self.field_indexes
+                             if self.fields.at(idx).typeName().lower() == 'json'}
+        self.staging_created = False
+        self.copy_sql = "COPY {} ({}) FROM STDIN".format(self.STAGING_TABLE,
+                                                         ", ".join(self.columns + self.staging_key_columns))
+
+    def create_feature(self, geometry, attributes, key_value=None):
+        feature = QgsFeature(self.staging_fields)
+        attributes.extend(key_value if len(self.key_idxs) > 1 else [key_value])
+        feature.setAttributes(attributes)
+        feature.setGeometry(geometry)
+        return feature
+
+    def _row_values(self, feature):
+        values = super()._row_values(feature)
+        values.extend(self._copy_value(feature.attribute(idx), self.staging_fields.at(idx)) for idx in self.key_idxs)
+        return values
+
+    def _join_conditions(self, target_alias, staging_alias):
+        """
+        Conditions to match target and staged keys, to be run in separate statements whose results are disjoint.
+
+        Keys without NULL values are compared with '=', so that PostgreSQL can use hash or merge joins and indexes
+        on target columns. Just like keys in QGIS, NULL values match each other, but IS NOT DISTINCT FROM can only
+        be run as a nested loop, so it's only used among keys with NULL values on both sides.
+        """
+        equal = " AND ".join("{}.{} = {}.{}".format(target_alias, key_column, staging_alias, staging_key_column)
+                             for key_column, staging_key_column in zip(self.key_columns, self.staging_key_columns))
+        not_distinct = " AND ".join("{}.{} IS NOT DISTINCT FROM {}.{}".format(target_alias, key_column, staging_alias, staging_key_column)
+                                    for key_column, staging_key_column in zip(self.key_columns, self.staging_key_columns))
+        with_nulls = "({}) AND ({}) AND {}".format(
+            " OR ".join("{}.{} IS NULL".format(target_alias, key_column) for key_column in self.key_columns),
+            " OR ".join("{}.{} IS NULL".format(staging_alias, staging_key_column) for staging_key_column in self.staging_key_columns),
+            not_distinct)
+        return equal, with_nulls
+
+    def _comparable(self, alias, column):
+        # json has no equality operator, unlike jsonb
+        return "{}.{}{}".format(alias, column, "::jsonb" if column in self.json_columns else "")
+
+    def write(self, new_features, updated_features, updated_geometries):
+        """
+        Stage features. Duplicates are found and written by merge().
+        """
+        if updated_features or updated_geometries:
+            raise QgsEditError("Features to update are found by the database")
+
+        if not new_features:
+            return 0, 0, False
+
+        self._connect()
+        try:
+            self.create_staging_table()
+            self._copy(new_features)
+            self.connection.commit()
+        except psycopg2.Error as e:
+            self.connection.rollback()
+            raise QgsEditError(str(e))
+
+        return 0, 0, True
+
+    def create_staging_table(self):
+        if self.staging_created:
+            return
+
+        self._connect()
+        with self.connection.cursor() as cursor:
+            cursor.execute("CREATE TEMP TABLE {stage} AS SELECT {columns} FROM {table} t WITH NO DATA".format(
+                stage=self.STAGING_TABLE,
+                columns=", ".join(["t.{}".format(column) for column in self.columns] +
+                                  ["t.{} AS {}".format(key_column, staging_key_column) for key_column, staging_key_column
+                                   in zip(self.key_columns, self.staging_key_columns)]),
+                table=self.table))
+            cursor.execute("ALTER TABLE {} ADD COLUMN {} bigserial, ADD COLUMN {} boolean DEFAULT false".format(
+                self.STAGING_TABLE, self.ROW_COLUMN, self.EXISTS_COLUMN))
+        self.staging_created = True
+
+    def merge(self, update_attributes, update_geometry, only_changes=False, delete_missing=False):
+        """
+        Find duplicates among staged features and write them to the target layer, in a single transaction.
+
+        :param update_attributes: Whether duplicates should get attributes from the source features
+        :param update_geometry: Whether duplicates should get geometries from the source features
+        :param only_changes: Whether duplicates should only be updated if their values differ from source values
+        :param delete_missing: Whether target features not found among staged features should be deleted (those
+                               with NULL values to compare are kept)
+        :return: dict with counts of 'appended', 'updated', 'skipped', 'unchanged' and 'deleted' features and target
+                 features 'matched'
+        :raises QgsEditError: If the changes cannot be committed
+        """
+        counts = {'appended': 0, 'updated': 0, 'skipped': 0, 'matched': 0, 'unchanged': 0, 'deleted': 0}
+        if not self.staging_created and not delete_missing:
+            return counts
+
+        stage = self.STAGING_TABLE
+        self._connect()
+        try:
+            self.create_staging_table()  # Without source features, every target feature is missing
+            with self.connection.cursor() as cursor:
+                # Duplicates are searched before changing anything in the target
+                join_conditions = self._join_conditions('t', 's')
+                for condition in join_conditions:
+                    cursor.execute("UPDATE {stage} s SET {exists} = true FROM {table} t WHERE {condition}".format(
+                        stage=stage, exists=self.EXISTS_COLUMN, table=self.table, condition=condition))
+                    cursor.execute("SELECT count(*) FROM {table} t WHERE EXISTS (SELECT 1 FROM {stage} s WHERE {condition})".format(
+                        stage=stage, table=self.table, condition=condition))
+                    counts['matched'] += cursor.fetchone()[0]
+                    cursor.execute("SELECT count(*) FROM {stage} s JOIN {table} t ON {condition}".format(
+                        stage=stage, table=self.table, condition=condition))
+                    counts['skipped'] += cursor.fetchone()[0]
+
+                set_columns = list()
+                if update_attributes:
+                    set_columns = [column for column in self.columns if column != quoted_identifier(self.geometry_column)]
+                if update_geometry and self.geometry_column:
+                    set_columns.append(quoted_identifier(self.geometry_column))
+
+                if set_columns:
+                    # If several source features match the same target feature, the last one wins
+                    for condition in join_conditions:
+                        if only_changes:
+                            condition += " AND ({}) IS DISTINCT FROM ({})".format(
+                                ", ".join(self._comparable('t', column) for column in set_columns),
+                                ", ".join(self._comparable('s', column) for column in set_columns))
+                        cursor.execute("""UPDATE {table} t SET {sets}
+                                          FROM (SELECT DISTINCT ON ({key_columns}) * FROM {stage} WHERE {exists}
+                                                ORDER BY {key_columns}, {row} DESC) s
+                                          WHERE {condition}""".format(
+                            table=self.table,
+                            sets=", ".join("{column} = s.{column}".format(column=column) for column in set_columns),
+                            key_columns=", ".join(self.staging_key_columns),
+                            stage=stage,
+                            exists=self.EXISTS_COLUMN,
+                            row=self.ROW_COLUMN,
+                            condition=condition))
+                        counts['updated'] += cursor.rowcount
+                    if only_changes:
+                        counts['unchanged'] = counts['matched'] - counts['updated']
+                elif update_attributes or update_geometry:
+                    counts['updated'] = counts['matched']  # Nothing to change
+
+                if delete_missing:
+                    # Target features with NULL values are kept, so only keys without them are compared
+                    cursor.execute("DELETE FROM {table} t WHERE {not_null} AND NOT EXISTS (SELECT 1 FROM {stage} s WHERE {condition})".format(
+                        table=self.table,
+                        not_null=" AND ".join("t.{} IS NOT NULL".format(column) for column in self.key_columns),
+                        stage=stage,
+                        condition=join_conditions[0]))
+                    counts['deleted'] = cursor.rowcount
+
+                cursor.execute("INSERT INTO {table}{columns} SELECT {values} FROM {stage} WHERE NOT {exists} ORDER BY {row}".format(
+                    table=self.table,
+                    columns=" ({})".format(", ".join(self.columns)) if self.columns else "",
+                    values=", ".join(self.columns),
+                    stage=stage,
+                    exists=self.EXISTS_COLUMN,
+                    row=self.ROW_COLUMN))
+                counts['appended'] = cursor.rowcount
+
+                cursor.execute("DROP TABLE {}".format(stage))
+            self.connection.commit()
+        except psycopg2.Error as e:
+            self.connection.rollback()
+            raise QgsEditError(str(e))
+
+        self.staging_created = False
+        self.written = True
+        return counts
+
+
+class GeoPackageWriter(FeatureWriter):
+    """
+    Write features to a GeoPackage target with SQLite itself, instead of going through OGR feature by feature.
+
+    Each write runs in a single transaction. The triggers that maintain the layer's spatial index (rtree) are
+    dropped while rows are written and recreated before committing, so that the index is updated once per write
+    with the bounding boxes computed here, instead of row by row. Only mapped target fields are written, so that
+    SQLite fills the other ones (e.g., the fid) with their default values.
+    """
+    PRAGMAS = ("PRAGMA synchronous = NORMAL",
+               "PRAGMA temp_store = MEMORY",
+               "PRAGMA cache_size = -65536")  # 64 MB
+
+    def __init__(self, target, feedback, field_indexes, key_index_cache=None):
+        """
+        :param field_indexes: Indexes of target fields to write
+        """
+        super().__init__(target, feedback)
+        parts = QgsProviderRegistry.instance().providerMetadata('ogr').decodeUri(target.source())
+        self.path = parts['path']
+        self.table_name = parts['layerName']
+        self.table = quoted_identifier(self.table_name)
+        self.fields = target.fields()
+        self.key_index_cache = key_index_cache
+        self.has_z = QgsWkbTypes.hasZ(target.wkbType())
+        self.has_m = QgsWkbTypes.hasM(target.wkbType())
+        self.connection = None
+        self.written = False
+
+        self._connect()
+        self.geometry_column = None
+        self.srs_id = 0
+        row = self.connection.execute("SELECT column_name, srs_id FROM gpkg_geometry_columns WHERE lower(table_name) = lower(?)",
+                                      (self.table_name,)).fetchone()
+        if row is not None and target.isSpatial():
+            self.geometry_column, self.srs_id = row
+
+        pk_columns = [info[1] for info in self.connection.execute("PRAGMA table_info({})".format(self.table)) if info[5]]
+        self.field_indexes = sorted(idx for idx in field_indexes if self.fields.at(idx).name() not in pk_columns)
+        self.fid_column = quoted_identifier(pk_columns[0]) if len(pk_columns) == 1 else 'rowid'
+
+        self.rtree = None
+        if self.geometry_column:
+            rtree = "rtree_{}_{}".format(self.table_name, self.geometry_column)
+            if self.connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (rtree,)).fetchone():
+                self.rtree = quoted_identifier(rtree)
+                self.rtree_trigger_prefix = rtree + "_"
+
+    @staticmethod
+    def is_supported(target):
+        if target.providerType() != 'ogr' or target.dataProvider().storageType() != 'GPKG':
+            return False
+
+        parts = QgsProviderRegistry.instance().providerMetadata('ogr').decodeUri(target.source())
+        return bool(parts.get('layerName'))
+
+    def _connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            for pragma in self.PRAGMAS:
+                self.connection.execute(pragma)
+
+    def create_feature(self, geometry, attributes, key_value=None):
+        # SQLite fills unmapped fields with their default values
+        feature = QgsFeature(self.fields)
+        feature.setAttributes(attributes)
+        feature.setGeometry(geometry)
+        return feature
+
+    def write(self, new_features, updated_features, updated_geometries):
+        if not (new_features or updated_features or updated_geometries):
+            return 0, 0, False
+
+        self._connect()
+        cursor = self.connection.cursor()
+        committed_keys = dict()
+        rtree_rows = dict()  # {fid: bbox or None}
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            rtree_triggers = self._drop_rtree_triggers(cursor)
+
+            for fid, attrs in updated_features.items():
+                indexes = [idx for idx in self.field_indexes if idx in attrs]
+                if not indexes:
+                    continue
+                cursor.execute("UPDATE {} SET {} WHERE {} = ?".format(
+                    self.table,
+                    ", ".join("{} = ?".format(quoted_identifier(self.fields.at(idx).name())) for idx in indexes),
+                    self.fid_column), [self._sqlite_value(attrs[idx]) for idx in indexes] + [fid])
+
+            if self.geometry_column:
+                for fid, geometry in updated_geometries.items():
+                    blob, bbox = self._gpkg_geometry(geometry)
+                    cursor.execute("UPDATE {} SET {} = ? WHERE {} = ?".format(
+                        self.table, quoted_identifier(self.geometry_column), self.fid_column), (blob, fid))
+                    rtree_rows[fid] = bbox
+
+            columns = [quoted_identifier(self.fields.at(idx).name()) for idx in self.field_indexes]
+            if self.geometry_column:
+                columns.append(quoted_identifier(self.geometry_column))
+            if columns:
+                insert_sql = "INSERT INTO {} ({}) VALUES ({})".format(self.table, ", ".join(columns),
+                                                                      ", ".join("?" * len(columns)))
+            else:
+                insert_sql = "INSERT INTO {} DEFAULT VALUES".format(self.table)
+
+            for f in new_features:
+                values = [self._sqlite_value(f.attribute(idx)) for idx in self.field_indexes]
+                bbox = None
+                if self.geometry_column:
+                    blob, bbox = self._gpkg_geometry(f.geometry())
+                    values.append(blob)
+                cursor.execute(insert_sql, values)
+                rtree_rows[cursor.lastrowid] = bbox
+                if self.key_index_cache:
+                    committed_keys[cursor.lastrowid] = self.key_index_cache.feature_key(f)
+
+            if self.rtree:
+                # Update the spatial index once for all written rows, then restore its triggers
+                cursor.executemany("DELETE FROM {} WHERE id = ?".format(self.rtree),
+                                   ((fid,) for fid, bbox in rtree_rows.items() if bbox is None))
+                cursor.executemany("INSERT OR REPLACE INTO {} (id, minx, maxx, miny, maxy) VALUES (?, ?, ?, ?, ?)".format(self.rtree),
+                                   ((fid, bbox.xMinimum(), bbox.xMaximum(), bbox.yMinimum(), bbox.yMaximum())
+                                    for fid, bbox in rtree_rows.items() if bbox is not None))
+                for sql in rtree_triggers:
+                    cursor.execute(sql)
+
+            cursor.execute("COMMIT")
+        except sqlite3.Error as e:
+            if self.connection.in_transaction:
+                cursor.execute("ROLLBACK")
+            raise QgsEditError(str(e))
+
+        self.written = True
+        if self.key_index_cache:
+            self.key_index_cache.add_committed_changes(committed_keys)
+            self.key_index_cache.add_changed_attributes(updated_features)
+
+        return len(updated_features), len(updated_geometries) if self.geometry_column else 0, bool(new_features)
+
+    def delete(self, fids):
+        if not fids:
+            return 0
+
+        self._connect()
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            rtree_triggers = self._drop_rtree_triggers(cursor)
+            cursor.executemany("DELETE FROM {} WHERE {} = ?".format(self.table, self.fid_column),
+                               ((fid,) for fid in fids))
+            if self.rtree:
+                cursor.executemany("DELETE FROM {} WHERE id = ?".format(self.rtree), ((fid,) for fid in fids))
+                for sql in rtree_triggers:
+                    cursor.execute(sql)
+
+            cursor.execute("COMMIT")
+        except sqlite3.Error as e:
+            if self.connection.in_transaction:
+                cursor.execute("ROLLBACK")
+            raise QgsEditError(str(e))
+
+        self.written = True
+        if self.key_index_cache:
+            self.key_index_cache.add_committed_changes(deleted_fids=fids)
+
+        return len(fids)
+
+    def _drop_rtree_triggers(self, cursor):
+        """
+        Drop the triggers that maintain the spatial index, since they run for each row (and use spatial SQL
+        functions that only GDAL registers).
+
+        :return: SQL statements to recreate the dropped triggers
+        """
+        if not self.rtree:
+            return list()
+
+        triggers = [(name, sql) for name, sql in cursor.execute(
+            "SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND lower(tbl_name) = lower(?)",
+            (self.table_name,)).fetchall() if name.startswith(self.rtree_trigger_prefix)]
+        for name, sql in triggers:
+            cursor.execute("DROP TRIGGER {}".format(quoted_identifier(name)))
+
+        return [sql for name, sql in triggers]
+
+    def _gpkg_geometry(self, geometry):
+        """
+        Encode a geometry as a GeoPackage binary blob (header with an XY envelope, followed by ISO WKB).
+
+        :return: Tuple (blob, bounding box for the spatial index or None if the geometry is null or empty)
+        """
+        if geometry.isNull():
+            return None, None
+
+        geometry = match_dimensions(geometry, self.has_z, self.has_m)
+        wkb = bytes(geometry.asWkb())
+        if geometry.isEmpty():
+            # Flags: little endian, no envelope, empty geometry
+            return b'GP' + struct.pack('<BBi', 0, 0b00010001, self.srs_id) + wkb, None
+
+        bbox = geometry.boundingBox()
+        # Flags: little endian, XY envelope
+        header = b'GP' + struct.pack('<BBi4d', 0, 0b00000011, self.srs_id,
+                                     bbox.xMinimum(), bbox.xMaximum(), bbox.yMinimum(), bbox.yMaximum())
+        return header + wkb, bbox
+
+    @staticmethod
+    def _sqlite_value(value):
+        if is_null(value):
+            return None
+
+        if isinstance(value, bool):
+            return int(value)
+        elif isinstance(value, QDateTime):
+            return value.toString(Qt.ISODateWithMs)
+        elif isinstance(value, (QDate, QTime)):
+            return value.toString(Qt.ISODate)
+        elif isinstance(value, QByteArray):
+            return bytes(value)
+        elif isinstance(value, (list, tuple, dict)):
+            return json.dumps(value)
+        elif isinstance(value, (int, float, str, bytes)):
+            return value
+
+        return str(value)
+
+    def rollback(self):
+        self.finish()
+
+    def finish(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+        if self.written:
+            self.target.reload()
+            self.target.updateExtents()
+            self.target.triggerRepaint()
+            self.written = False
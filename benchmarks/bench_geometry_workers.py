@@ -0,0 +1,62 @@
+"""
+Throughput of polygon to multi-polygon loads with avoid-intersections, preparing geometries in the main thread
+vs. in parallel workers.
+
+Run it from the repository root (QGIS plugins folder in PYTHONPATH):
+
+    python -m benchmarks.bench_geometry_workers [workers]
+"""
+import sys
+
+from qgis.core import (QgsFeature,
+                       QgsGeometry,
+                       QgsProject,
+                       QgsVectorLayer)
+
+from benchmarks.utils import (init_plugin,
+                              run_timed,
+                              report)
+
+COUNT = 50000
+SIDE = 100  # Squares per row
+
+
+def create_polygon_layer(definition, name, offset=0.0):
+    layer = QgsVectorLayer(definition, name, "memory")
+    features = list()
+    for i in range(COUNT):
+        x, y = (i % SIDE) * 10 + offset, (i // SIDE) * 10 + offset
+        feature = QgsFeature(layer.fields())
+        feature.setGeometry(QgsGeometry.fromWkt("Polygon (({x} {y}, {x1} {y}, {x1} {y1}, {x} {y1}, {x} {y}))".format(
+            x=x, y=y, x1=x + 8, y1=y + 8)))
+        feature.setAttributes([i])
+        features.append(feature)
+    layer.dataProvider().addFeatures(features)
+    return layer
+
+
+def main():
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    plugin = init_plugin()
+    source = create_polygon_layer("Polygon?crs=EPSG:3857&field=code:integer", 'source')
+    avoid = create_polygon_layer("Polygon?crs=EPSG:3857&field=code:integer", 'avoid', offset=4.0)
+    QgsProject.instance().addMapLayer(avoid)
+    QgsProject.instance().setAvoidIntersectionsLayers([avoid])
+
+    for geometry_workers in (0, workers):
+        target = QgsVectorLayer("MultiPolygon?crs=EPSG:3857&field=code:integer", 'target', "memory")
+        res, seconds = run_timed({'SOURCE_LAYER': source,
+                                  'SOURCE_FIELD': None,
+                                  'TARGET_LAYER': target,
+                                  'TARGET_FIELD': None,
+                                  'ACTION_ON_DUPLICATE': 0,  # No action
+                                  'GEOMETRY_WORKERS': geometry_workers})
+        assert res['APPENDED_COUNT'] == COUNT, res
+        report("Polygon to MultiPolygon with avoid-intersections, {} workers".format(geometry_workers), COUNT, seconds)
+
+    QgsProject.instance().setAvoidIntersectionsLayers([])
+    plugin.unload()
+
+
+if __name__ == '__main__':
+    main()
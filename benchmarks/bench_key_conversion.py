@@ -0,0 +1,65 @@
+"""
+Per-row cost of converting source keys to the target field type and looking them up in the target index, for
+each supported pair of field types: QVariant conversion for each row vs. a converter resolved once per run.
+
+Run it from the repository root (QGIS plugins folder in PYTHONPATH):
+
+    python -m benchmarks.bench_key_conversion
+"""
+import time
+
+from qgis.PyQt.QtCore import (Qt,
+                              QDate,
+                              QVariant)
+
+from benchmarks.utils import QGIS_APP  # noqa: F401 (QGIS must be initialized)
+from AppendFeaturesToLayer.processing.utils.converters import (convert_with_qvariant,
+                                                               get_converter)
+
+COUNT = 200000
+
+# (source type, target type, source values, target values)
+PAIRS = [
+    (QVariant.Int, QVariant.String, list(range(COUNT)), [str(i) for i in range(COUNT)]),
+    (QVariant.String, QVariant.Int, [str(i) for i in range(COUNT)], list(range(COUNT))),
+    (QVariant.Int, QVariant.LongLong, list(range(COUNT)), list(range(COUNT))),
+    (QVariant.Int, QVariant.Double, list(range(COUNT)), [float(i) for i in range(COUNT)]),
+    (QVariant.Double, QVariant.Int, [float(i) for i in range(COUNT)], list(range(COUNT))),
+    (QVariant.String, QVariant.Double, [str(float(i)) for i in range(COUNT)], [float(i) for i in range(COUNT)]),
+    (QVariant.Date, QVariant.String, [QDate(2000, 1, 1).addDays(i) for i in range(COUNT)],
+     [QDate(2000, 1, 1).addDays(i).toString(Qt.ISODate) for i in range(COUNT)]),
+    (QVariant.String, QVariant.Date, [QDate(2000, 1, 1).addDays(i).toString(Qt.ISODate) for i in range(COUNT)],
+     [QDate(2000, 1, 1).addDays(i) for i in range(COUNT)]),
+]
+
+
+def time_lookups(convert, values, target_value_dict):
+    found = 0
+    start_time = time.perf_counter()
+    for value in values:
+        converted_value = convert(value)
+        if converted_value is not None and converted_value in target_value_dict:
+            found += 1
+    return found, time.perf_counter() - start_time
+
+
+def main():
+    for source_type, target_type, source_values, target_values in PAIRS:
+        target_value_dict = {value: [fid] for fid, value in enumerate(target_values)}
+        title = "{} -> {}".format(QVariant.typeToName(source_type), QVariant.typeToName(target_type))
+
+        found_qvariant, seconds_qvariant = time_lookups(lambda value: convert_with_qvariant(value, target_type),
+                                                        source_values, target_value_dict)
+        found_converter, seconds_converter = time_lookups(get_converter(source_type, target_type),
+                                                          source_values, target_value_dict)
+        assert found_qvariant == found_converter == COUNT, (title, found_qvariant, found_converter)
+
+        print("{:<22} QVariant: {:.3f} us/row   converter: {:.3f} us/row   ({:.1f}x)".format(
+            title,
+            seconds_qvariant / COUNT * 1e6,
+            seconds_converter / COUNT * 1e6,
+            seconds_qvariant / seconds_converter if seconds_converter else 0))
+
+
+if __name__ == '__main__':
+    main()
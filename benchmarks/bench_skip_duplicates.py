@@ -0,0 +1,34 @@
+"""
+Throughput of SKIP_FEATURE mode when every source feature is a duplicate.
+
+Run it from the repository root (QGIS plugins folder in PYTHONPATH):
+
+    python -m benchmarks.bench_skip_duplicates
+"""
+from benchmarks.utils import (init_plugin,
+                              create_memory_layer,
+                              run_timed,
+                              report)
+
+COUNT = 100000
+
+
+def main():
+    plugin = init_plugin()
+    definition = "None?field=code:integer&field=name:string(20)"
+    rows = [[i, 'name {}'.format(i)] for i in range(COUNT)]
+    source = create_memory_layer(definition, rows, 'source')
+    target = create_memory_layer(definition, rows, 'target')
+
+    res, seconds = run_timed({'SOURCE_LAYER': source,
+                              'SOURCE_FIELD': 'code',
+                              'TARGET_LAYER': target,
+                              'TARGET_FIELD': 'code',
+                              'ACTION_ON_DUPLICATE': 1})  # Skip
+    assert res['SKIPPED_COUNT'] == COUNT, res
+    report("SKIP_FEATURE, {} duplicates".format(COUNT), COUNT, seconds)
+    plugin.unload()
+
+
+if __name__ == '__main__':
+    main()
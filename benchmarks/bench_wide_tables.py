@@ -0,0 +1,62 @@
+"""
+Throughput of building target features from wide source tables (200+ columns): a dict comprehension with field
+lookups and QgsVectorLayerUtils.createFeature() per row vs. the attribute transformer and the feature template
+resolved once per run. An end-to-end append is timed as well.
+
+Run it from the repository root (QGIS plugins folder in PYTHONPATH):
+
+    python -m benchmarks.bench_wide_tables [columns]
+"""
+import sys
+import time
+
+from qgis.core import (QgsGeometry,
+                       QgsVectorLayer,
+                       QgsVectorLayerUtils)
+
+from benchmarks.utils import (create_memory_layer,
+                              init_plugin,
+                              run_timed,
+                              report)
+from AppendFeaturesToLayer.processing.utils.mapping import AttributeTransformer
+from AppendFeaturesToLayer.processing.utils.writers import FeatureTemplate
+
+COUNT = 20000
+
+
+def main():
+    columns = int(sys.argv[1]) if len(sys.argv) > 1 else 220
+    plugin = init_plugin()
+    definition = "None?{}".format("&".join("field=f{}:integer".format(i) for i in range(columns)))
+    source = create_memory_layer(definition, ([i * columns + j for j in range(columns)] for i in range(COUNT)), 'source')
+    target = QgsVectorLayer(definition, 'target', "memory")
+    mapping = {target_idx: source.fields().indexOf(target.fields().at(target_idx).name())
+               for target_idx in target.fields().allAttributesList()}
+
+    features = list(source.getFeatures())
+    start_time = time.perf_counter()
+    for in_feature in features:
+        attrs = {target_idx: in_feature[source_idx] for target_idx, source_idx in mapping.items()}
+        QgsVectorLayerUtils().createFeature(target, QgsGeometry(), attrs)
+    report("{} columns, dict + createFeature()".format(columns), COUNT, time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    transformer = AttributeTransformer(mapping, source.fields().count(), target.fields().count())
+    template = FeatureTemplate(target)
+    for in_feature in features:
+        template.create_feature(QgsGeometry(), transformer.target_attributes(in_feature.attributes()))
+    report("{} columns, transformer + template".format(columns), COUNT, time.perf_counter() - start_time)
+
+    res, seconds = run_timed({'SOURCE_LAYER': source,
+                              'SOURCE_FIELD': None,
+                              'TARGET_LAYER': target,
+                              'TARGET_FIELD': None,
+                              'ACTION_ON_DUPLICATE': 0})  # No action
+    assert res['APPENDED_COUNT'] == COUNT, res
+    report("{} columns, append (end to end)".format(columns), COUNT, seconds)
+
+    plugin.unload()
+
+
+if __name__ == '__main__':
+    main()
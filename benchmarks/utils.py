@@ -0,0 +1,42 @@
+import time
+
+from qgis.core import (QgsFeature,
+                       QgsVectorLayer)
+from qgis.testing import start_app
+from qgis.testing.mocked import get_iface
+
+import processing
+
+QGIS_APP = start_app()
+
+
+def init_plugin():
+    from AppendFeaturesToLayer.append_features_to_layer_plugin import AppendFeaturesToLayerPlugin
+    plugin = AppendFeaturesToLayerPlugin(get_iface)
+    plugin.initGui()
+    return plugin
+
+
+def create_memory_layer(definition, rows, name='layer'):
+    """
+    :param definition: Memory layer URI, e.g., "None?field=name:string(20)"
+    :param rows: Iterable of attribute lists
+    """
+    layer = QgsVectorLayer(definition, name, "memory")
+    features = list()
+    for attrs in rows:
+        feature = QgsFeature(layer.fields())
+        feature.setAttributes(attrs)
+        features.append(feature)
+    layer.dataProvider().addFeatures(features)
+    return layer
+
+
+def run_timed(parameters):
+    start_time = time.perf_counter()
+    res = processing.run("etl_load:appendfeaturestolayer", parameters)
+    return res, time.perf_counter() - start_time
+
+
+def report(title, rows, seconds):
+    print("{}: {} rows in {:.2f} s ({:.0f} rows/s)".format(title, rows, seconds, rows / seconds if seconds else 0))
@@ -0,0 +1,258 @@
+from qgis.PyQt.QtCore import QDate
+from qgis.core import (QgsFeature,
+                       QgsGeometry,
+                       QgsProcessingFeedback,
+                       QgsVectorLayer,
+                       QgsVectorLayerUtils)
+from qgis.testing import unittest, start_app
+from qgis.testing.mocked import get_iface
+
+import processing
+
+from tests.utils import (get_qgis_gpkg_layer,
+                         APPENDED_COUNT,
+                         SKIPPED_COUNT,
+                         UPDATED_FEATURE_COUNT)
+
+start_app()
+
+
+class TestKeyIndex(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        print('\nINFO: Set up test_key_index')
+        from AppendFeaturesToLayer.append_features_to_layer_plugin import AppendFeaturesToLayerPlugin
+        cls.plugin = AppendFeaturesToLayerPlugin(get_iface)
+        cls.plugin.initGui()
+
+    def test_build_target_key_index(self):
+        print('\nINFO: Validating target key index...')
+        from AppendFeaturesToLayer.processing.utils.key_index import build_target_key_index
+
+        output_layer, layer_path = get_qgis_gpkg_layer('target_table')
+        self.assertTrue(output_layer.isValid())
+
+        res = processing.run("etl_load:appendfeaturestolayer",
+                             {'SOURCE_LAYER': "{}|layername=source_table".format(layer_path),
+                              'SOURCE_FIELD': None,
+                              'TARGET_LAYER': output_layer,
+                              'TARGET_FIELD': None,
+                              'ACTION_ON_DUPLICATE': 0})  # No action
+        self.assertEqual(res[APPENDED_COUNT], 2)
+
+        target_value_dict = build_target_key_index(output_layer, 'name', QgsProcessingFeedback())
+        self.assertEqual(target_value_dict, {'abc': [1], 'def': [2]})
+
+    def test_build_target_key_index_without_sql_support(self):
+        print('\nINFO: Validating target key index for providers without SQL support...')
+        from AppendFeaturesToLayer.processing.utils.key_index import build_target_key_index, get_key_index_query
+
+        layer = QgsVectorLayer("None?field=name:string(20)", "target", "memory")
+        self.assertTrue(layer.isValid())
+        features = list()
+        for name in ['abc', 'def', 'abc']:
+            feature = QgsFeature(layer.fields())
+            feature.setAttribute('name', name)
+            features.append(feature)
+        self.assertTrue(layer.dataProvider().addFeatures(features)[0])
+
+        self.assertEqual(get_key_index_query(layer, 'name'), (None, None))
+        target_value_dict = build_target_key_index(layer, 'name', QgsProcessingFeedback())
+        self.assertEqual(target_value_dict, {'abc': [1, 3], 'def': [2]})
+
+    def test_update_probing_target(self):
+        print('\nINFO: Validating updates probing the target layer for source values...')
+        output_layer, layer_path = get_qgis_gpkg_layer('target_table')
+        input_layer = QgsVectorLayer("{}|layername=source_table".format(layer_path), 'layer name', 'ogr')
+        self.assertTrue(input_layer.isValid())
+
+        res = processing.run("etl_load:appendfeaturestolayer",
+                             {'SOURCE_LAYER': input_layer,
+                              'SOURCE_FIELD': None,
+                              'TARGET_LAYER': output_layer,
+                              'TARGET_FIELD': None,
+                              'ACTION_ON_DUPLICATE': 0})  # No action
+        self.assertEqual(res[APPENDED_COUNT], 2)
+
+        input_layer.dataProvider().changeAttributeValues({1: {3: 30}})  # real_value --> 30
+        new_feature = QgsFeature()
+        new_feature.setAttributes([5, 'ABC', 1, 2.0])
+        input_layer.dataProvider().addFeatures([new_feature])
+
+        res = processing.run("etl_load:appendfeaturestolayer",
+                             {'SOURCE_LAYER': input_layer,
+                              'SOURCE_FIELD': 'name',
+                              'TARGET_LAYER': output_layer,
+                              'TARGET_FIELD': 'name',
+                              'ACTION_ON_DUPLICATE': 2,  # Update
+                              'KEY_INDEX_STRATEGY': 2})  # Probe
+
+        self.assertEqual(output_layer.featureCount(), 3)
+        self.assertEqual(res[APPENDED_COUNT], 1)
+        self.assertEqual(res[UPDATED_FEATURE_COUNT], 2)
+        self.assertIsNone(res[SKIPPED_COUNT])
+
+        feature = next(output_layer.getFeatures('"name"=\'abc\''))
+        self.assertEqual(feature['real_value'], 30)
+
+    def test_key_index_cache(self):
+        print('\nINFO: Validating the key index cache is updated after each run...')
+        from AppendFeaturesToLayer.processing.utils.key_index_cache import KeyIndexCache
+
+        output_layer, layer_path = get_qgis_gpkg_layer('target_table')
+        input_layer = QgsVectorLayer("{}|layername=source_table".format(layer_path), 'layer name', 'ogr')
+        self.assertTrue(input_layer.isValid())
+
+        res = processing.run("etl_load:appendfeaturestolayer",
+                             {'SOURCE_LAYER': input_layer,
+                              'SOURCE_FIELD': None,
+                              'TARGET_LAYER': output_layer,
+                              'TARGET_FIELD': None,
+                              'ACTION_ON_DUPLICATE': 0})  # No action
+        self.assertEqual(res[APPENDED_COUNT], 2)
+
+        params = {'SOURCE_LAYER': input_layer,
+                  'SOURCE_FIELD': 'name',
+                  'TARGET_LAYER': output_layer,
+                  'TARGET_FIELD': 'name',
+                  'ACTION_ON_DUPLICATE': 1,  # Skip
+                  'USE_KEY_INDEX_CACHE': True}
+        res = processing.run("etl_load:appendfeaturestolayer", params)
+        self.assertEqual(res[APPENDED_COUNT], 0)
+        self.assertEqual(res[SKIPPED_COUNT], 2)
+
+        key_index_cache = KeyIndexCache(output_layer, 'name')
+        self.assertTrue(key_index_cache.is_supported())
+        self.assertEqual(key_index_cache.load(), {'abc': [1], 'def': [2]})
+
+        new_feature = QgsFeature()
+        new_feature.setAttributes([5, 'ABC', 1, 2.0])
+        input_layer.dataProvider().addFeatures([new_feature])
+
+        res = processing.run("etl_load:appendfeaturestolayer", params)
+        self.assertEqual(res[APPENDED_COUNT], 1)
+        self.assertEqual(res[SKIPPED_COUNT], 2)
+
+        key_index_cache = KeyIndexCache(output_layer, 'name')
+        self.assertEqual(key_index_cache.load(), {'abc': [1], 'def': [2], 'ABC': [3]})
+
+        # A change in the target layer makes the cached index stale
+        self.assertTrue(output_layer.dataProvider().deleteFeatures([3]))
+        key_index_cache = KeyIndexCache(output_layer, 'name')
+        self.assertIsNone(key_index_cache.load())
+
+    def test_key_index_cache_concurrent_changes(self):
+        print('\nINFO: Validating the key index cache is dropped if other applications change the target layer...')
+        from AppendFeaturesToLayer.processing.utils.key_index_cache import KeyIndexCache
+
+        output_layer, layer_path = get_qgis_gpkg_layer('target_table')
+        res = processing.run("etl_load:appendfeaturestolayer",
+                             {'SOURCE_LAYER': "{}|layername=source_table".format(layer_path),
+                              'SOURCE_FIELD': None,
+                              'TARGET_LAYER': output_layer,
+                              'TARGET_FIELD': None,
+                              'ACTION_ON_DUPLICATE': 0})  # No action
+        self.assertEqual(res[APPENDED_COUNT], 2)
+        name_idx = output_layer.fields().indexOf('name')
+
+        def add_feature(name):
+            feature = QgsVectorLayerUtils.createFeature(output_layer, QgsGeometry(), {name_idx: name})
+            self.assertTrue(output_layer.dataProvider().addFeatures([feature]))
+            return next(output_layer.getFeatures('"name" = \'{}\''.format(name))).id()
+
+        # Registered changes explain the new signature
+        key_index_cache = KeyIndexCache(output_layer, 'name')
+        key_index_cache.save({'abc': [1], 'def': [2]})
+        fid = add_feature('ABC')
+        key_index_cache.add_committed_changes({fid: 'ABC'}, [1])
+        self.assertTrue(output_layer.dataProvider().deleteFeatures([1]))
+        key_index_cache.update()
+        self.assertEqual(KeyIndexCache(output_layer, 'name').load(), {'def': [2], 'ABC': [fid]})
+
+        # Another feature was added meanwhile, which the cached index would miss
+        key_index_cache = KeyIndexCache(output_layer, 'name')
+        fid = add_feature('DEF')
+        add_feature('GHI')
+        key_index_cache.add_committed_changes({fid: 'DEF'})
+        key_index_cache.update()
+        self.assertIsNone(KeyIndexCache(output_layer, 'name').load())
+
+    def test_update_composite_key(self):
+        print('\nINFO: Validating updates comparing several fields (composite key)...')
+        from AppendFeaturesToLayer.processing.utils.key_index import build_target_key_index
+
+        output_layer, layer_path = get_qgis_gpkg_layer('target_table')
+        input_layer = QgsVectorLayer("{}|layername=source_table".format(layer_path), 'layer name', 'ogr')
+        self.assertTrue(input_layer.isValid())
+
+        res = processing.run("etl_load:appendfeaturestolayer",
+                             {'SOURCE_LAYER': input_layer,
+                              'SOURCE_FIELD': None,
+                              'TARGET_LAYER': output_layer,
+                              'TARGET_FIELD': None,
+                              'ACTION_ON_DUPLICATE': 0})  # No action
+        self.assertEqual(res[APPENDED_COUNT], 2)
+
+        target_value_dict = build_target_key_index(output_layer, ['name', 'date_value'], QgsProcessingFeedback())
+        self.assertEqual(target_value_dict, {('abc', QDate(2017, 4, 12)): [1],
+                                             ('def', QDate(2018, 3, 25)): [2]})
+
+        input_layer.dataProvider().changeAttributeValues({1: {3: 30}})  # real_value --> 30
+        new_feature = QgsFeature()
+        new_feature.setAttributes([5, 'abc', 1, 2.0, QDate(2020, 1, 1)])  # Same name, but another date
+        input_layer.dataProvider().addFeatures([new_feature])
+
+        res = processing.run("etl_load:appendfeaturestolayer",
+                             {'SOURCE_LAYER': input_layer,
+                              'SOURCE_FIELD': ['name', 'date_value'],
+                              'TARGET_LAYER': output_layer,
+                              'TARGET_FIELD': ['name', 'date_value'],
+                              'ACTION_ON_DUPLICATE': 2})  # Update
+
+        self.assertEqual(output_layer.featureCount(), 3)
+        self.assertEqual(res[APPENDED_COUNT], 1)
+        self.assertEqual(res[UPDATED_FEATURE_COUNT], 2)
+        self.assertEqual(output_layer.getFeature(1)['real_value'], 30)
+
+        res = processing.run("etl_load:appendfeaturestolayer",
+                             {'SOURCE_LAYER': input_layer,
+                              'SOURCE_FIELD': ['name', 'date_value'],
+                              'TARGET_LAYER': output_layer,
+                              'TARGET_FIELD': ['name'],
+                              'ACTION_ON_DUPLICATE': 1})  # Skip
+        self.assertIsNone(res[APPENDED_COUNT])  # Source and target fields to compare don't match
+
+    def test_key_converters(self):
+        print('\nINFO: Validating precompiled key converters give the same values as QVariant...')
+        from qgis.PyQt.QtCore import QVariant
+        from AppendFeaturesToLayer.processing.utils.converters import (convert_with_qvariant,
+                                                                       get_converter,
+                                                                       get_key_converter)
+
+        samples = {QVariant.Int: [0, -12, 2 ** 31 - 1],
+                   QVariant.LongLong: [0, -12, 2 ** 31 - 1],
+                   QVariant.Double: [0.0, 2.5, -2.5, 3.7],
+                   QVariant.String: ['12', ' 12 ', '-3', '+7', '1.5', '1e3', 'abc', '', '2018-03-25', '2 ** 40',
+                                     '1_000', '\u0661\u0662', '\uff11\uff12', 'infinity'],
+                   QVariant.Date: [QDate(2018, 3, 25), QDate(1, 1, 1)]}
+        for source_type, values in samples.items():
+            for target_type in samples:
+                convert = get_converter(source_type, target_type)
+                for value in values:
+                    self.assertEqual(convert(value), convert_with_qvariant(value, target_type),
+                                     "{} -> {}: {!r}".format(QVariant.typeToName(source_type),
+                                                             QVariant.typeToName(target_type),
+                                                             value))
+
+        convert_key = get_key_converter([QVariant.String, QVariant.Int], [QVariant.Int, QVariant.String])
+        self.assertEqual(convert_key(('12', 3)), (12, '3'))
+        self.assertEqual(convert_key((None, 3)), (None, '3'))
+        self.assertIsNone(convert_key(('abc', 3)))
+        self.assertIsNone(convert_key(('1_000', 3)))
+        self.assertIsNone(convert_key(('\u0661\u0662', 3)))  # Arabic-Indic digits
+
+    @classmethod
+    def tearDownClass(cls):
+        print('INFO: Tear down test_key_index')
+        cls.plugin.unload()
@@ -0,0 +1,92 @@
+from qgis.core import (QgsFeature,
+                       QgsVectorLayer)
+from qgis.testing import unittest, start_app
+from qgis.testing.mocked import get_iface
+
+import processing
+
+from tests.utils import (get_qgis_gpkg_layer,
+                         APPENDED_COUNT,
+                         SKIPPED_COUNT,
+                         UPDATED_FEATURE_COUNT)
+
+start_app()
+
+
+class TestMultipleSources(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        print('\nINFO: Set up test_multiple_sources')
+        from AppendFeaturesToLayer.append_features_to_layer_plugin import AppendFeaturesToLayerPlugin
+        cls.plugin = AppendFeaturesToLayerPlugin(get_iface)
+        cls.plugin.initGui()
+
+    @staticmethod
+    def get_memory_layer(rows, fields="field=name:string(20)&field=real_value:double"):
+        layer = QgsVectorLayer("None?{}".format(fields), 'municipality', 'memory')
+        features = list()
+        for row in rows:
+            feature = QgsFeature(layer.fields())
+            feature.setAttributes(list(row))
+            features.append(feature)
+        layer.dataProvider().addFeatures(features)
+        return layer
+
+    def test_append_update_from_layers(self):
+        print('\nINFO: Validating table-table append/update from several source layers in a single run...')
+        output_layer, layer_path = get_qgis_gpkg_layer('target_table')
+        input_layer = QgsVectorLayer("{}|layername=source_table".format(layer_path), 'source_table', 'ogr')
+        memory_layer = self.get_memory_layer([('ghi', 5.0), ('jkl', 6.0)])
+        self.assertTrue(input_layer.isValid())
+        self.assertTrue(memory_layer.isValid())
+
+        res = processing.run("etl_load:appendfeaturesfromlayerstolayer",
+                             {'SOURCE_LAYERS': [input_layer, memory_layer],
+                              'SOURCE_FIELD': 'name',
+                              'TARGET_LAYER': output_layer,
+                              'TARGET_FIELD': 'name',
+                              'ACTION_ON_DUPLICATE': 1})  # Skip
+
+        self.assertEqual(res[APPENDED_COUNT], 4)
+        self.assertEqual(res[SKIPPED_COUNT], 0)
+        self.assertEqual(sorted(f['name'] for f in output_layer.getFeatures()), ['abc', 'def', 'ghi', 'jkl'])
+
+        # Batches mix features from both source layers
+        input_layer.dataProvider().changeAttributeValues({1: {3: 30}})  # real_value --> 30
+        memory_layer.dataProvider().changeAttributeValues({1: {1: 50}})  # real_value --> 50
+        res = processing.run("etl_load:appendfeaturesfromlayerstolayer",
+                             {'SOURCE_LAYERS': [input_layer, memory_layer],
+                              'SOURCE_FIELD': 'name',
+                              'TARGET_LAYER': output_layer,
+                              'TARGET_FIELD': 'name',
+                              'ACTION_ON_DUPLICATE': 2,  # Update
+                              'BATCH_SIZE': 3})
+
+        self.assertEqual(output_layer.featureCount(), 4)
+        self.assertEqual(res[APPENDED_COUNT], 0)
+        self.assertEqual(res[UPDATED_FEATURE_COUNT], 4)
+        self.assertEqual(next(output_layer.getFeatures('"name"=\'abc\''))['real_value'], 30)
+        self.assertEqual(next(output_layer.getFeatures('"name"=\'ghi\''))['real_value'], 50)
+
+    def test_source_field_not_in_all_layers(self):
+        print('\nINFO: Validating source fields to compare must be found in all source layers...')
+        output_layer, layer_path = get_qgis_gpkg_layer('target_table')
+        input_layer = QgsVectorLayer("{}|layername=source_table".format(layer_path), 'source_table', 'ogr')
+        memory_layer = self.get_memory_layer([(5.0,)], "field=real_value:double")
+
+        res = processing.run("etl_load:appendfeaturesfromlayerstolayer",
+                             {'SOURCE_LAYERS': [input_layer, memory_layer],
+                              'SOURCE_FIELD': 'name',
+                              'TARGET_LAYER': output_layer,
+                              'TARGET_FIELD': 'name',
+                              'ACTION_ON_DUPLICATE': 1})  # Skip
+
+        self.assertIsNone(res['TARGET_LAYER'])  # The algorithm doesn't run, and doesn't give an output
+        self.assertIsNone(res[APPENDED_COUNT])
+        self.assertEqual(output_layer.featureCount(), 0)
+
+    @classmethod
+    def tearDownClass(cls):
+        print('INFO: Tear down test_multiple_sources')
+        cls.plugin.unload()
@@ -11,6 +11,7 @@ import processing
 from tests.utils import (get_test_file_copy_path,
                          get_qgis_gpkg_layer,
                          APPENDED_COUNT,
+                         DELETED_COUNT,
                          SKIPPED_COUNT,
                          UPDATED_FEATURE_COUNT,
                          UPDATED_ONLY_GEOMETRY_COUNT)
@@ -156,6 +157,28 @@ class TestParameterErrors(unittest.TestCase):
 
         self.assertEqual(output_layer.featureCount(), 0)
 
+    def test_delete_missing_no_on_duplicate(self):
+        print('\nINFO: Validating delete missing features with no on_duplicate option...')
+
+        gpkg = get_test_file_copy_path('insert_features_to_layer_test.gpkg')
+
+        res = processing.run("etl_load:appendfeaturestolayer",
+                             {'SOURCE_LAYER': "{}|layername=source_table".format(gpkg),
+                              'SOURCE_FIELD': None,
+                              'TARGET_LAYER': "{}|layername=target_table".format(gpkg),
+                              'TARGET_FIELD': None,
+                              'ACTION_ON_DUPLICATE': 0,  # No action
+                              'DELETE_MISSING': True})
+
+        self.assertIsNone(res['TARGET_LAYER'])  # The algorithm doesn't run, and doesn't give an output
+        self.assertIsNone(res[APPENDED_COUNT])
+        self.assertIsNone(res[DELETED_COUNT])
+
+        # Target layer remains untouched
+        layer = QgsVectorLayer("{}|layername=target_table".format(gpkg), 'a', 'ogr')
+        self.assertTrue(layer.isValid())
+        self.assertEqual(layer.featureCount(), 0)
+
     @classmethod
     def tearDownClass(self):
         print('INFO: Tear down test_parameter_errors')
@@ -1,17 +1,26 @@
+from unittest.mock import patch
+
 from qgis.PyQt.QtCore import QDate
-from qgis.core import (QgsVectorLayerUtils,
+from qgis.core import (NULL,
+                       QgsEditError,
+                       QgsProcessingFeedback,
+                       QgsVectorLayerUtils,
                        QgsGeometry,
                        QgsVectorLayer)
 from qgis.testing import unittest, start_app
 from qgis.testing.mocked import get_iface
 import processing
 
+from AppendFeaturesToLayer.processing.utils.writers import (PostgresCopyWriter,
+                                                            PostgresUpsertWriter)
 from tests.utils import (CommonTests,
                          get_qgis_pg_layer,
                          APPENDED_COUNT,
                          SKIPPED_COUNT,
                          UPDATED_FEATURE_COUNT,
                          UPDATED_ONLY_GEOMETRY_COUNT,
+                         UNCHANGED_COUNT,
+                         DELETED_COUNT,
                          PG_BD_1,
                          prepare_pg_db_1,
                          drop_all_tables,
@@ -31,6 +40,15 @@ class TestPGSimplePolySimplePoly(unittest.TestCase):
         cls.common = CommonTests()
         prepare_pg_db_1()
 
+    def spy(self, writer_class, method_name):
+        """
+        Count calls to a writer method, which still does its work, until the end of the test.
+        """
+        patcher = patch.object(writer_class, method_name, autospec=True,
+                               side_effect=getattr(writer_class, method_name))
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
     def test_copy_all(self):
         print('\nINFO: Validating PG simple_pol-simple_pol copy&paste all...')
         pg_layer = get_qgis_pg_layer(PG_BD_1, 'target_simple_polygons')
@@ -54,6 +72,246 @@ class TestPGSimplePolySimplePoly(unittest.TestCase):
         self.assertEqual(layer.featureCount(), 1)
         self.assertEqual(res[APPENDED_COUNT], 1)
 
+    def test_copy_all_native(self):
+        print('\nINFO: Validating pg simple_pol-simple_pol copy&paste all via COPY...')
+        pg_layer = get_qgis_pg_layer(PG_BD_1, 'target_simple_polygons', truncate=True)
+        self.assertTrue(pg_layer.isValid())
+        self.assertEqual(pg_layer.featureCount(), 0)
+
+        output_layer, layer_path = get_qgis_gpkg_layer('target_simple_polygons')
+        copy = self.spy(PostgresCopyWriter, '_copy')
+        res = processing.run("etl_load:appendfeaturestolayer",
+                             {'SOURCE_LAYER': "{}|layername=source_simple_polygons".format(layer_path),
+                              'SOURCE_FIELD': None,
+                              'TARGET_LAYER': pg_layer,
+                              'TARGET_FIELD': None,
+                              'ACTION_ON_DUPLICATE': 0,  # No action
+                              'WRITE_MODE': 2})  # Native
+
+        self.assertEqual(copy.call_count, 1)  # Not written through the data provider
+        self.assertEqual(res[APPENDED_COUNT], 2)
+        self.assertEqual(pg_layer.featureCount(), 2)
+
+        features = {f['name']: f for f in pg_layer.getFeatures()}
+        self.assertEqual(sorted(features.keys()), ['abc', 'def'])
+        self.assertEqual(features['abc']['date_value'], QDate(2018, 3, 26))
+        self.assertTrue(features['abc'].hasGeometry())
+        self.assertEqual(features['abc'].geometry().wkbType(), pg_layer.wkbType())
+
+    def test_copy_native_connection_error(self):
+        print('\nINFO: Validating pg simple_pol-simple_pol COPY with a database that cannot be reached...')
+        pg_layer = get_qgis_pg_layer(PG_BD_1, 'target_simple_polygons', truncate=True)
+        writer = PostgresCopyWriter(pg_layer, QgsProcessingFeedback(), [pg_layer.fields().indexOf('name')])
+        writer.uri.setDatabase('db_that_does_not_exist')
+        feature = writer.create_feature(QgsGeometry(), [NULL] * pg_layer.fields().count())
+
+        with self.assertRaises(QgsEditError) as cm:
+            writer.write([feature], dict(), dict())
+
+        self.assertIn('db_that_does_not_exist', str(cm.exception))  # The connection error, not an AttributeError
+        writer.rollback()
+        self.assertEqual(pg_layer.featureCount(), 0)
+
+    def test_update_native(self):
+        print('\nINFO: Validating pg simple_pol-simple_pol update via a staging table...')
+        pg_layer = get_qgis_pg_layer(PG_BD_1, 'target_simple_polygons', truncate=True)
+        input_layer, layer_path = get_qgis_gpkg_layer('source_simple_polygons')
+
+        res = processing.run("etl_load:appendfeaturestolayer",
+                             {'SOURCE_LAYER': input_layer,
+                              'SOURCE_FIELD': None,
+                              'TARGET_LAYER': pg_layer,
+                              'TARGET_FIELD': None,
+                              'ACTION_ON_DUPLICATE': 0,  # No action
+                              'WRITE_MODE': 2})  # Native
+        self.assertEqual(res[APPENDED_COUNT], 2)
+
+        input_layer.dataProvider().changeAttributeValues({1: {input_layer.fields().indexOf('real_value'): 30}})
+        new_feature = QgsVectorLayerUtils().createFeature(input_layer, QgsGeometry(), {1: 'ABC'})
+        input_layer.dataProvider().addFeatures([new_feature])
+        merge = self.spy(PostgresUpsertWriter, 'merge')
+
+        res = processing.run("etl_load:appendfeaturestolayer",
+                             {'SOURCE_LAYER': input_layer,
+                              'SOURCE_FIELD': 'name',
+                              'TARGET_LAYER': pg_layer,
+                              'TARGET_FIELD': 'name',
+                              'ACTION_ON_DUPLICATE': 2,  # Update
+                              'WRITE_MODE': 2})  # Native
+
+        self.assertEqual(res[APPENDED_COUNT], 1)
+        self.assertEqual(res[UPDATED_FEATURE_COUNT], 2)
+        self.assertIsNone(res[SKIPPED_COUNT])
+        self.assertEqual(pg_layer.featureCount(), 3)
+
+        feature = next(pg_layer.getFeatures('"name"=\'abc\''))
+        self.assertEqual(feature['real_value'], 30)
+
+        res = processing.run("etl_load:appendfeaturestolayer",
+                             {'SOURCE_LAYER': input_layer,
+                              'SOURCE_FIELD': 'name',
+                              'TARGET_LAYER': pg_layer,
+                              'TARGET_FIELD': 'name',
+                              'ACTION_ON_DUPLICATE': 1,  # Skip
+                              'WRITE_MODE': 2})  # Native
+
+        self.assertEqual(res[APPENDED_COUNT], 0)
+        self.assertEqual(res[SKIPPED_COUNT], 3)
+        self.assertEqual(pg_layer.featureCount(), 3)
+
+        input_layer.dataProvider().changeAttributeValues({1: {input_layer.fields().indexOf('real_value'): 40}})
+        res = processing.run("etl_load:appendfeaturestolayer",
+                             {'SOURCE_LAYER': input_layer,
+                              'SOURCE_FIELD': 'name',
+                              'TARGET_LAYER': pg_layer,
+                              'TARGET_FIELD': 'name',
+                              'ACTION_ON_DUPLICATE': 2,  # Update
+                              'WRITE_MODE': 2,  # Native
+                              'ONLY_WRITE_CHANGES': True})
+
+        self.assertEqual(res[UPDATED_FEATURE_COUNT], 1)
+        self.assertEqual(res[UNCHANGED_COUNT], 2)
+        self.assertEqual(next(pg_layer.getFeatures('"name"=\'abc\''))['real_value'], 40)
+
+        input_layer.dataProvider().deleteFeatures([1])
+        res = processing.run("etl_load:appendfeaturestolayer",
+                             {'SOURCE_LAYER': input_layer,
+                              'SOURCE_FIELD': 'name',
+                              'TARGET_LAYER': pg_layer,
+                              'TARGET_FIELD': 'name',
+                              'ACTION_ON_DUPLICATE': 1,  # Skip
+                              'WRITE_MODE': 2,  # Native
+                              'DELETE_MISSING': True})
+
+        self.assertEqual(res[SKIPPED_COUNT], 2)
+        self.assertEqual(res[DELETED_COUNT], 1)
+        self.assertEqual(sorted(f['name'] for f in pg_layer.getFeatures()), ['ABC', 'def'])
+
+        # Duplicates were found by PostgreSQL in all runs, not through the data provider
+        self.assertEqual(merge.call_count, 4)
+
+    def test_update_native_composite_key_with_null(self):
+        print('\nINFO: Validating pg simple_pol-simple_pol update via a staging table, with NULLs in composite keys...')
+        pg_layer = get_qgis_pg_layer(PG_BD_1, 'target_simple_polygons', truncate=True)
+        input_layer, layer_path = get_qgis_gpkg_layer('source_simple_polygons')
+
+        res = processing.run("etl_load:appendfeaturestolayer",
+                             {'SOURCE_LAYER': input_layer,
+                              'SOURCE_FIELD': None,
+                              'TARGET_LAYER': pg_layer,
+                              'TARGET_FIELD': None,
+                              'ACTION_ON_DUPLICATE': 0,  # No action
+                              'WRITE_MODE': 2})  # Native
+        self.assertEqual(res[APPENDED_COUNT], 2)
+
+        # 'abc' has a NULL date in both layers
+        target_fid = next(pg_layer.getFeatures('"name"=\'abc\'')).id()
+        pg_layer.dataProvider().changeAttributeValues({target_fid: {pg_layer.fields().indexOf('date_value'): NULL}})
+        input_layer.dataProvider().changeAttributeValues({1: {input_layer.fields().indexOf('date_value'): NULL,
+                                                              input_layer.fields().indexOf('real_value'): 30}})
+
+        merge = self.spy(PostgresUpsertWriter, 'merge')
+        for write_mode in (1, 2):  # Data provider, native
+            res = processing.run("etl_load:appendfeaturestolayer",
+                                 {'SOURCE_LAYER': input_layer,
+                                  'SOURCE_FIELD': ['name', 'date_value'],
+                                  'TARGET_LAYER': pg_layer,
+                                  'TARGET_FIELD': ['name', 'date_value'],
+                                  'ACTION_ON_DUPLICATE': 2,  # Update
+                                  'WRITE_MODE': write_mode})
+
+            self.assertEqual(res[APPENDED_COUNT], 0)
+            self.assertEqual(res[UPDATED_FEATURE_COUNT], 2)
+            self.assertEqual(pg_layer.featureCount(), 2)
+            self.assertEqual(next(pg_layer.getFeatures('"name"=\'abc\''))['real_value'], 30)
+
+        self.assertEqual(merge.call_count, 1)  # Only in native mode
+
+    def test_update_native_subset(self):
+        print('\nINFO: Validating pg simple_pol-simple_pol update in native mode, with a target subset...')
+        pg_layer = get_qgis_pg_layer(PG_BD_1, 'target_simple_polygons', truncate=True)
+        input_layer, layer_path = get_qgis_gpkg_layer('source_simple_polygons')
+
+        res = processing.run("etl_load:appendfeaturestolayer",
+                             {'SOURCE_LAYER': input_layer,
+                              'SOURCE_FIELD': None,
+                              'TARGET_LAYER': pg_layer,
+                              'TARGET_FIELD': None,
+                              'ACTION_ON_DUPLICATE': 0,  # No action
+                              'WRITE_MODE': 2})  # Native
+        self.assertEqual(res[APPENDED_COUNT], 2)
+
+        original_value = next(pg_layer.getFeatures('"name"=\'abc\''))['real_value']
+        input_layer.dataProvider().changeAttributeValues({1: {input_layer.fields().indexOf('real_value'): 30}})
+        subset_layer = get_qgis_pg_layer(PG_BD_1, 'target_simple_polygons')
+        subset_layer.setSubsetString('"name" = \'def\'')
+        merge = self.spy(PostgresUpsertWriter, 'merge')
+
+        res = processing.run("etl_load:appendfeaturestolayer",
+                             {'SOURCE_LAYER': input_layer,
+                              'SOURCE_FIELD': 'name',
+                              'TARGET_LAYER': subset_layer,
+                              'TARGET_FIELD': 'name',
+                              'ACTION_ON_DUPLICATE': 2,  # Update
+                              'WRITE_MODE': 2})  # Native
+
+        # Just like through the data provider, 'abc' is not found in the subset, so it's appended
+        self.assertEqual(merge.call_count, 0)
+        self.assertEqual(res[APPENDED_COUNT], 1)
+        self.assertEqual(res[UPDATED_FEATURE_COUNT], 1)
+        self.assertEqual(pg_layer.featureCount(), 3)
+        self.assertEqual(sorted(f['real_value'] for f in pg_layer.getFeatures('"name"=\'abc\'')),
+                         sorted([original_value, 30]))  # The feature outside the subset was not updated
+
+    def test_delete_missing_native_subset(self):
+        print('\nINFO: Validating pg simple_pol-simple_pol delete missing features in native mode, with a target subset...')
+        pg_layer = get_qgis_pg_layer(PG_BD_1, 'target_simple_polygons', truncate=True)
+        input_layer, layer_path = get_qgis_gpkg_layer('source_simple_polygons')
+
+        res = processing.run("etl_load:appendfeaturestolayer",
+                             {'SOURCE_LAYER': input_layer,
+                              'SOURCE_FIELD': None,
+                              'TARGET_LAYER': pg_layer,
+                              'TARGET_FIELD': None,
+                              'ACTION_ON_DUPLICATE': 0,  # No action
+                              'WRITE_MODE': 2})  # Native
+        self.assertEqual(res[APPENDED_COUNT], 2)
+
+        # 'abc' is neither in the source layer nor in the target subset
+        input_layer.dataProvider().deleteFeatures([1])
+        subset_layer = get_qgis_pg_layer(PG_BD_1, 'target_simple_polygons')
+        subset_layer.setSubsetString('"name" = \'def\'')
+        merge = self.spy(PostgresUpsertWriter, 'merge')
+
+        res = processing.run("etl_load:appendfeaturestolayer",
+                             {'SOURCE_LAYER': input_layer,
+                              'SOURCE_FIELD': 'name',
+                              'TARGET_LAYER': subset_layer,
+                              'TARGET_FIELD': 'name',
+                              'ACTION_ON_DUPLICATE': 1,  # Skip
+                              'WRITE_MODE': 2,  # Native
+                              'DELETE_MISSING': True})
+
+        self.assertEqual(merge.call_count, 0)
+        self.assertEqual(res[SKIPPED_COUNT], 1)
+        self.assertEqual(res[DELETED_COUNT], 0)
+        self.assertEqual(sorted(f['name'] for f in pg_layer.getFeatures()), ['abc', 'def'])
+
+    def test_native_join_plan(self):
+        print('\nINFO: Validating pg simple_pol-simple_pol staging table join plan...')
+        pg_layer = get_qgis_pg_layer(PG_BD_1, 'target_simple_polygons', truncate=True)
+        writer = PostgresUpsertWriter(pg_layer, QgsProcessingFeedback(), [pg_layer.fields().indexOf('name')], 'name')
+        writer.create_staging_table()
+        self.addCleanup(writer.finish)
+
+        equal = writer._join_conditions('t', 's')[0]  # Keys without NULL values, i.e., most of them
+        with writer.connection.cursor() as cursor:
+            cursor.execute("SET enable_nestloop = off")  # Only a join that needs it gets a nested loop
+            cursor.execute("EXPLAIN SELECT count(*) FROM {} s JOIN {} t ON {}".format(writer.STAGING_TABLE, writer.table, equal))
+            plan = "\n".join(row[0] for row in cursor.fetchall())
+
+        self.assertNotIn('Nested Loop', plan)
+
     def test_update(self):
         print('\nINFO: Validating pg simple_pol-simple_pol update...')
         pg_layer = get_qgis_pg_layer(PG_BD_1, 'target_simple_polygons', truncate=True)
@@ -1,4 +1,6 @@
+from qgis.PyQt.QtCore import QVariant
 from qgis.core import (QgsApplication,
+                       QgsField,
                        QgsVectorLayer,
                        QgsProcessingFeatureSourceDefinition,
                        QgsProject,
@@ -18,6 +20,7 @@ from tests.utils import (CommonTests,
                          APPENDED_COUNT,
                          UPDATED_FEATURE_COUNT,
                          SKIPPED_COUNT,
+                         UNCHANGED_COUNT,
                          drop_all_tables,
                          truncate_table,
                          JSON_VALUE_1,
@@ -48,6 +51,17 @@ class TestPGTablePGTable(unittest.TestCase):
         self.assertEqual(layer.featureCount(), 2)
         self.assertEqual(res[APPENDED_COUNT], 2)
 
+    def test_copy_value_json(self):
+        print('\nINFO: Validating values written with COPY to JSON columns...')
+        from AppendFeaturesToLayer.processing.utils.writers import PostgresCopyWriter
+
+        field = QgsField('json_value', QVariant.Map, 'json')
+        self.assertEqual(PostgresCopyWriter._copy_value(JSON_VALUE_2, field), '{"c": "def"}')
+        self.assertEqual(PostgresCopyWriter._copy_value(True, field), 'true')
+
+        # JSON text (e.g., from a string field) is not turned into a JSON string
+        self.assertEqual(PostgresCopyWriter._copy_value('{"c": "def"}', field), '{"c": "def"}')
+
     def _test_copy_all_json_to_json(self):
         print('\nINFO: Validating gpkg table - pg table copy&paste all (JSON to JSON)...')
         conn = get_pg_conn(PG_BD_1)
@@ -136,6 +150,46 @@ class TestPGTablePGTable(unittest.TestCase):
         for f in layer.getFeatures():
             self.assertEqual(f['text_value'], expected_json_values[f['name']])
 
+    def test_update_native_only_changes_json(self):
+        print('\nINFO: Validating gpkg table - pg table update only changes via a staging table (String to JSON)...')
+        conn = get_pg_conn(PG_BD_1)
+        self.assertIsNotNone(conn)
+        cur = conn.cursor()
+        cur.execute("""ALTER TABLE target_table ADD COLUMN IF NOT EXISTS text_value JSON;""")
+        cur.close()
+        conn.commit()
+
+        pg_layer = get_qgis_pg_layer(PG_BD_1, 'target_table', truncate=True)
+        input_layer, layer_path = get_qgis_gpkg_layer('source_table')
+        params = {'SOURCE_LAYER': input_layer,
+                  'SOURCE_FIELD': None,
+                  'TARGET_LAYER': pg_layer,
+                  'TARGET_FIELD': None,
+                  'ACTION_ON_DUPLICATE': 0,  # No action
+                  'WRITE_MODE': 2}  # Native
+        res = processing.run("etl_load:appendfeaturestolayer", params)
+        self.assertEqual(res[APPENDED_COUNT], 2)
+
+        params.update({'SOURCE_FIELD': 'name',
+                       'TARGET_FIELD': 'name',
+                       'ACTION_ON_DUPLICATE': 2,  # Update
+                       'ONLY_WRITE_CHANGES': True})
+        res = processing.run("etl_load:appendfeaturestolayer", params)
+        self.assertEqual(res[UPDATED_FEATURE_COUNT], 0)
+        self.assertEqual(res[UNCHANGED_COUNT], 2)
+
+        source_fid = next(input_layer.getFeatures('"name" = \'abc\'')).id()
+        input_layer.dataProvider().changeAttributeValues({source_fid: {input_layer.fields().indexOf('text_value'): '{"c": "xyz"}'}})
+        res = processing.run("etl_load:appendfeaturestolayer", params)
+        self.assertEqual(res[UPDATED_FEATURE_COUNT], 1)
+        self.assertEqual(res[UNCHANGED_COUNT], 1)
+        self.assertEqual(next(pg_layer.getFeatures('"name" = \'abc\''))['text_value'], {"c": "xyz"})
+
+        cur = conn.cursor()
+        cur.execute("""ALTER TABLE target_table DROP COLUMN text_value;""")
+        cur.close()
+        conn.commit()
+
     def test_copy_selected(self):
         print('\nINFO: Validating gpkg table - pg table copy&paste selected...')
         res = self.common._test_copy_selected('source_table', get_qgis_pg_layer(PG_BD_1, 'target_table'))
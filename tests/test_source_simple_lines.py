@@ -1,6 +1,12 @@
+from qgis.core import (QgsFeature,
+                       QgsGeometry,
+                       QgsVectorLayer,
+                       QgsWkbTypes)
 from qgis.testing import unittest, start_app
 from qgis.testing.mocked import get_iface
 
+import processing
+
 from tests.utils import (CommonTests,
                          get_qgis_gpkg_layer,
                          APPENDED_COUNT)
@@ -39,6 +45,47 @@ class TestSimplePolySimpleLine(unittest.TestCase):
         self.assertEqual(layer.featureCount(), 1)
         self.assertEqual(res[APPENDED_COUNT], 1)
 
+    def test_geometry_conversion_plan(self):
+        print('\nINFO: Validating geometry conversion plans...')
+        from AppendFeaturesToLayer.processing.utils.geometry import GeometryConversionPlan
+
+        plan = GeometryConversionPlan(QgsWkbTypes.Polygon, QgsWkbTypes.Polygon)
+        self.assertEqual(plan.kind, GeometryConversionPlan.IDENTITY)
+        plan = GeometryConversionPlan(QgsWkbTypes.Point, QgsWkbTypes.MultiPoint)
+        self.assertEqual(plan.kind, GeometryConversionPlan.PROMOTE_TO_MULTI)
+        plan = GeometryConversionPlan(QgsWkbTypes.PolygonZ, QgsWkbTypes.LineString)
+        self.assertEqual(plan.kind, GeometryConversionPlan.GENERIC)
+        self.assertTrue(plan.drop_z)
+        self.assertEqual(plan.convert(QgsGeometry.fromWkt('PolygonZ ((0 0 1, 1 0 1, 1 1 1, 0 0 1))')).asWkt(),
+                         'LineString (0 0, 1 0, 1 1, 0 0)')
+        plan = GeometryConversionPlan(QgsWkbTypes.Point, QgsWkbTypes.NoGeometry)
+        self.assertEqual(plan.kind, GeometryConversionPlan.NO_GEOMETRY)
+        plan = GeometryConversionPlan(QgsWkbTypes.Point, QgsWkbTypes.LineString)
+        self.assertFalse(plan.is_supported())
+
+        # Multi-part geometries in a single-part layer are converted too
+        plan = GeometryConversionPlan(QgsWkbTypes.LineString, QgsWkbTypes.MultiLineString)
+        self.assertEqual(plan.convert(QgsGeometry.fromWkt('MultiLineString ((0 0, 1 1))')).asWkt(),
+                         'MultiLineString ((0 0, 1 1))')
+
+    def test_unsupported_geometry_conversion(self):
+        print('\nINFO: Validating points cannot be copied to lines...')
+        output_layer, layer_path = get_qgis_gpkg_layer('target_simple_lines')
+        input_layer = QgsVectorLayer("Point?crs=EPSG:3116&field=name:string(20)", 'points', 'memory')
+        feature = QgsFeature(input_layer.fields())
+        feature.setGeometry(QgsGeometry.fromWkt('Point (1001318 1013949)'))
+        input_layer.dataProvider().addFeatures([feature])
+
+        res = processing.run("etl_load:appendfeaturestolayer",
+                             {'SOURCE_LAYER': input_layer,
+                              'SOURCE_FIELD': None,
+                              'TARGET_LAYER': output_layer,
+                              'TARGET_FIELD': None,
+                              'ACTION_ON_DUPLICATE': 0})  # No action
+
+        self.assertIsNone(res[APPENDED_COUNT])
+        self.assertEqual(output_layer.featureCount(), 0)
+
     @classmethod
     def tearDownClass(cls):
         print('INFO: Tear down simple_pol-simple_lin')
@@ -1,6 +1,11 @@
-from qgis.PyQt.QtCore import QDate
+from qgis.PyQt.QtCore import QDate, QVariant
 from qgis.core import (QgsVectorLayerUtils,
+                       QgsFeature,
+                       QgsFeatureRequest,
+                       QgsField,
                        QgsGeometry,
+                       QgsProject,
+                       QgsRectangle,
                        QgsVectorLayer)
 from qgis.testing import unittest, start_app
 from qgis.testing.mocked import get_iface
@@ -44,6 +49,168 @@ class TestSimplePolySimplePoly(unittest.TestCase):
         self.assertEqual(layer.featureCount(), 1)
         self.assertEqual(res[APPENDED_COUNT], 1)
 
+    def test_copy_all_native(self):
+        print('\nINFO: Validating simple_pol-simple_pol copy&paste all with SQLite in bulk...')
+        output_layer, layer_path = get_qgis_gpkg_layer('target_simple_polygons')
+        input_layer = QgsVectorLayer("{}|layername=source_simple_polygons".format(layer_path), 'layer name', 'ogr')
+        self.assertTrue(input_layer.isValid())
+
+        res = processing.run("etl_load:appendfeaturestolayer",
+                             {'SOURCE_LAYER': input_layer,
+                              'SOURCE_FIELD': None,
+                              'TARGET_LAYER': output_layer,
+                              'TARGET_FIELD': None,
+                              'ACTION_ON_DUPLICATE': 0,  # No action
+                              'WRITE_MODE': 2})  # Native
+
+        self.assertEqual(res[APPENDED_COUNT], 2)
+        self.assertEqual(output_layer.featureCount(), 2)
+
+        source_features = {f['name']: f for f in input_layer.getFeatures()}
+        for feature in output_layer.getFeatures():
+            source_feature = source_features[feature['name']]
+            self.assertEqual(feature['date_value'], source_feature['date_value'])
+            self.assertTrue(feature.geometry().equals(source_feature.geometry()))
+
+            # The spatial index must know about the new features
+            request = QgsFeatureRequest().setFilterRect(feature.geometry().boundingBox())
+            self.assertIn(feature.id(), [f.id() for f in output_layer.getFeatures(request)])
+
+        # Triggers that maintain the spatial index are restored
+        input_layer.dataProvider().changeAttributeValues({1: {input_layer.fields().indexOf('real_value'): 30}})
+        res = processing.run("etl_load:appendfeaturestolayer",
+                             {'SOURCE_LAYER': input_layer,
+                              'SOURCE_FIELD': 'name',
+                              'TARGET_LAYER': output_layer,
+                              'TARGET_FIELD': 'name',
+                              'ACTION_ON_DUPLICATE': 2,  # Update
+                              'WRITE_MODE': 2})  # Native
+
+        self.assertEqual(res[APPENDED_COUNT], 0)
+        self.assertEqual(res[UPDATED_FEATURE_COUNT], 2)
+        self.assertEqual(next(output_layer.getFeatures('"name"=\'abc\''))['real_value'], 30)
+
+        self.assertTrue(output_layer.dataProvider().deleteFeatures([1]))
+        self.assertEqual(len(list(output_layer.getFeatures(QgsFeatureRequest().setFilterRect(output_layer.extent())))), 1)
+
+    def test_copy_all_native_with_virtual_field(self):
+        print('\nINFO: Validating simple_pol-simple_pol copy&paste all to a layer with virtual fields, asking for native tools...')
+        output_layer, layer_path = get_qgis_gpkg_layer('target_simple_polygons')
+        output_layer.addExpressionField('length("name")', QgsField('name_length', QVariant.Int))
+        input_layer = QgsVectorLayer("{}|layername=source_simple_polygons".format(layer_path), 'layer name', 'ogr')
+        self.assertTrue(input_layer.isValid())
+
+        # Virtual fields have no column in the database, so the layer edit buffer is used
+        res = processing.run("etl_load:appendfeaturestolayer",
+                             {'SOURCE_LAYER': input_layer,
+                              'SOURCE_FIELD': None,
+                              'TARGET_LAYER': output_layer,
+                              'TARGET_FIELD': None,
+                              'ACTION_ON_DUPLICATE': 0,  # No action
+                              'WRITE_MODE': 2})  # Native
+
+        self.assertEqual(res[APPENDED_COUNT], 2)
+        self.assertEqual(output_layer.featureCount(), 2)
+        self.assertEqual(next(output_layer.getFeatures('"name"=\'abc\''))['name_length'], 3)
+
+    def test_avoid_intersections(self):
+        print('\nINFO: Validating simple_pol-simple_pol copy&paste all avoiding intersections...')
+        output_layer, layer_path = get_qgis_gpkg_layer('target_simple_polygons')
+        input_layer = QgsVectorLayer("{}|layername=source_simple_polygons".format(layer_path), 'layer name', 'ogr')
+        self.assertTrue(input_layer.isValid())
+        source_feature = next(input_layer.getFeatures('"name"=\'abc\''))
+        bbox = source_feature.geometry().boundingBox()
+
+        # Cover the left half of the source feature
+        avoid_layer = QgsVectorLayer("Polygon?crs={}".format(output_layer.crs().authid()), 'avoid', 'memory')
+        avoid_feature = QgsFeature()
+        avoid_feature.setGeometry(QgsGeometry.fromRect(QgsRectangle(bbox.xMinimum() - 1, bbox.yMinimum() - 1,
+                                                                    bbox.center().x(), bbox.yMaximum() + 1)))
+        avoid_layer.dataProvider().addFeatures([avoid_feature])
+        QgsProject.instance().addMapLayer(avoid_layer)
+        QgsProject.instance().setAvoidIntersectionsLayers([avoid_layer])
+
+        params = {'SOURCE_LAYER': input_layer,
+                  'SOURCE_FIELD': None,
+                  'TARGET_LAYER': output_layer,
+                  'TARGET_FIELD': None,
+                  'ACTION_ON_DUPLICATE': 0,  # No action
+                  'AVOID_INTERSECTIONS': False}
+        try:
+            res = processing.run("etl_load:appendfeaturestolayer", params)
+            self.assertEqual(res[APPENDED_COUNT], 2)
+            feature = next(output_layer.getFeatures('"name"=\'abc\''))
+            self.assertAlmostEqual(feature.geometry().area(), source_feature.geometry().area())
+
+            output_layer.dataProvider().truncate()
+            params['AVOID_INTERSECTIONS'] = True
+            res = processing.run("etl_load:appendfeaturestolayer", params)
+            self.assertEqual(res[APPENDED_COUNT], 2)
+            feature = next(output_layer.getFeatures('"name"=\'abc\''))
+            self.assertLess(feature.geometry().area(), source_feature.geometry().area())
+            self.assertFalse(feature.geometry().intersection(avoid_feature.geometry()).area() > 0.001)
+        finally:
+            QgsProject.instance().setAvoidIntersectionsLayers([])
+            QgsProject.instance().removeMapLayer(avoid_layer)
+
+    def test_avoid_intersections_split(self):
+        print('\nINFO: Validating simple_pol-simple_pol avoiding intersections that split polygons...')
+        output_layer, layer_path = get_qgis_gpkg_layer('target_simple_polygons')
+        multi_output_layer, multi_layer_path = get_qgis_gpkg_layer('target_multi_polygons', layer_path)
+        input_layer = QgsVectorLayer("{}|layername=source_simple_polygons".format(layer_path), 'layer name', 'ogr')
+        self.assertTrue(input_layer.isValid())
+        bbox = next(input_layer.getFeatures('"name"=\'abc\'')).geometry().boundingBox()
+
+        # A strip across the source feature splits it into two parts
+        avoid_layer = QgsVectorLayer("Polygon?crs={}".format(output_layer.crs().authid()), 'avoid', 'memory')
+        avoid_feature = QgsFeature()
+        avoid_feature.setGeometry(QgsGeometry.fromRect(QgsRectangle(bbox.center().x() - 1, bbox.yMinimum() - 1,
+                                                                    bbox.center().x() + 1, bbox.yMaximum() + 1)))
+        avoid_layer.dataProvider().addFeatures([avoid_feature])
+        QgsProject.instance().addMapLayer(avoid_layer)
+        QgsProject.instance().setAvoidIntersectionsLayers([avoid_layer])
+
+        params = {'SOURCE_LAYER': input_layer,
+                  'SOURCE_FIELD': None,
+                  'TARGET_LAYER': output_layer,
+                  'TARGET_FIELD': None,
+                  'ACTION_ON_DUPLICATE': 0}  # No action
+        try:
+            # Single-part target layer: the split feature is not appended, instead of losing one of its parts
+            res = processing.run("etl_load:appendfeaturestolayer", params)
+            self.assertEqual(res[APPENDED_COUNT], 1)
+            self.assertEqual([f['name'] for f in output_layer.getFeatures()], ['def'])
+
+            params['TARGET_LAYER'] = multi_output_layer
+            res = processing.run("etl_load:appendfeaturestolayer", params)
+            self.assertEqual(res[APPENDED_COUNT], 2)
+            feature = next(multi_output_layer.getFeatures('"name"=\'abc\''))
+            self.assertEqual(feature.geometry().constGet().numGeometries(), 2)
+        finally:
+            QgsProject.instance().setAvoidIntersectionsLayers([])
+            QgsProject.instance().removeMapLayer(avoid_layer)
+
+    def test_copy_all_geometry_workers(self):
+        print('\nINFO: Validating simple_pol-multi_pol copy&paste all preparing geometries in parallel workers...')
+        output_layer, layer_path = get_qgis_gpkg_layer('target_multi_polygons')
+        input_layer = QgsVectorLayer("{}|layername=source_simple_polygons".format(layer_path), 'layer name', 'ogr')
+        self.assertTrue(input_layer.isValid())
+
+        res = processing.run("etl_load:appendfeaturestolayer",
+                             {'SOURCE_LAYER': input_layer,
+                              'SOURCE_FIELD': None,
+                              'TARGET_LAYER': output_layer,
+                              'TARGET_FIELD': None,
+                              'ACTION_ON_DUPLICATE': 0,  # No action
+                              'GEOMETRY_WORKERS': 2})
+
+        self.assertEqual(res[APPENDED_COUNT], 2)
+        source_features = {f['name']: f for f in input_layer.getFeatures()}
+        for feature in output_layer.getFeatures():
+            source_geometry = QgsGeometry(source_features[feature['name']].geometry())
+            source_geometry.convertToMultiType()
+            self.assertEqual(feature.geometry().asWkt(), source_geometry.asWkt())
+
     def test_update(self):
         print('\nINFO: Validating simple_pol-simple_pol update...')
         output_layer, layer_path = get_qgis_gpkg_layer('target_simple_polygons')
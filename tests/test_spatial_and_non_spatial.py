@@ -1,14 +1,18 @@
+from unittest.mock import patch
+
 from qgis.core import (QgsApplication,
                        QgsVectorLayer,
                        QgsProcessingFeatureSourceDefinition,
                        QgsProject,
                        QgsFeature,
+                       QgsFeatureRequest,
                        QgsGeometry)
 from qgis.testing import unittest, start_app
 from qgis.testing.mocked import get_iface
 
 import processing
 
+from AppendFeaturesToLayer.processing.utils.sources import LoadSource
 from tests.utils import (APPENDED_COUNT,
                          SKIPPED_COUNT,
                          UPDATED_FEATURE_COUNT,
@@ -100,6 +104,59 @@ class TestSpatialAndNonSpatialUpdates(unittest.TestCase):
         # while the other 2 features have still a non-NULL geometry
         self.assertEqual(updated_geoms.count(QgsGeometry().asWkt()), res[APPENDED_COUNT])
 
+    def test_append_spatial_features_to_non_spatial_layer(self):
+        print('\nINFO: Validating only mapped fields are read from a spatial source to append to a non-spatial layer...')
+        source = QgsVectorLayer("Point?crs=EPSG:3116&field=name:string&field=unmapped:string&field=code:integer",
+                                'source', 'memory')
+        feature = QgsFeature(source.fields())
+        feature.setAttributes(['abc', 'not copied', 7])
+        feature.setGeometry(QgsGeometry.fromWkt('Point (1 2)'))
+        source.dataProvider().addFeatures([feature])
+
+        target = QgsVectorLayer("None?field=code:integer&field=name:string", 'target', 'memory')
+        target_feature = QgsFeature(target.fields())
+        target_feature.setAttributes([7, 'old'])
+        target.dataProvider().addFeatures([target_feature])
+
+        requests = list()
+        original_request = LoadSource.request
+
+        def request(load_source, copy_geometries):
+            source_request = original_request(load_source, copy_geometries)
+            requests.append(source_request)
+            return source_request
+
+        with patch.object(LoadSource, 'request', autospec=True, side_effect=request):
+            res = processing.run("etl_load:appendfeaturestolayer",
+                                 {'SOURCE_LAYER': source,
+                                  'SOURCE_FIELD': 'code',
+                                  'TARGET_LAYER': target,
+                                  'TARGET_FIELD': 'code',
+                                  'ACTION_ON_DUPLICATE': 2})  # Update
+
+        # Neither geometries nor unmapped fields were read from the source
+        self.assertEqual(len(requests), 1)
+        self.assertTrue(requests[0].flags() & QgsFeatureRequest.NoGeometry)
+        self.assertEqual(sorted(requests[0].subsetOfAttributes()),
+                         [source.fields().indexOf('name'), source.fields().indexOf('code')])
+
+        self.assertEqual(res[UPDATED_FEATURE_COUNT], 1)
+        self.assertEqual(target.featureCount(), 1)
+        self.assertEqual(next(target.getFeatures()).attributes(), [7, 'abc'])
+
+        feature.setAttributes(['def', 'not copied', 8])
+        source.dataProvider().addFeatures([feature])
+        res = processing.run("etl_load:appendfeaturestolayer",
+                             {'SOURCE_LAYER': source,
+                              'SOURCE_FIELD': 'code',
+                              'TARGET_LAYER': target,
+                              'TARGET_FIELD': 'code',
+                              'ACTION_ON_DUPLICATE': 1})  # Skip
+
+        self.assertEqual(res[APPENDED_COUNT], 1)
+        self.assertEqual(res[SKIPPED_COUNT], 1)
+        self.assertEqual(next(target.getFeatures('"code"=8')).attributes(), [8, 'def'])
+
     @classmethod
     def tearDownClass(cls):
         print('INFO: Tear down test_pg_table_pg_table')
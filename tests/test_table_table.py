@@ -1,10 +1,15 @@
 from qgis.PyQt.QtCore import QVariant
-from qgis.core import (QgsApplication,
+from qgis.core import (NULL,
+                       QgsApplication,
                        QgsVectorLayer,
                        QgsProcessingFeatureSourceDefinition,
                        QgsProject,
+                       QgsDefaultValue,
                        QgsFeature,
-                       QgsField)
+                       QgsField,
+                       QgsFieldConstraints,
+                       QgsGeometry,
+                       QgsVectorLayerUtils)
 from qgis.testing import unittest, start_app
 from qgis.testing.mocked import get_iface
 
@@ -16,6 +21,9 @@ from tests.utils import (CommonTests,
                          UPDATED_FEATURE_COUNT,
                          SKIPPED_COUNT,
                          UPDATED_ONLY_GEOMETRY_COUNT,
+                         UNCHANGED_COUNT,
+                         DELETED_COUNT,
+                         FILTERED_COUNT,
                          JSON_VALUE_1,
                          JSON_VALUE_2)
 
@@ -295,6 +303,325 @@ class TestTableTable(unittest.TestCase):
         self.assertEqual(res[SKIPPED_COUNT], 0)
         self.assertIsNone(res[UPDATED_ONLY_GEOMETRY_COUNT])
 
+    def test_append_update_in_batches(self):
+        print('\nINFO: Validating table-table append/update committing in batches...')
+        output_layer, layer_path = get_qgis_gpkg_layer('target_table')
+        input_layer = QgsVectorLayer("None?field=name:string(20)&field=real_value:double", 'source', 'memory')
+        self.assertTrue(input_layer.isValid())
+        features = list()
+        for i, name in enumerate(['a', 'b', 'c', 'd', 'e']):
+            feature = QgsFeature(input_layer.fields())
+            feature.setAttributes([name, float(i)])
+            features.append(feature)
+        self.assertTrue(input_layer.dataProvider().addFeatures(features)[0])
+
+        res = processing.run("etl_load:appendfeaturestolayer",
+                             {'SOURCE_LAYER': input_layer,
+                              'SOURCE_FIELD': None,
+                              'TARGET_LAYER': output_layer,
+                              'TARGET_FIELD': None,
+                              'ACTION_ON_DUPLICATE': 0,  # No action
+                              'BATCH_SIZE': 2})
+
+        self.assertEqual(output_layer.featureCount(), 5)
+        self.assertEqual(res[APPENDED_COUNT], 5)
+
+        input_layer.dataProvider().changeAttributeValues({1: {1: 10.0}, 5: {1: 50.0}})
+        feature = QgsFeature(input_layer.fields())
+        feature.setAttributes(['f', 6.0])
+        self.assertTrue(input_layer.dataProvider().addFeatures([feature])[0])
+
+        res = processing.run("etl_load:appendfeaturestolayer",
+                             {'SOURCE_LAYER': input_layer,
+                              'SOURCE_FIELD': 'name',
+                              'TARGET_LAYER': output_layer,
+                              'TARGET_FIELD': 'name',
+                              'ACTION_ON_DUPLICATE': 2,  # Update
+                              'BATCH_SIZE': 2})
+
+        self.assertEqual(output_layer.featureCount(), 6)
+        self.assertEqual(res[APPENDED_COUNT], 1)
+        self.assertEqual(res[UPDATED_FEATURE_COUNT], 5)
+        self.assertEqual(next(output_layer.getFeatures('"name"=\'a\''))['real_value'], 10.0)
+        self.assertEqual(next(output_layer.getFeatures('"name"=\'e\''))['real_value'], 50.0)
+
+    def test_append_update_through_data_provider(self):
+        print('\nINFO: Validating table-table append/update writing through the data provider...')
+        output_layer, layer_path = get_qgis_gpkg_layer('target_table')
+        input_layer = QgsVectorLayer("{}|layername=source_table".format(layer_path), 'layer name', 'ogr')
+        self.assertTrue(input_layer.isValid())
+
+        res = processing.run("etl_load:appendfeaturestolayer",
+                             {'SOURCE_LAYER': input_layer,
+                              'SOURCE_FIELD': None,
+                              'TARGET_LAYER': output_layer,
+                              'TARGET_FIELD': None,
+                              'ACTION_ON_DUPLICATE': 0,  # No action
+                              'WRITE_MODE': 1})  # Data provider
+
+        self.assertEqual(output_layer.featureCount(), 2)
+        self.assertEqual(res[APPENDED_COUNT], 2)
+        self.assertFalse(output_layer.isEditable())
+
+        input_layer.dataProvider().changeAttributeValues({1: {3: 30}})  # real_value --> 30
+
+        res = processing.run("etl_load:appendfeaturestolayer",
+                             {'SOURCE_LAYER': input_layer,
+                              'SOURCE_FIELD': 'name',
+                              'TARGET_LAYER': output_layer,
+                              'TARGET_FIELD': 'name',
+                              'ACTION_ON_DUPLICATE': 2,  # Update
+                              'WRITE_MODE': 1})  # Data provider
+
+        self.assertEqual(output_layer.featureCount(), 2)
+        self.assertEqual(res[APPENDED_COUNT], 0)
+        self.assertEqual(res[UPDATED_FEATURE_COUNT], 2)
+        self.assertEqual(next(output_layer.getFeatures('"name"=\'abc\''))['real_value'], 30)
+
+    def test_update_only_changes(self):
+        print('\nINFO: Validating table-table update only writing changes...')
+        output_layer, layer_path = get_qgis_gpkg_layer('target_table')
+        input_layer = QgsVectorLayer("{}|layername=source_table".format(layer_path), 'layer name', 'ogr')
+        self.assertTrue(input_layer.isValid())
+
+        res = processing.run("etl_load:appendfeaturestolayer",
+                             {'SOURCE_LAYER': input_layer,
+                              'SOURCE_FIELD': None,
+                              'TARGET_LAYER': output_layer,
+                              'TARGET_FIELD': None,
+                              'ACTION_ON_DUPLICATE': 0})  # No action
+        self.assertEqual(res[APPENDED_COUNT], 2)
+        self.assertIsNone(res[UNCHANGED_COUNT])
+
+        input_layer.dataProvider().changeAttributeValues({1: {3: 30}})  # real_value --> 30
+        changed_attributes = list()
+        output_layer.committedAttributeValuesChanges.connect(
+            lambda layer_id, changes: changed_attributes.append(changes))
+
+        res = processing.run("etl_load:appendfeaturestolayer",
+                             {'SOURCE_LAYER': input_layer,
+                              'SOURCE_FIELD': 'name',
+                              'TARGET_LAYER': output_layer,
+                              'TARGET_FIELD': 'name',
+                              'ACTION_ON_DUPLICATE': 2,  # Update
+                              'ONLY_WRITE_CHANGES': True})
+
+        self.assertEqual(res[APPENDED_COUNT], 0)
+        self.assertEqual(res[UPDATED_FEATURE_COUNT], 1)
+        self.assertEqual(res[UNCHANGED_COUNT], 1)
+        self.assertEqual(next(output_layer.getFeatures('"name"=\'abc\''))['real_value'], 30)
+
+        # Only the changed field of the changed feature was written
+        self.assertEqual(len(changed_attributes), 1)
+        self.assertEqual([list(attrs.keys()) for attrs in changed_attributes[0].values()],
+                         [[output_layer.fields().indexOf('real_value')]])
+
+    def test_sync_delete_missing(self):
+        for write_mode in (0, 1, 2):  # Layer edit buffer, data provider, native
+            print('\nINFO: Validating table-table sync deleting features missing from source (write mode {})...'.format(write_mode))
+            output_layer, layer_path = get_qgis_gpkg_layer('target_table')
+            input_layer = QgsVectorLayer("{}|layername=source_table".format(layer_path), 'layer name', 'ogr')
+            self.assertTrue(input_layer.isValid())
+
+            params = {'SOURCE_LAYER': input_layer,
+                      'SOURCE_FIELD': None,
+                      'TARGET_LAYER': output_layer,
+                      'TARGET_FIELD': None,
+                      'ACTION_ON_DUPLICATE': 0,  # No action
+                      'WRITE_MODE': write_mode}
+            res = processing.run("etl_load:appendfeaturestolayer", params)
+            self.assertEqual(res[APPENDED_COUNT], 2)
+            self.assertIsNone(res[DELETED_COUNT])
+
+            # A target feature without value to compare is never deleted
+            feature = QgsFeature(output_layer.fields())
+            output_layer.dataProvider().addFeatures([feature])
+            self.assertEqual(output_layer.featureCount(), 3)
+
+            input_layer.dataProvider().deleteFeatures([1])
+            params.update({'SOURCE_FIELD': 'name',
+                           'TARGET_FIELD': 'name',
+                           'ACTION_ON_DUPLICATE': 1,  # Skip
+                           'KEY_INDEX_STRATEGY': 2,  # Probe (all target features must be indexed anyway)
+                           'DELETE_MISSING': True})
+            res = processing.run("etl_load:appendfeaturestolayer", params)
+
+            self.assertEqual(res[SKIPPED_COUNT], 1)
+            self.assertEqual(res[DELETED_COUNT], 1)
+            self.assertEqual(output_layer.featureCount(), 2)
+            names = [f['name'] for f in output_layer.getFeatures()]
+            self.assertNotIn('abc', names)
+            self.assertIn(NULL, names)
+
+    def test_source_filter(self):
+        print('\nINFO: Validating table-table copy&paste with a source filter...')
+        output_layer, layer_path = get_qgis_gpkg_layer('target_table')
+        input_layer = QgsVectorLayer("{}|layername=source_table".format(layer_path), 'layer name', 'ogr')
+        self.assertTrue(input_layer.isValid())
+
+        params = {'SOURCE_LAYER': input_layer,
+                  'SOURCE_FIELD': None,
+                  'TARGET_LAYER': output_layer,
+                  'TARGET_FIELD': None,
+                  'ACTION_ON_DUPLICATE': 0,  # No action
+                  'SOURCE_FILTER': '"name" = \'abc\' AND'}
+        res = processing.run("etl_load:appendfeaturestolayer", params)
+        self.assertIsNone(res['TARGET_LAYER'])  # Invalid expression, the algorithm doesn't run
+        self.assertEqual(output_layer.featureCount(), 0)
+
+        params['SOURCE_FILTER'] = '"name" = \'abc\''
+        res = processing.run("etl_load:appendfeaturestolayer", params)
+        self.assertEqual(res[APPENDED_COUNT], 1)
+        self.assertEqual(res[FILTERED_COUNT], 1)
+        self.assertEqual([f['name'] for f in output_layer.getFeatures()], ['abc'])
+
+        params['SOURCE_FILTER'] = None
+        res = processing.run("etl_load:appendfeaturestolayer", params)
+        self.assertEqual(res[APPENDED_COUNT], 2)
+        self.assertIsNone(res[FILTERED_COUNT])
+
+        # Target features matching filtered-out source features would be deleted as well
+        params.update({'SOURCE_FIELD': 'name',
+                       'TARGET_FIELD': 'name',
+                       'ACTION_ON_DUPLICATE': 1,  # Skip
+                       'SOURCE_FILTER': '"name" = \'abc\'',
+                       'DELETE_MISSING': True})
+        res = processing.run("etl_load:appendfeaturestolayer", params)
+        self.assertIsNone(res['TARGET_LAYER'])  # The algorithm doesn't run
+        self.assertEqual(output_layer.featureCount(), 3)
+
+        params['TARGET_FILTER'] = '"name" = \'abc\''
+        res = processing.run("etl_load:appendfeaturestolayer", params)
+        self.assertEqual(res[SKIPPED_COUNT], 2)
+        self.assertEqual(res[DELETED_COUNT], 0)
+        self.assertEqual(output_layer.featureCount(), 3)
+
+    def test_target_filter(self):
+        print('\nINFO: Validating table-table update only finding duplicates among filtered target features...')
+        output_layer, layer_path = get_qgis_gpkg_layer('target_table')
+        input_layer = QgsVectorLayer("{}|layername=source_table".format(layer_path), 'layer name', 'ogr')
+        self.assertTrue(input_layer.isValid())
+
+        res = processing.run("etl_load:appendfeaturestolayer",
+                             {'SOURCE_LAYER': input_layer,
+                              'SOURCE_FIELD': None,
+                              'TARGET_LAYER': output_layer,
+                              'TARGET_FIELD': None,
+                              'ACTION_ON_DUPLICATE': 0})  # No action
+        self.assertEqual(res[APPENDED_COUNT], 2)
+
+        input_layer.dataProvider().changeAttributeValues({1: {3: 30}, 2: {3: 20}})  # real_value --> 30, 20
+        for key_index_strategy in (1, 2):  # Index all target features, probe
+            params = {'SOURCE_LAYER': input_layer,
+                      'SOURCE_FIELD': 'name',
+                      'TARGET_LAYER': output_layer,
+                      'TARGET_FIELD': 'name',
+                      'TARGET_FILTER': '"name" = \'def\'',
+                      'ACTION_ON_DUPLICATE': 2,  # Update
+                      'KEY_INDEX_STRATEGY': key_index_strategy}
+            res = processing.run("etl_load:appendfeaturestolayer", params)
+
+            # 'abc' is not among filtered target features, so it's appended
+            self.assertEqual(res[UPDATED_FEATURE_COUNT], 1)
+            self.assertEqual(res[APPENDED_COUNT], 1)
+            self.assertEqual(next(output_layer.getFeatures('"name"=\'def\''))['real_value'], 20)
+            self.assertEqual(sorted(f['real_value'] for f in output_layer.getFeatures('"name"=\'abc\'')),
+                             [3.1416, 30] if key_index_strategy == 1 else [3.1416, 30, 30])
+
+        params['TARGET_FILTER'] = '"name" ='
+        res = processing.run("etl_load:appendfeaturestolayer", params)
+        self.assertIsNone(res['TARGET_LAYER'])  # Invalid expression, the algorithm doesn't run
+
+    def test_watermark(self):
+        print('\nINFO: Validating table-table incremental loads with a watermark field...')
+        output_layer, layer_path = get_qgis_gpkg_layer('target_table')
+        input_layer = QgsVectorLayer("{}|layername=source_table".format(layer_path), 'layer name', 'ogr')
+        self.assertTrue(input_layer.isValid())
+
+        params = {'SOURCE_LAYER': input_layer,
+                  'SOURCE_FIELD': 'name',
+                  'TARGET_LAYER': output_layer,
+                  'TARGET_FIELD': 'name',
+                  'ACTION_ON_DUPLICATE': 2,  # Update
+                  'WATERMARK_FIELD': 'int_value'}
+        res = processing.run("etl_load:appendfeaturestolayer", params)
+        self.assertEqual(res[APPENDED_COUNT], 2)
+        self.assertEqual(res[UPDATED_FEATURE_COUNT], 0)
+
+        # No source feature is newer than the watermark
+        res = processing.run("etl_load:appendfeaturestolayer", params)
+        self.assertEqual(res[APPENDED_COUNT], 0)
+        self.assertEqual(res[UPDATED_FEATURE_COUNT], 0)
+        self.assertEqual(res[FILTERED_COUNT], 2)
+
+        input_layer.dataProvider().changeAttributeValues({1: {2: 3, 3: 30}})  # int_value --> 3, real_value --> 30
+        res = processing.run("etl_load:appendfeaturestolayer", params)
+        self.assertEqual(res[APPENDED_COUNT], 0)
+        self.assertEqual(res[UPDATED_FEATURE_COUNT], 1)
+        self.assertEqual(next(output_layer.getFeatures('"name"=\'abc\''))['real_value'], 30)
+
+        # The watermark is stored per source and target layers
+        other_output_layer, other_layer_path = get_qgis_gpkg_layer('target_table')
+        params['TARGET_LAYER'] = other_output_layer
+        res = processing.run("etl_load:appendfeaturestolayer", params)
+        self.assertEqual(res[APPENDED_COUNT], 2)
+
+    def test_feature_template(self):
+        print('\nINFO: Validating table-table features created from a template...')
+        from AppendFeaturesToLayer.processing.utils.writers import FeatureTemplate
+        layer = QgsVectorLayer("None?field=id:integer&field=name:string&field=origin:string&field=code:integer",
+                               'target', 'memory')
+        self.assertTrue(layer.isValid())
+        layer.setDefaultValueDefinition(2, QgsDefaultValue("'etl'"))
+        layer.setFieldConstraint(3, QgsFieldConstraints.ConstraintUnique)
+        feature = QgsFeature(layer.fields())
+        feature.setAttributes([1, 'abc', 'manual', 7])
+        layer.dataProvider().addFeatures([feature])
+
+        template = FeatureTemplate(layer)
+        self.assertEqual(template.evaluate_if_null, [2, 3])
+        self.assertEqual(template.evaluate_if_not_null, [3])
+
+        for attributes in [[2, 'def', 'source', 8],  # No per-row evaluation
+                           [2, 'def', NULL, 8],  # Default value expression
+                           [2, 'def', 'source', 7],  # Unique constraint
+                           [2, 'def', 'source', NULL]]:  # Unique value
+            expected_feature = QgsVectorLayerUtils.createFeature(
+                layer, QgsGeometry(), {idx: value for idx, value in enumerate(attributes) if value != NULL})
+            self.assertEqual(template.create_feature(QgsGeometry(), list(attributes)).attributes(),
+                             expected_feature.attributes())
+
+        source = QgsVectorLayer("None?field=id:integer&field=name:string", 'source', 'memory')
+        feature = QgsFeature(source.fields())
+        feature.setAttributes([2, 'def'])
+        source.dataProvider().addFeatures([feature])
+
+        res = processing.run("etl_load:appendfeaturestolayer",
+                             {'SOURCE_LAYER': source,
+                              'SOURCE_FIELD': None,
+                              'TARGET_LAYER': layer,
+                              'TARGET_FIELD': None,
+                              'ACTION_ON_DUPLICATE': 0})  # No action
+
+        self.assertEqual(res[APPENDED_COUNT], 1)
+        self.assertEqual(next(layer.getFeatures('"id"=2'))['origin'], 'etl')
+
+    def test_attribute_transformer(self):
+        print('\nINFO: Validating table-table attribute transformer...')
+        from AppendFeaturesToLayer.processing.utils.mapping import AttributeTransformer
+        transformer = AttributeTransformer({0: 2, 2: 0, 3: 1}, 3, 5)  # {target idx: source idx}
+
+        self.assertEqual(transformer.update_map(['a', 'b', 'c']), {0: 'c', 2: 'a', 3: 'b'})
+        self.assertEqual(transformer.target_attributes(['a', 'b', 'c']), ['c', NULL, 'a', 'b', NULL])
+
+        transformer = AttributeTransformer({1: 0}, 1, 2)
+        self.assertEqual(transformer.update_map(['a']), {1: 'a'})
+        self.assertEqual(transformer.target_attributes(['a']), [NULL, 'a'])
+
+        transformer = AttributeTransformer(dict(), 1, 1)
+        self.assertEqual(transformer.update_map(['a']), dict())
+        self.assertEqual(transformer.target_attributes(['a']), [NULL])
+
     @classmethod
     def tearDownClass(self):
         print('INFO: Tear down test_table_table')
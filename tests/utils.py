@@ -21,6 +21,9 @@ APPENDED_COUNT = 'APPENDED_COUNT'
 UPDATED_FEATURE_COUNT = 'UPDATED_FEATURE_COUNT'
 UPDATED_ONLY_GEOMETRY_COUNT = 'UPDATED_ONLY_GEOMETRY_COUNT'
 SKIPPED_COUNT = 'SKIPPED_COUNT'
+UNCHANGED_COUNT = 'UNCHANGED_COUNT'
+DELETED_COUNT = 'DELETED_COUNT'
+FILTERED_COUNT = 'FILTERED_COUNT'
 
 PG_BD_1 = "db1"
 